@@ -0,0 +1,48 @@
+"""
+小规模语料精确检索对比：FAISS IndexFlatIP 与 numpy矩阵乘法（exact_search）的单次查询延迟和结果一致性
+用法（在backend目录下）: python benchmarks/bench_exact_search.py --dim 1024
+"""
+import sys
+import time
+import argparse
+import numpy as np
+import faiss
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from src.retrieval import exact_search, normalize_vectors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--sizes", type=str, default="100,1000,5000,20000,50000")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--dtype", type=str, default="float32", help="向量在vectors.npy中的数据类型: float32/float16")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"dim={args.dim} queries={args.queries} top_k={args.top_k} dtype={args.dtype}")
+    print(f"{'向量数':>8}{'faiss(ms)':>12}{'numpy(ms)':>12}{'结果一致':>10}")
+    for n in [int(size) for size in args.sizes.split(",")]:
+        vectors = normalize_vectors(rng.standard_normal((n, args.dim)))
+        queries = normalize_vectors(rng.standard_normal((args.queries, args.dim)))
+        stored = vectors.astype(args.dtype)
+
+        index = faiss.IndexFlatIP(args.dim)
+        index.add(vectors)
+        t0 = time.time()
+        faiss_ids = [index.search(q[None, :], args.top_k)[1][0] for q in queries]
+        faiss_ms = (time.time() - t0) / args.queries * 1000
+
+        t0 = time.time()
+        numpy_ids = [exact_search(stored, q[None, :], args.top_k)[1][0] for q in queries]
+        numpy_ms = (time.time() - t0) / args.queries * 1000
+
+        overlap = np.mean([len(set(a.tolist()) & set(b.tolist())) / len(a) for a, b in zip(faiss_ids, numpy_ids)])
+        print(f"{n:>8}{faiss_ms:>12.3f}{numpy_ms:>12.3f}{overlap:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
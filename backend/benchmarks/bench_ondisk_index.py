@@ -0,0 +1,150 @@
+"""
+内存受限场景下的全局检索对比：GLOBAL_INDEX_MODE=memory 与 ondisk（不同ONDISK_CACHE_MB）的常驻内存、冷/热查询延迟和召回率
+每种配置在独立子进程中加载索引，冷查询前通过 posix_fadvise(DONTNEED) 丢弃索引文件的页缓存
+用法（在backend目录下）: python benchmarks/bench_ondisk_index.py --docs 50 --chunks-per-doc 2000 --dim 256
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import tempfile
+import numpy as np
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def build_corpus(root: Path, docs: int, chunks_per_doc: int, dim: int, clusters: int):
+    """生成聚类分布的合成向量与随机词表文本，写成与向量化结果相同的文档目录"""
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((clusters, dim)).astype("float32")
+    vocab = [f"w{i}" for i in range(20000)]
+    for d in range(docs):
+        doc_dir = root / f"doc{d}"
+        doc_dir.mkdir(parents=True)
+        chunks = [
+            {"chunk_id": i, "content": " ".join(rng.choice(vocab, 120)), "page_num": i // 10 + 1}
+            for i in range(chunks_per_doc)
+        ]
+        with open(doc_dir / "chunks.json", "w", encoding="utf-8") as f:
+            json.dump(chunks, f)
+        with open(doc_dir / "metadata.json", "w", encoding="utf-8") as f:
+            json.dump({"filename": f"doc{d}.pdf", "uploaded_at": float(d)}, f)
+        vectors = centers[rng.integers(0, clusters, chunks_per_doc)] + 0.5 * rng.standard_normal((chunks_per_doc, dim))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.save(doc_dir / "vectors.npy", vectors.astype("float32"))
+    np.save(root / "queries.npy", centers[rng.integers(0, clusters, 200)] + 0.5 * rng.standard_normal((200, dim)))
+
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def drop_page_cache(directory: Path):
+    for path in directory.rglob("*"):
+        if path.is_file():
+            fd = os.open(path, os.O_RDONLY)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(fd)
+
+
+def run(root: Path, mode: str, cache_mb: int, nprobe: int, top_k: int):
+    """子进程：按指定配置加载全局索引并查询，结果以JSON输出到stdout最后一行"""
+    from src.config import settings
+    settings.GLOBAL_INDEX_MODE = mode
+    settings.ONDISK_CACHE_MB = cache_mb
+    settings.IVF_NPROBE = nprobe
+    settings.INDEX_MMAP = True
+    from src.index_store import IndexStore, publish, compact, read_snapshot
+    from src.retrieval import exact_search, normalize_vectors
+
+    queries = normalize_vectors(np.load(root / "queries.npy"))
+    # 先将全部文档合并为一个全局段，构建开销不计入加载时间和内存
+    publish(root)
+    compact(root, force=True)
+    global_dir = root / read_snapshot(root)["segments"][0]["path"]
+    drop_page_cache(root)
+    base_rss = rss_mb()
+    store = IndexStore(root)
+    t0 = time.time()
+    retrieval = store.get_retrieval()
+    load_time = time.time() - t0
+    drop_page_cache(global_dir)
+
+    latencies = []
+    results = []
+    for q in queries:
+        t0 = time.time()
+        hits = retrieval.vector_search("", top_k, query_embedding=q.tolist())
+        retrieval.bm25_search("w1 w2 w3 w4", top_k)
+        latencies.append((time.time() - t0) * 1000)
+        results.append({(c["filename"], c["chunk_id"]) for _, c in hits})
+
+    # 召回率以全量精确检索为基准
+    with open(global_dir / "manifest.json", "r", encoding="utf-8") as f:
+        documents = json.load(f)["documents"]
+    _, truth = exact_search(np.load(global_dir / "vectors.npy", mmap_mode="r"), queries, top_k)
+    recall = []
+    for ids, found in zip(truth, results):
+        expected = set()
+        for idx in ids:
+            doc = next(d for d in documents if d["offset"] <= idx < d["offset"] + d["count"])
+            expected.add((f"{doc['name']}.pdf", int(idx) - doc["offset"]))
+        recall.append(len(expected & found) / len(expected))
+
+    warm = latencies[len(latencies) // 2:]
+    print(json.dumps({
+        "load": load_time,
+        "rss": rss_mb() - base_rss,
+        "cold": latencies[0],
+        "p50": float(np.percentile(warm, 50)),
+        "p95": float(np.percentile(warm, 95)),
+        "recall": float(np.mean(recall)),
+        "cache": retrieval.get_stats()["cache"] if hasattr(retrieval, "cache") else None
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=50)
+    parser.add_argument("--chunks-per-doc", type=int, default=2000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--cache-mb", type=str, default="8,64,256")
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--run", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        root, mode, cache_mb = args.run.split(",")
+        run(Path(root), mode, int(cache_mb), args.nprobe, args.top_k)
+        return
+
+    root = Path(tempfile.mkdtemp(prefix="bench_ondisk_"))
+    try:
+        build_corpus(root, args.docs, args.chunks_per_doc, args.dim, args.clusters)
+        env = dict(os.environ, EMBEDDING_DIMENSION=str(args.dim))
+        print(f"chunks={args.docs * args.chunks_per_doc} dim={args.dim} nprobe={args.nprobe} top_k={args.top_k}")
+        print(f"{'模式':<14}{'加载(s)':>9}{'RSS增量(MB)':>13}{'冷查询(ms)':>12}{'p50(ms)':>10}{'p95(ms)':>10}{'召回率':>8}")
+        configs = [("memory", 0)] + [("ondisk", int(mb)) for mb in args.cache_mb.split(",")]
+        for mode, cache_mb in configs:
+            output = subprocess.run(
+                [sys.executable, __file__, "--run", f"{root},{mode},{cache_mb}", "--nprobe", str(args.nprobe),
+                 "--top-k", str(args.top_k)],
+                env=env, capture_output=True, text=True, check=True
+            ).stdout.strip().splitlines()[-1]
+            result = json.loads(output)
+            label = mode if mode == "memory" else f"ondisk/{cache_mb}MB"
+            print(f"{label:<14}{result['load']:>9.2f}{result['rss']:>13.1f}"
+                  f"{result['cold']:>12.2f}{result['p50']:>10.2f}{result['p95']:>10.2f}{result['recall']:>8.3f}")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
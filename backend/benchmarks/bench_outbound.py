@@ -0,0 +1,94 @@
+"""
+调度器压测：批量向量化与交互式问答同时调用受限的模拟DashScope服务
+对比直接调用与经调度器调用时的限流错误数、重试次数和各优先级排队耗时
+用法（在backend目录下）: python benchmarks/bench_outbound.py --bulk 90 --interactive 10
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from mock_dashscope import start_server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--rpm", type=int, default=60, help="模拟服务对embedding模型的每分钟请求上限")
+    parser.add_argument("--bulk", type=int, default=90)
+    parser.add_argument("--interactive", type=int, default=10)
+    args = parser.parse_args()
+
+    os.environ["DASHSCOPE_HTTP_BASE_URL"] = f"http://127.0.0.1:{args.port}/api/v1"
+    import dashscope
+    from src.config import settings
+    dashscope.base_http_api_url = os.environ["DASHSCOPE_HTTP_BASE_URL"]
+    dashscope.api_key = "mock"
+    settings.DASHSCOPE_API_KEY = "mock"
+    # 调度器配额略低于服务端限额
+    settings.MODEL_RATE_LIMITS = {settings.EMBEDDING_MODEL: {"rpm": int(args.rpm * 0.9), "tpm": 10 ** 9, "concurrency": 4}}
+    settings.OUTBOUND_BACKOFF_BASE = 0.2
+    from src.outbound import scheduler, OutboundError, PRIORITY_BULK, PRIORITY_INTERACTIVE
+    from src.retrieval import Retrieval
+
+    def run(label, call):
+        errors = []
+        latencies = {"bulk": [], "interactive": []}
+
+        def worker(kind, i):
+            t0 = time.time()
+            try:
+                call(kind, f"{kind} 文本 {i}")
+                latencies[kind].append(time.time() - t0)
+            except Exception as e:
+                errors.append(str(e)[:80])
+
+        threads = [threading.Thread(target=worker, args=("bulk", i)) for i in range(args.bulk)]
+        for t in threads:
+            t.start()
+        time.sleep(0.5)
+        # 批量任务占满配额后再发起交互式请求
+        interactive = [threading.Thread(target=worker, args=("interactive", i)) for i in range(args.interactive)]
+        for t in interactive:
+            t.start()
+            time.sleep(0.2)
+        for t in threads + interactive:
+            t.join()
+        print(f"== {label}: 失败 {len(errors)} 次")
+        for kind, values in latencies.items():
+            if values:
+                print(f"   {kind}: 完成 {len(values)} 次, 平均耗时 {sum(values) / len(values):.2f}s, 最大 {max(values):.2f}s")
+
+    # 1. 直接调用：与改造前的行为一致，超限即失败
+    server, limits = start_server(args.port, {settings.EMBEDDING_MODEL: args.rpm})
+
+    def direct(kind, text):
+        response = dashscope.TextEmbedding.call(model=settings.EMBEDDING_MODEL, input=text)
+        if response.status_code != 200:
+            raise OutboundError(response.code)
+
+    run("直接调用", direct)
+    print(f"   服务端: {limits.stats}")
+    server.shutdown()
+    server.server_close()
+
+    # 2. 经调度器调用
+    server, limits = start_server(args.port, {settings.EMBEDDING_MODEL: args.rpm})
+    retrieval = Retrieval()
+
+    def scheduled(kind, text):
+        retrieval.get_embedding(text, PRIORITY_BULK if kind == "bulk" else PRIORITY_INTERACTIVE)
+
+    run("调度器", scheduled)
+    print(f"   服务端: {limits.stats}")
+    print(json.dumps(scheduler.get_metrics(), ensure_ascii=False, indent=2))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
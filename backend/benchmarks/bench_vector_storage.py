@@ -0,0 +1,77 @@
+"""
+向量存储格式对比：磁盘/内存占用、recall@k 与检索延迟
+用法（在backend目录下）: python benchmarks/bench_vector_storage.py --n 20000 --dim 1024
+"""
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import faiss
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from src.config import settings
+from src.retrieval import Retrieval, build_vector_index, storage_dtype
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype("float32")
+
+
+def make_dataset(n: int, dim: int, num_queries: int, seed: int = 0):
+    """生成带聚类结构的归一化向量，查询为语料向量加扰动，近似真实embedding分布"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(n // 50, 1), dim))
+    vectors = normalize(centers[rng.integers(0, len(centers), n)] + 0.3 * rng.standard_normal((n, dim)))
+    queries = normalize(vectors[rng.integers(0, n, num_queries)] + 0.02 * rng.standard_normal((num_queries, dim)))
+    return vectors, queries
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    vectors, queries = make_dataset(args.n, args.dim, args.queries)
+    # 对比的是各格式的FAISS索引，关闭小规模语料的numpy精确检索
+    settings.EXACT_SEARCH_MAX_VECTORS = 0
+    exact = faiss.IndexFlatL2(args.dim)
+    exact.add(vectors)
+    _, truth = exact.search(queries, args.top_k)
+    chunks = [{"content": str(i), "page_num": 1, "chunk_id": f"1-{i}"} for i in range(args.n)]
+
+    print(f"n={args.n} dim={args.dim} queries={args.queries} top_k={args.top_k}")
+    print(f"{'格式':<10}{'重排':<6}{'vectors.npy(MB)':>16}{'index(MB)':>12}{'recall@k':>10}{'延迟(ms)':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for storage in ["float32", "float16", "sq8", "pq"]:
+            index = build_vector_index(vectors, storage)
+            index_file = Path(tmp_dir) / f"{storage}.faiss"
+            faiss.write_index(index, str(index_file))
+            vectors_file = Path(tmp_dir) / f"{storage}.npy"
+            np.save(vectors_file, vectors.astype(storage_dtype(storage)))
+
+            index = faiss.read_index(str(index_file), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+            stored = np.load(vectors_file, mmap_mode="r")
+            for rescore_factor in [0, 4]:
+                settings.RESCORE_FACTOR = rescore_factor
+                retrieval = Retrieval()
+                retrieval.load_index(chunks, stored, index)
+                hits = 0
+                t0 = time.time()
+                for q, expected in zip(queries, truth):
+                    retrieval.get_embedding = lambda text, q=q: q
+                    results = retrieval.vector_search("", args.top_k)
+                    found = {int(chunk["chunk_id"].split("-")[1]) for _, chunk in results}
+                    hits += len(found & set(expected.tolist()))
+                latency = (time.time() - t0) / args.queries * 1000
+                print(f"{storage:<10}{('x' + str(rescore_factor)) if rescore_factor else '-':<6}"
+                      f"{vectors_file.stat().st_size / 2 ** 20:>16.1f}{index_file.stat().st_size / 2 ** 20:>12.1f}"
+                      f"{hits / truth.size:>10.3f}{latency:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+本地DashScope模拟服务，按模型强制执行RPM与并发限制，超限返回429 Throttling
+用法: python benchmarks/mock_dashscope.py --port 8765 --rpm text-embedding-v4=60 --rpm qwen-plus=30
+然后设置环境变量 DASHSCOPE_HTTP_BASE_URL=http://127.0.0.1:8765/api/v1 启动后端
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockLimits:
+    """按模型的滑动窗口RPM与并发计数"""
+    def __init__(self, rpm: dict, concurrency: int, window: float = 60.0):
+        self.rpm = rpm
+        self.concurrency = concurrency
+        self.window = window
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.in_flight = {}
+        self.stats = {"accepted": 0, "throttled": 0}
+
+    def enter(self, model: str) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            calls = self.calls.setdefault(model, deque())
+            while calls and now - calls[0] > self.window:
+                calls.popleft()
+            limit = self.rpm.get(model)
+            if (limit is not None and len(calls) >= limit) or self.in_flight.get(model, 0) >= self.concurrency:
+                self.stats["throttled"] += 1
+                return False
+            calls.append(now)
+            self.in_flight[model] = self.in_flight.get(model, 0) + 1
+            self.stats["accepted"] += 1
+            return True
+
+    def leave(self, model: str):
+        with self.lock:
+            self.in_flight[model] -= 1
+
+
+def make_handler(limits: MockLimits, latency: float, dimension: int):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status: int, body: dict):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            model = payload.get("model", "")
+            if not limits.enter(model):
+                self._send(429, {"code": "Throttling.RateQuota", "message": "Requests rate limit exceeded", "request_id": "mock"})
+                return
+            try:
+                time.sleep(latency)
+                if self.path.endswith("/text-embedding"):
+                    texts = payload.get("input", {}).get("texts", [])
+                    embeddings = [
+                        {"text_index": i, "embedding": [random.random() for _ in range(dimension)]}
+                        for i in range(len(texts))
+                    ]
+                    tokens = sum(len(t) for t in texts)
+                    body = {"output": {"embeddings": embeddings}, "usage": {"total_tokens": tokens}, "request_id": "mock"}
+                else:
+                    messages = payload.get("input", {}).get("messages", [])
+                    tokens = sum(len(m.get("content", "")) for m in messages)
+                    body = {
+                        "output": {"text": "1. 分步推理：模拟\n2. 推理摘要：模拟\n3. 相关页面：1\n4. 最终答案：模拟", "finish_reason": "stop"},
+                        "usage": {"input_tokens": tokens, "output_tokens": 20, "total_tokens": tokens + 20},
+                        "request_id": "mock"
+                    }
+            finally:
+                # 先释放并发名额再返回响应，避免客户端收到响应后立即发起的请求被误判超限
+                limits.leave(model)
+            self._send(200, body)
+
+    return Handler
+
+
+def start_server(port: int, rpm: dict, concurrency: int = 4, latency: float = 0.05, dimension: int = 1024):
+    """在后台线程中启动模拟服务，返回 (server, limits)"""
+    limits = MockLimits(rpm, concurrency)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(limits, latency, dimension))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, limits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rpm", action="append", default=[], help="模型=每分钟请求数，可重复")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+    rpm = {item.split("=")[0]: int(item.split("=")[1]) for item in args.rpm}
+    server, _ = start_server(args.port, rpm, args.concurrency, args.latency)
+    print(f"Mock DashScope 运行于 http://127.0.0.1:{args.port}/api/v1 限额: {rpm}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import copy
+import threading
+import numpy as np
+import faiss
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Any
+from src.config import settings
+
+
+class SemanticAnswerCache:
+    """
+    语义答案缓存：对历史问题的向量建立小型FAISS内积索引（向量已归一化，即余弦相似度）
+    相似度超过阈值的问题直接复用已生成的结构化答案
+    - 按检索范围（单文件/全局/过滤条件）分别建索引，不同范围的答案互不复用
+    - 所有范围共享一个LRU队列，超过容量时淘汰最久未命中的答案
+    - 每个范围记录其覆盖的文档版本，版本变化（范围内的文档重新向量化或被删除）时只清空该范围
+    """
+    def __init__(self, max_entries: int = None, threshold: float = None):
+        self.max_entries = max_entries or settings.ANSWER_CACHE_MAX_ENTRIES
+        self.threshold = threshold if threshold is not None else settings.ANSWER_CACHE_THRESHOLD
+        self._lock = threading.Lock()
+        self._versions: Dict[str, str] = {}
+        self._scopes: Dict[str, faiss.IndexIDMap2] = {}
+        self._entries: "OrderedDict[int, Tuple[str, Dict[str, Any]]]" = OrderedDict()
+        self._next_id = 0
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        vector = np.array([vector], dtype="float32")
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _check_version(self, scope: str, version: str):
+        """范围内的文档版本变化后清空该范围的缓存"""
+        if self._versions.get(scope) != version:
+            self._drop_scope(scope)
+            self._versions[scope] = version
+
+    def _drop_scope(self, scope: str):
+        """删除一个范围的索引及其全部缓存条目"""
+        self._scopes.pop(scope, None)
+        for entry_id in [entry_id for entry_id, (entry_scope, _) in self._entries.items() if entry_scope == scope]:
+            del self._entries[entry_id]
+
+    def lookup(self, scope: str, version: str, query_vector: List[float]) -> Optional[Tuple[Dict[str, Any], float]]:
+        """查找相似问题的答案，命中时返回 (答案副本, 相似度)"""
+        with self._lock:
+            self._check_version(scope, version)
+            index = self._scopes.get(scope)
+            if index is None or index.ntotal == 0:
+                return None
+            query = self._normalize(query_vector)
+            if query.shape[1] != index.d:
+                return None
+            similarities, ids = index.search(query, 1)
+            similarity, entry_id = float(similarities[0][0]), int(ids[0][0])
+            if entry_id < 0 or similarity < self.threshold:
+                return None
+            self._entries.move_to_end(entry_id)
+            return copy.deepcopy(self._entries[entry_id][1]), similarity
+
+    def store(self, scope: str, version: str, query_vector: List[float], answer: Dict[str, Any]):
+        """缓存答案，超出容量时按LRU淘汰"""
+        with self._lock:
+            self._check_version(scope, version)
+            query = self._normalize(query_vector)
+            index = self._scopes.get(scope)
+            if index is None or index.d != query.shape[1]:
+                # 向量维度变化后旧条目无法再命中，随旧索引一并删除，不再占用容量
+                self._drop_scope(scope)
+                index = faiss.IndexIDMap2(faiss.IndexFlatIP(query.shape[1]))
+                self._scopes[scope] = index
+            entry_id = self._next_id
+            self._next_id += 1
+            index.add_with_ids(query, np.array([entry_id], dtype="int64"))
+            self._entries[entry_id] = (scope, copy.deepcopy(answer))
+
+            while len(self._entries) > self.max_entries:
+                evicted_id, (evicted_scope, _) = self._entries.popitem(last=False)
+                self._scopes[evicted_scope].remove_ids(np.array([evicted_id], dtype="int64"))
+
+    def invalidate(self):
+        """立即清空全部缓存"""
+        with self._lock:
+            self._scopes.clear()
+            self._entries.clear()
+            self._versions.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "scopes": len(self._scopes)}
+
+
+# 进程内单例
+answer_cache = SemanticAnswerCache()
@@ -0,0 +1,222 @@
+import json
+import numpy as np
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Any
+
+# BM25倒排文件
+BM25_TERMS_FILE = "bm25_terms.bin"
+BM25_TERM_OFFSETS_FILE = "bm25_term_offsets.npy"
+BM25_STATS_FILE = "bm25_stats.json"
+BM25_OFFSETS_FILE = "bm25_offsets.npy"
+BM25_DOC_IDS_FILE = "bm25_doc_ids.npy"
+BM25_TFS_FILE = "bm25_tfs.npy"
+BM25_DOC_LENGTHS_FILE = "bm25_doc_lengths.npy"
+
+# 与rank_bm25.BM25Okapi的默认参数一致，倒排表打分与BM25Okapi的得分相同
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+
+
+def bm25_idf(corpus_size: int, df: int, average_idf: float) -> float:
+    """按rank_bm25的方式计算idf，负值以 epsilon * 平均idf 代替"""
+    idf = np.log(corpus_size - df + 0.5) - np.log(df + 0.5)
+    return float(idf) if idf >= 0 else BM25_EPSILON * average_idf
+
+
+def _load_array(path: Path) -> np.ndarray:
+    """只读mmap加载npy，空数组无法mmap时直接读入"""
+    array_ = np.load(path, mmap_mode="r")
+    return array_ if array_.size else np.load(path)
+
+
+class PostingsWriter:
+    """
+    逐个chunk累积BM25倒排，finish在内存中生成倒排，close写入段目录：
+    词表按UTF-8字节序排序后拼接存储（bm25_terms.bin + 词偏移），词id即排序位置，查询时二分查找；
+    倒排表按词id顺序存储，文档频率由倒排表偏移得到，idf在查询时计算
+    """
+    def __init__(self):
+        self._terms: Dict[str, int] = {}
+        self._posting_terms = array("i")
+        self._posting_docs = array("i")
+        self._posting_tfs = array("i")
+        self._doc_lengths = array("i")
+
+    def add(self, content: str):
+        doc_id = len(self._doc_lengths)
+        # 与BM25Okapi相同，按空白切词
+        tokens = content.split()
+        self._doc_lengths.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            self._posting_terms.append(self._terms.setdefault(term, len(self._terms)))
+            self._posting_docs.append(doc_id)
+            self._posting_tfs.append(tf)
+
+    def finish(self) -> Dict[str, Any]:
+        """生成有序词表、倒排表和统计信息"""
+        terms = sorted(self._terms)
+        rank = np.empty(len(terms), dtype="int32")
+        rank[np.array([self._terms[term] for term in terms], dtype="int64")] = np.arange(len(terms), dtype="int32")
+        encoded = [term.encode("utf-8") for term in terms]
+        term_offsets = np.zeros(len(terms) + 1, dtype="int64")
+        np.cumsum([len(term) for term in encoded], out=term_offsets[1:])
+
+        term_ids = rank[np.frombuffer(self._posting_terms, dtype="int32")]
+        order = np.argsort(term_ids, kind="stable")
+        counts = np.bincount(term_ids, minlength=len(terms))
+        offsets = np.zeros(len(terms) + 1, dtype="int64")
+        np.cumsum(counts, out=offsets[1:])
+        doc_lengths = np.frombuffer(self._doc_lengths, dtype="int32")
+
+        # BM25Okapi以整个词表的平均idf作为负idf的下限，这里预先算好
+        corpus_size = len(doc_lengths)
+        idf = np.log(corpus_size - counts + 0.5) - np.log(counts + 0.5)
+        return {
+            "terms": np.frombuffer(b"".join(encoded), dtype="uint8"),
+            "term_offsets": term_offsets,
+            "offsets": offsets,
+            "doc_ids": np.frombuffer(self._posting_docs, dtype="int32")[order],
+            "tfs": np.frombuffer(self._posting_tfs, dtype="int32")[order].astype("uint16"),
+            "doc_lengths": doc_lengths,
+            "stats": {
+                "corpus_size": corpus_size,
+                "avgdl": float(doc_lengths.mean()) if corpus_size else 0.0,
+                "average_idf": float(idf.mean()) if len(idf) else 0.0
+            }
+        }
+
+    def close(self, target_dir: Path):
+        """将倒排写入段目录"""
+        index = self.finish()
+        index["terms"].tofile(target_dir / BM25_TERMS_FILE)
+        np.save(target_dir / BM25_TERM_OFFSETS_FILE, index["term_offsets"])
+        np.save(target_dir / BM25_OFFSETS_FILE, index["offsets"])
+        np.save(target_dir / BM25_DOC_IDS_FILE, index["doc_ids"])
+        np.save(target_dir / BM25_TFS_FILE, index["tfs"])
+        np.save(target_dir / BM25_DOC_LENGTHS_FILE, index["doc_lengths"])
+        with open(target_dir / BM25_STATS_FILE, "w", encoding="utf-8") as f:
+            json.dump(index["stats"], f)
+
+
+class SortedTerms:
+    """有序词表（可为mmap），二分查找词id，常驻内存与词表大小无关"""
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def _term(self, idx: int) -> bytes:
+        return self.data[int(self.offsets[idx]):int(self.offsets[idx + 1])].tobytes()
+
+    def find(self, term: str) -> Optional[int]:
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(self) and self._term(lo) == key else None
+
+
+class PostingsBM25:
+    """
+    基于倒排表的BM25打分，只读取查询词的倒排表，得分与rank_bm25.BM25Okapi一致
+    从段目录加载时词表、倒排表和文档长度均为只读mmap，多个worker共享页缓存
+    """
+    def __init__(self, index: Dict[str, Any], cache: Any = None):
+        self.terms = SortedTerms(index["terms"], index["term_offsets"])
+        self.offsets = index["offsets"]
+        self.doc_ids = index["doc_ids"]
+        self.tfs = index["tfs"]
+        self.doc_lengths = index["doc_lengths"]
+        self.corpus_size = index["stats"]["corpus_size"]
+        self.avgdl = index["stats"]["avgdl"]
+        self.average_idf = index["stats"]["average_idf"]
+        # 可选的按字节限制的缓存（ByteLRUCache），缓存热点词的倒排表；多个段共用时以段目录区分
+        self.cache = cache
+        self.cache_key = index.get("cache_key")
+
+    @classmethod
+    def build(cls, texts: List[str]) -> "PostingsBM25":
+        """在内存中构建（旧数据没有磁盘倒排时使用）"""
+        writer = PostingsWriter()
+        for text in texts:
+            writer.add(text)
+        return cls(writer.finish())
+
+    @classmethod
+    def load(cls, segment_dir: Path, cache: Any = None) -> "PostingsBM25":
+        terms_file = segment_dir / BM25_TERMS_FILE
+        with open(segment_dir / BM25_STATS_FILE, "r", encoding="utf-8") as f:
+            stats = json.load(f)
+        return cls({
+            "terms": np.memmap(terms_file, dtype="uint8", mode="r") if terms_file.stat().st_size else np.zeros(0, dtype="uint8"),
+            "term_offsets": _load_array(segment_dir / BM25_TERM_OFFSETS_FILE),
+            "offsets": _load_array(segment_dir / BM25_OFFSETS_FILE),
+            "doc_ids": _load_array(segment_dir / BM25_DOC_IDS_FILE),
+            "tfs": _load_array(segment_dir / BM25_TFS_FILE),
+            "doc_lengths": _load_array(segment_dir / BM25_DOC_LENGTHS_FILE),
+            "stats": stats,
+            "cache_key": str(segment_dir)
+        }, cache)
+
+    def idf(self, term_id: int) -> float:
+        df = int(self.offsets[term_id + 1] - self.offsets[term_id])
+        return bm25_idf(self.corpus_size, df, self.average_idf)
+
+    def document_frequency(self, term: str, live: Optional[np.ndarray] = None) -> int:
+        """词的文档频率，live为存活掩码时只统计存活的chunk"""
+        term_id = self.terms.find(term)
+        if term_id is None:
+            return 0
+        if live is None:
+            return int(self.offsets[term_id + 1] - self.offsets[term_id])
+        return int(np.count_nonzero(live[self.postings(term_id)[0]]))
+
+    def postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """读取一个词的倒排表 (chunk下标, 词频)"""
+        def load():
+            start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+            doc_ids = np.array(self.doc_ids[start:end])
+            tfs = np.array(self.tfs[start:end], dtype="float32")
+            return (doc_ids, tfs), doc_ids.nbytes + tfs.nbytes
+        if self.cache is None:
+            return load()[0]
+        return self.cache.get((self.cache_key, "bm25", term_id), load)
+
+    def score(self, tokens: List[str], idf: Optional[Dict[str, float]] = None, avgdl: Optional[float] = None,
+              mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        返回包含任一查询词的 (chunk下标, BM25得分)；与BM25Okapi相同，重复出现的查询词重复计分
+        :param idf: 各查询词的idf，跨段检索时传入按全部段统计的值，为空时使用本段的统计
+        :param avgdl: 平均文档长度，含义同上
+        :param mask: 过滤掩码，倒排表先按掩码裁剪，只为命中的chunk读取文档长度并计分；idf仍按全部chunk统计
+        """
+        avgdl = avgdl or self.avgdl
+        doc_parts, score_parts = [], []
+        for term in tokens:
+            term_id = self.terms.find(term)
+            if term_id is None:
+                continue
+            doc_ids, tfs = self.postings(term_id)
+            if mask is not None:
+                keep = mask[doc_ids]
+                doc_ids, tfs = doc_ids[keep], tfs[keep]
+                if len(doc_ids) == 0:
+                    continue
+            doc_lengths = self.doc_lengths[doc_ids]
+            denominator = tfs + BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / avgdl)
+            doc_parts.append(doc_ids)
+            term_idf = idf[term] if idf is not None else self.idf(term_id)
+            score_parts.append(term_idf * tfs * (BM25_K1 + 1) / denominator)
+        if not doc_parts:
+            return np.zeros(0, dtype="int32"), np.zeros(0, dtype="float64")
+        doc_ids, inverse = np.unique(np.concatenate(doc_parts), return_inverse=True)
+        return doc_ids, np.bincount(inverse, weights=np.concatenate(score_parts))
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import fcntl
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Any
+from src.config import settings
+from src.ingestion import STAGING_DIR
+from src.index_store import current_segment
+
+# 文档状态
+STATUS_UPLOADED = "uploaded"
+STATUS_VECTORIZING = "vectorizing"
+STATUS_VECTORIZED = "vectorized"
+STATUS_FAILED = "failed"
+
+# 目录扫描互斥锁，多个worker同一时刻只有一个在对账
+RECONCILE_LOCK_FILE = ".catalog.lock"
+
+COLUMNS = ["filename", "size", "mtime", "sha256", "page_count", "chunk_count",
+           "embedding_dimension", "status", "version", "updated_at"]
+
+
+def file_sha256(file_path: Path) -> str:
+    """流式计算文件哈希，避免大文件一次性读入内存"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class DocumentCatalog:
+    """
+    基于SQLite的文档目录，文件列表和状态查询直接读表，不再逐个stat上传目录和向量目录
+    上传、向量化、删除时同步更新；后台对账线程定期扫描目录，补上绕过接口的文件变更
+    """
+    def __init__(self, db_path: Path, uploads_dir: Path, vector_store_dir: Path):
+        self.db_path = str(db_path)
+        self.uploads_dir = uploads_dir
+        self.vector_store_dir = vector_store_dir
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "filename TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, sha256 TEXT, "
+            "page_count INTEGER, chunk_count INTEGER, embedding_dimension INTEGER, "
+            "status TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL)"
+        )
+        self._execute("CREATE INDEX IF NOT EXISTS documents_mtime ON documents (mtime DESC)")
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _to_dict(row: tuple) -> Dict[str, Any]:
+        return dict(zip(COLUMNS, row))
+
+    # --------------------------
+    # 接口调用时的同步更新
+    # --------------------------
+    def record_upload(self, filename: str, size: int, mtime: float, sha256: str):
+        """上传（或覆盖上传）文件，内容变化时重置向量化状态"""
+        self._execute(
+            "INSERT INTO documents (filename, size, mtime, sha256, status, version, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, 0, ?) "
+            "ON CONFLICT(filename) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, sha256 = excluded.sha256, "
+            "status = CASE WHEN documents.sha256 IS excluded.sha256 THEN documents.status ELSE excluded.status END, "
+            "updated_at = excluded.updated_at",
+            (filename, size, mtime, sha256, STATUS_UPLOADED, time.time())
+        )
+
+    def set_status(self, filename: str, status: str):
+        self._execute(
+            "UPDATE documents SET status = ?, updated_at = ? WHERE filename = ?",
+            (status, time.time(), filename)
+        )
+
+    def record_vectorized(self, filename: str, page_count: int, chunk_count: int, embedding_dimension: Optional[int]):
+        """向量化完成，版本号递增"""
+        self._execute(
+            "UPDATE documents SET status = ?, page_count = ?, chunk_count = ?, embedding_dimension = ?, "
+            "version = version + 1, updated_at = ? WHERE filename = ?",
+            (STATUS_VECTORIZED, page_count, chunk_count, embedding_dimension, time.time(), filename)
+        )
+
+    def remove(self, filename: str):
+        self._execute("DELETE FROM documents WHERE filename = ?", (filename,))
+
+    # --------------------------
+    # 查询
+    # --------------------------
+    def get(self, filename: str) -> Optional[Dict[str, Any]]:
+        rows = self._execute(f"SELECT {', '.join(COLUMNS)} FROM documents WHERE filename = ?", (filename,))
+        return self._to_dict(rows[0]) if rows else None
+
+    def list(self, page: int = 1, page_size: int = 0) -> Tuple[List[Dict[str, Any]], int]:
+        """按修改时间倒序分页列出文档，page_size为0时返回全部；返回 (当前页, 总数)"""
+        total = self._execute("SELECT COUNT(*) FROM documents")[0][0]
+        sql = f"SELECT {', '.join(COLUMNS)} FROM documents ORDER BY mtime DESC, filename"
+        params: tuple = ()
+        if page_size > 0:
+            sql += " LIMIT ? OFFSET ?"
+            params = (page_size, (max(page, 1) - 1) * page_size)
+        return [self._to_dict(row) for row in self._execute(sql, params)], total
+
+    # --------------------------
+    # 对账
+    # --------------------------
+    def _read_metadata(self, filename: str) -> Dict[str, Any]:
+        metadata_file = self.vector_store_dir / os.path.splitext(filename)[0] / "metadata.json"
+        if not metadata_file.exists():
+            return {}
+        with open(metadata_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    @staticmethod
+    def _matches_source(metadata: Dict[str, Any], row: Dict[str, Any]) -> bool:
+        """向量化时记录的源文件哈希与当前文件一致；旧元信息没有哈希时比较文件修改时间"""
+        if "sha256" in metadata:
+            return metadata["sha256"] == row["sha256"]
+        return metadata.get("uploaded_at") == row["mtime"]
+
+    def reconcile(self) -> Dict[str, int]:
+        """
+        扫描上传目录，与目录表对账：补录新文件、更新被替换的文件、删除已不存在的文件，
+        并按向量目录修正向量化状态；其他worker正在对账时直接跳过
+        """
+        self.vector_store_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.vector_store_dir / RECONCILE_LOCK_FILE, "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return {}
+            return self._reconcile()
+
+    def _reconcile(self) -> Dict[str, int]:
+        stats = {"added": 0, "updated": 0, "removed": 0}
+        known = {row["filename"]: row for row in self.list()[0]}
+        seen = set()
+        with os.scandir(self.uploads_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith(".pdf"):
+                    continue
+                seen.add(entry.name)
+                stat = entry.stat()
+                row = known.get(entry.name)
+                if row is None or row["size"] != stat.st_size or row["mtime"] != stat.st_mtime:
+                    # 新文件或文件被替换，重新计算哈希
+                    self.record_upload(entry.name, stat.st_size, stat.st_mtime, file_sha256(Path(entry.path)))
+                    stats["added" if row is None else "updated"] += 1
+                    row = self.get(entry.name)
+
+                file_vector_dir = self.vector_store_dir / os.path.splitext(entry.name)[0]
+                if row["status"] == STATUS_VECTORIZING and (file_vector_dir / STAGING_DIR).exists():
+                    # 正在入库（或中断后待续跑），状态由向量化接口维护
+                    continue
+                # 只有状态与向量目录不一致时才读取元信息
+                vectorized = current_segment(file_vector_dir) is not None and (file_vector_dir / "metadata.json").exists()
+                if vectorized and row["status"] != STATUS_VECTORIZED:
+                    metadata = self._read_metadata(entry.name)
+                    # 向量来自被覆盖前的旧文件时保持未向量化状态
+                    if self._matches_source(metadata, row):
+                        self.record_vectorized(entry.name, metadata.get("page_count"), metadata.get("chunk_count"),
+                                               metadata.get("embedding_dimension"))
+                        stats["updated"] += 1
+                elif not vectorized and row["status"] == STATUS_VECTORIZED:
+                    self.set_status(entry.name, STATUS_UPLOADED)
+                    stats["updated"] += 1
+
+        for filename in known.keys() - seen:
+            self.remove(filename)
+            stats["removed"] += 1
+        if any(stats.values()):
+            print(f"[Catalog] 对账完成: {stats}")
+        return stats
+
+    def start_reconciler(self, interval: float = None):
+        """启动后台对账线程（轮询），启动时立即对账一次"""
+        interval = interval or settings.CATALOG_RECONCILE_INTERVAL
+        if self._thread is not None or interval <= 0:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.reconcile()
+                except Exception as e:
+                    print(f"[Catalog] 对账失败: {e}")
+                if self._stop.wait(interval):
+                    return
+
+        self._thread = threading.Thread(target=loop, name="catalog-reconciler", daemon=True)
+        self._thread.start()
+
+    def stop_reconciler(self):
+        self._stop.set()
@@ -1,5 +1,5 @@
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Optional, Dict
 from pathlib import Path
 import os
 
@@ -30,17 +30,94 @@ class Settings(BaseSettings):
     # 检索配置
     TOP_K: int = 10
     RERANK_TOP_K: int = 5
+    RERANK_ENABLED: bool = False  # 是否对检索结果做LLM重排序
+    RERANK_WINDOW_SIZE: int = 3  # 每个重排序窗口（一次LLM请求）包含的候选数（默认10个候选分为4个窗口）
+    RERANK_CONCURRENCY: int = 4  # 并发请求的窗口数
+    RERANK_STABLE_WINDOWS: int = 1  # top_k全部已打分后，又有这么多个完成的窗口没有改变top_k时提前结束
+    RERANK_DEADLINE: float = 8.0  # 重排序截止时间（秒），超时返回当前最佳排序
+    RERANK_SNIPPET_CHARS: int = 400  # 每个候选送入LLM的最大字符数
+    FILTER_BRUTE_FORCE_RATIO: float = 0.1  # 过滤后命中比例低于该值时直接在子集上精确计算
+    HYBRID_VECTOR_WEIGHT: float = 0.7  # 混合检索融合得分中向量得分的权重，其余为归一化后的BM25得分
+    
+    # 语义答案缓存配置
+    ANSWER_CACHE_ENABLED: bool = True
+    ANSWER_CACHE_THRESHOLD: float = 0.95  # 问题向量余弦相似度达到该值时复用缓存答案
+    ANSWER_CACHE_MAX_ENTRIES: int = 1000  # 所有检索范围合计的缓存条数上限（LRU淘汰）
     
     # 文本分块配置
     CHUNK_SIZE: int = 500
     CHUNK_OVERLAP: int = 50
+    CHUNKING_STRATEGY: str = "structure"  # 可选值: structure（基于Docling文档结构）, token
+    CHUNK_MIN_TOKENS: int = 100  # 结构化分块时，章节内容不足该值则与下一章节合并
     
     # 模型配置
     LLM_MODEL: str = "qwen-plus"
+    EMBEDDING_MODEL: str = "text-embedding-v4"
+    EMBEDDING_BATCH_SIZE: int = 10  # 单次Embedding请求的文本数（text-embedding-v4上限为10）
+    EMBEDDING_DIMENSION: int = 1024  # 向量维度，text-embedding-v4支持 2048/1536/1024/768/512/256/128/64
+    EMBEDDING_REQUEST_DIMENSION: bool = True  # True时由服务端直接输出该维度；False时在本地截断前N维并重新归一化
+    
+    # 模型调用调度配置（限流、优先级、重试）
+    # 每个模型的限额：rpm 每分钟请求数、tpm 每分钟token数、concurrency 最大并发，未配置的模型使用默认值
+    MODEL_RATE_LIMITS: Dict[str, Dict[str, int]] = {
+        "text-embedding-v4": {"rpm": 1800, "tpm": 1200000, "concurrency": 8},
+        "qwen-plus": {"rpm": 600, "tpm": 1000000, "concurrency": 8},
+    }
+    OUTBOUND_DEFAULT_RPM: int = 300
+    OUTBOUND_DEFAULT_TPM: int = 300000
+    OUTBOUND_MAX_CONCURRENCY: int = 4
+    OUTBOUND_BURST_SECONDS: float = 3.0  # 令牌桶允许的突发量（按秒计的限额）
+    OUTBOUND_QUEUE_SIZE: int = 256  # 每个模型的等待队列上限
+    OUTBOUND_QUEUE_TIMEOUT: float = 30.0  # 队列满时调用方最多阻塞的秒数
+    OUTBOUND_MAX_RETRIES: int = 5
+    OUTBOUND_BACKOFF_BASE: float = 0.5  # 重试退避基数（秒）
+    OUTBOUND_BACKOFF_MAX: float = 20.0  # 单次退避上限（秒）
     
     # PDF解析配置
     PDF_PARSER: str = "docling"  # 可选值: pymupdf, docling
     
+    # 部署配置
+    WORKERS: int = 1  # uvicorn worker进程数
+    APP_ROLE: str = "all"  # 可选值: all, query（仅问答）, ingest（仅上传/向量化/删除）
+    PRELOAD_INDEXES: bool = False  # 启动时预加载索引后再接收请求
+    INDEX_MMAP: bool = True  # 以mmap方式只读加载向量和FAISS索引，多worker共享内存
+    CATALOG_RECONCILE_INTERVAL: float = 30.0  # 文档目录与上传目录对账的轮询间隔（秒），0表示关闭
+    
+    # 流水线入库配置
+    INGEST_PAGE_BATCH: int = 10  # 每批解析的页数
+    INGEST_QUEUE_SIZE: int = 4  # 各阶段之间队列的最大批次数
+    INGEST_EMBED_CONCURRENCY: int = 4  # 并发发送的Embedding请求数
+    INGEST_FLUSH_PAGES: int = 20  # 每处理多少页就写出一次可检索的索引
+    
+    # 向量存储配置
+    VECTOR_STORAGE: str = "float32"  # 可选值: float32, float16, sq8, pq
+    PQ_M: int = 64  # PQ子空间数量，需整除向量维度
+    PQ_NBITS: int = 8  # 每个PQ子空间的编码位数
+    RESCORE_FACTOR: int = 0  # 大于1时召回 top_k*该倍数 个候选并用原始向量精确重排，0表示关闭
+    SEARCH_DIMENSION: int = 0  # 两阶段检索：大于0时用向量前N维构建索引召回候选，再用完整向量重排；0表示关闭
+    VECTOR_METRIC: str = "cosine"  # 可选值: cosine（向量L2归一化后用内积检索）, l2
+    EXACT_SEARCH_MAX_VECTORS: int = 20000  # float32存储且向量数不超过该值时用numpy矩阵乘法精确检索，跳过FAISS索引；0表示关闭
+    
+    # 多向量检索配置
+    MULTI_VECTOR: bool = False  # 开启后为分块的句子级子片段单独生成向量，检索时按父分块取最大相似度
+    SUBSPAN_MIN_CHARS: int = 50  # 子片段的最少字符数，过短的句子与后续句子合并
+    SUBSPAN_CANDIDATE_FACTOR: int = 4  # 子片段检索召回 top_k*该倍数 个候选，再聚合到父分块
+    
+    # 磁盘索引配置
+    GLOBAL_INDEX_MODE: str = "memory"  # 全局索引模式: memory（全量载入内存）, ondisk（IVF倒排表与BM25倒排表留在磁盘，按需读取）
+    IVF_NLIST: int = 0  # IVF倒排表数量，0表示按向量数自动选择（约4*sqrt(n)）
+    IVF_NPROBE: int = 16  # 每次查询扫描的倒排表数量，越大召回率越高、读取越多
+    IVF_TRAIN_SAMPLE: int = 50000  # 训练聚类中心时采样的向量数
+    ONDISK_CACHE_MB: int = 256  # 磁盘模式下热点倒排表的内存缓存上限（MB）
+    ONDISK_CHUNK_CACHE: int = 1024  # 磁盘模式下缓存在内存中的chunk数量
+    
+    # 段与快照配置
+    COMPACT_INTERVAL: float = 60.0  # 后台合并小段的轮询间隔（秒），0表示关闭
+    COMPACT_MIN_SEGMENTS: int = 8  # 待合并的小段达到该数量时合并为一个全局段
+    COMPACT_SEGMENT_CHUNKS: int = 100000  # 存活chunk数低于该值的全局段视为小段，参与合并
+    COMPACT_DEAD_RATIO: float = 0.3  # 全局段中已被替换或删除的chunk比例超过该值时重写
+    SNAPSHOT_RETENTION: float = 300.0  # 旧快照及其引用的段保留的时间（秒），供仍在读取旧快照的worker使用
+    
     class Config:
         extra = "ignore"  # 忽略未定义的额外字段
 
@@ -0,0 +1,305 @@
+import os
+import json
+import math
+import threading
+import numpy as np
+import faiss
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Any, Callable
+from src.config import settings
+from src.retrieval import Retrieval, SearchFilter, calibrate_scores, metric_type, normalize_vectors, storage_dtype
+from src.bm25_index import PostingsWriter, PostingsBM25
+
+# 磁盘段文件
+CHUNKS_FILE = "chunks.jsonl"
+CHUNK_OFFSETS_FILE = "chunk_offsets.npy"
+CHUNK_FILES_FILE = "chunk_files.npy"
+CHUNK_PAGES_FILE = "chunk_pages.npy"
+CHUNK_UPLOADED_AT_FILE = "chunk_uploaded_at.npy"
+FILENAMES_FILE = "filenames.json"
+IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+IVF_OFFSETS_FILE = "ivf_offsets.npy"
+IVF_IDS_FILE = "ivf_ids.npy"
+IVF_VECTORS_FILE = "ivf_vectors.npy"
+
+# 段格式版本，格式变化后旧格式的全局段由后台合并重写
+DISK_FORMAT = 3
+
+
+class ByteLRUCache:
+    """按字节数限制容量的LRU缓存，缓存热点倒排表，内存占用不随语料规模增长"""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Any, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any, loader: Callable[[], Tuple[Any, int]]) -> Any:
+        """命中时返回缓存值，否则调用loader读取 (值, 字节数) 并按LRU淘汰"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        value, size = loader()
+        with self._lock:
+            if key not in self._entries and size <= self.max_bytes:
+                self._entries[key] = (value, size)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, (_, evicted_size) = self._entries.popitem(last=False)
+                    self._bytes -= evicted_size
+        return value
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses}
+
+
+class DiskSegmentWriter:
+    """
+    流式写出段的文本索引（chunks、列式元数据与BM25倒排）：逐个文档追加，不需要在内存中保留全部chunks
+    chunks以JSONL存储并记录字节偏移，过滤用的列式元数据与BM25倒排表以npy存储，加载时均可只读mmap
+    """
+    def __init__(self, target_dir: Path):
+        self.target_dir = target_dir
+        self._chunks_file = open(target_dir / CHUNKS_FILE, "wb")
+        self._offsets = array("q", [0])
+        self._filename_codes: Dict[str, int] = {}
+        self._files = array("i")
+        self._pages = array("i")
+        self._uploaded_at = array("d")
+        self._postings = PostingsWriter()
+
+    def add(self, chunks: List[Dict[str, any]]):
+        for chunk in chunks:
+            data = (json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8")
+            self._chunks_file.write(data)
+            self._offsets.append(self._offsets[-1] + len(data))
+            self._files.append(self._filename_codes.setdefault(chunk.get("filename", ""), len(self._filename_codes)))
+            self._pages.append(chunk.get("page_num", 0))
+            self._uploaded_at.append(chunk.get("uploaded_at", np.nan))
+
+            self._postings.add(chunk["content"])
+
+    def close(self) -> int:
+        """写出偏移、列式元数据和BM25倒排，返回chunk数量"""
+        self._chunks_file.close()
+        np.save(self.target_dir / CHUNK_OFFSETS_FILE, np.frombuffer(self._offsets, dtype="int64"))
+        np.save(self.target_dir / CHUNK_FILES_FILE, np.frombuffer(self._files, dtype="int32"))
+        np.save(self.target_dir / CHUNK_PAGES_FILE, np.frombuffer(self._pages, dtype="int32"))
+        np.save(self.target_dir / CHUNK_UPLOADED_AT_FILE, np.frombuffer(self._uploaded_at, dtype="float64"))
+        with open(self.target_dir / FILENAMES_FILE, "w", encoding="utf-8") as f:
+            json.dump(sorted(self._filename_codes, key=self._filename_codes.get), f, ensure_ascii=False)
+
+        self._postings.close(self.target_dir)
+        return len(self._offsets) - 1
+
+
+def write_ivf(target_dir: Path, vectors: np.ndarray):
+    """
+    训练聚类中心并将向量按倒排表顺序写到磁盘
+    ivf_offsets[i]:ivf_offsets[i+1] 为第i个倒排表在 ivf_ids / ivf_vectors 中的行范围
+    """
+    n, dimension = vectors.shape
+    nlist = settings.IVF_NLIST or max(1, min(int(4 * math.sqrt(n)), n // 39 or 1))
+    cosine = settings.VECTOR_METRIC == "cosine"
+
+    # 在采样上训练聚类中心
+    rng = np.random.default_rng(0)
+    sample_ids = np.sort(rng.choice(n, min(n, settings.IVF_TRAIN_SAMPLE), replace=False))
+    sample = np.asarray(vectors[sample_ids], dtype="float32")
+    if nlist == 1:
+        # 小文档只有一个倒排表，聚类中心取均值即可，无需训练
+        centroids = sample.mean(axis=0, keepdims=True)
+        centroids = normalize_vectors(centroids) if cosine else centroids
+    else:
+        kmeans = faiss.Kmeans(dimension, nlist, niter=20, seed=1, spherical=cosine)
+        kmeans.train(sample)
+        centroids = kmeans.centroids
+    quantizer = faiss.IndexFlat(dimension, metric_type())
+    quantizer.add(centroids)
+
+    # 分块分配倒排表，避免一次性加载全部向量
+    assignments = np.empty(n, dtype="int64")
+    for start in range(0, n, 65536):
+        block = np.asarray(vectors[start:start + 65536], dtype="float32")
+        _, assigned = quantizer.search(block, 1)
+        assignments[start:start + len(block)] = assigned[:, 0]
+    order = np.argsort(assignments, kind="stable")
+    offsets = np.zeros(nlist + 1, dtype="int64")
+    np.cumsum(np.bincount(assignments, minlength=nlist), out=offsets[1:])
+
+    np.save(target_dir / IVF_CENTROIDS_FILE, centroids)
+    np.save(target_dir / IVF_OFFSETS_FILE, offsets)
+    np.save(target_dir / IVF_IDS_FILE, order.astype("int32"))
+    ordered = np.lib.format.open_memmap(
+        target_dir / IVF_VECTORS_FILE, mode="w+", dtype=storage_dtype(), shape=(n, dimension)
+    )
+    for start in range(0, n, 65536):
+        ordered[start:start + 65536] = vectors[order[start:start + 65536]]
+    ordered.flush()
+    del ordered
+    print(f"[DiskIndex] 已写出IVF磁盘索引: {n} 个向量, {nlist} 个倒排表")
+
+
+class DiskChunks:
+    """按需从JSONL读取chunk的只读序列，常用chunk缓存在内存中"""
+    def __init__(self, segment_dir: Path):
+        self.offsets = np.load(segment_dir / CHUNK_OFFSETS_FILE, mmap_mode="r")
+        self._path = segment_dir / CHUNKS_FILE
+        self._fd = os.open(self._path, os.O_RDONLY)
+        self._cache: "OrderedDict[int, Dict[str, any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> Dict[str, any]:
+        idx = int(idx)
+        with self._lock:
+            chunk = self._cache.get(idx)
+            if chunk is not None:
+                self._cache.move_to_end(idx)
+                return chunk
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        chunk = json.loads(os.pread(self._fd, end - start, start).decode("utf-8"))
+        with self._lock:
+            self._cache[idx] = chunk
+            while len(self._cache) > settings.ONDISK_CHUNK_CACHE:
+                self._cache.popitem(last=False)
+        return chunk
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __del__(self):
+        try:
+            os.close(self._fd)
+        except (AttributeError, OSError):
+            pass
+
+
+def has_text_index(segment_dir: Path) -> bool:
+    """段是否以磁盘格式（chunks.jsonl + 偏移 + 倒排）保存文本索引，旧数据为chunks.json"""
+    return (segment_dir / CHUNK_OFFSETS_FILE).exists()
+
+
+def is_disk_segment(segment_dir: Path) -> bool:
+    """段是否带有IVF倒排表，可由DiskRetrieval加载（磁盘模式下写出的文档版本段）"""
+    return has_text_index(segment_dir) and (segment_dir / IVF_CENTROIDS_FILE).exists()
+
+
+def load_text_index(retrieval: Retrieval, segment_dir: Path, cache: Optional[ByteLRUCache] = None):
+    """
+    为检索器加载段的文本索引：chunks按需读取，列式元数据与BM25倒排只读mmap，
+    多个worker共享页缓存，不在各自的堆上解析chunks、构建BM25
+    """
+    retrieval.chunks = DiskChunks(segment_dir)
+    with open(segment_dir / FILENAMES_FILE, "r", encoding="utf-8") as f:
+        retrieval.filename_codes = {name: code for code, name in enumerate(json.load(f))}
+    retrieval.chunk_files = np.load(segment_dir / CHUNK_FILES_FILE, mmap_mode="r")
+    retrieval.chunk_pages = np.load(segment_dir / CHUNK_PAGES_FILE, mmap_mode="r")
+    retrieval.chunk_uploaded_at = np.load(segment_dir / CHUNK_UPLOADED_AT_FILE, mmap_mode="r")
+    retrieval.bm25_index = PostingsBM25.load(segment_dir, cache)
+
+
+def read_chunks(segment_dir: Path) -> List[Dict[str, any]]:
+    """读取段的全部chunks（合并段时使用）"""
+    chunks_file = segment_dir / "chunks.json"
+    if chunks_file.exists():
+        with open(chunks_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    with open(segment_dir / CHUNKS_FILE, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+class DiskRetrieval(Retrieval):
+    """
+    全局检索的磁盘模式：常驻内存的只有聚类中心、IVF倒排表偏移和列式元数据，BM25词表与倒排表均为mmap
+    向量检索为IVF：查询先与聚类中心比较，只读取最近的 IVF_NPROBE 个倒排表精确计算；
+    BM25在有序词表中二分查找查询词，只读取其倒排表；读取的倒排表进入按字节限制的LRU缓存
+    """
+    def __init__(self, segment_dir: Path, cache: Optional[ByteLRUCache] = None):
+        """
+        :param cache: 多个段共用的倒排表缓存，为空时按 ONDISK_CACHE_MB 单独创建
+        """
+        super().__init__()
+        self.segment_dir = segment_dir
+        self.cache = cache if cache is not None else ByteLRUCache(settings.ONDISK_CACHE_MB * 1024 * 1024)
+        load_text_index(self, segment_dir, self.cache)
+
+        self.centroids = None
+        if (segment_dir / IVF_CENTROIDS_FILE).exists():
+            self.centroids = np.load(segment_dir / IVF_CENTROIDS_FILE)
+            self.ivf_offsets = np.load(segment_dir / IVF_OFFSETS_FILE)
+            self.ivf_ids = np.load(segment_dir / IVF_IDS_FILE, mmap_mode="r")
+            self.ivf_vectors = np.load(segment_dir / IVF_VECTORS_FILE, mmap_mode="r")
+            self.quantizer = faiss.IndexFlat(self.centroids.shape[1], metric_type())
+            self.quantizer.add(self.centroids)
+
+
+    def _ivf_list(self, list_id: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """读取一个倒排表 (chunk下标, float32向量, 向量平方范数)，经LRU缓存"""
+        def load():
+            start, end = int(self.ivf_offsets[list_id]), int(self.ivf_offsets[list_id + 1])
+            ids = np.array(self.ivf_ids[start:end])
+            vectors = np.array(self.ivf_vectors[start:end], dtype="float32")
+            sq_norms = np.einsum("ij,ij->i", vectors, vectors)
+            return (ids, vectors, sq_norms), ids.nbytes + vectors.nbytes + sq_norms.nbytes
+        return self.cache.get((str(self.segment_dir), "ivf", list_id), load)
+
+    def vector_search(self, query: str, top_k: int = None, search_filter: Optional[SearchFilter] = None,
+                      query_embedding: Optional[List[float]] = None) -> List[Tuple[float, Dict[str, any]]]:
+        """IVF检索：只扫描最近的IVF_NPROBE个倒排表，返回校准到[0,1]的得分"""
+        if self.centroids is None:
+            return []
+        top_k = top_k or settings.TOP_K
+        if query_embedding is None:
+            query_embedding = self.get_embedding(query)
+        query_vector = np.array([query_embedding], dtype="float32")
+        if query_vector.shape[1] != self.centroids.shape[1]:
+            raise ValueError(f"查询向量维度({query_vector.shape[1]})与索引向量维度({self.centroids.shape[1]})不一致，请重新向量化文档")
+        if settings.VECTOR_METRIC == "cosine":
+            query_vector = normalize_vectors(query_vector)
+        mask = search_filter.mask(self) if search_filter is not None else None
+
+        nprobe = min(settings.IVF_NPROBE, len(self.centroids))
+        _, list_ids = self.quantizer.search(query_vector, nprobe)
+        l2 = metric_type() == faiss.METRIC_L2
+        all_scores, all_ids = [], []
+        for list_id in list_ids[0]:
+            if list_id < 0:
+                continue
+            ids, vectors, sq_norms = self._ivf_list(int(list_id))
+            if mask is not None:
+                keep = mask[ids]
+                ids, vectors, sq_norms = ids[keep], vectors[keep], sq_norms[keep]
+            if len(ids) == 0:
+                continue
+            scores = vectors @ query_vector[0]
+            if l2:
+                # 平方距离，越小越相似
+                scores = sq_norms - 2 * scores + float(query_vector[0] @ query_vector[0])
+            all_scores.append(scores)
+            all_ids.append(ids)
+        if not all_scores:
+            return []
+
+        scores, ids = np.concatenate(all_scores), np.concatenate(all_ids)
+        ranking = -scores if not l2 else scores
+        k = min(top_k, len(ids))
+        top = np.argpartition(ranking, k - 1)[:k]
+        top = top[np.argsort(ranking[top])]
+        calibrated = calibrate_scores(scores[top], metric_type())
+        return [(float(score), self.chunks[idx]) for score, idx in zip(calibrated, ids[top])]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"chunks": len(self.chunks), "cache": self.cache.get_stats()}
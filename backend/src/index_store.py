@@ -0,0 +1,753 @@
+import os
+import json
+import time
+import hashlib
+import uuid
+import shutil
+import sqlite3
+import fcntl
+import threading
+import numpy as np
+import faiss
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Any
+from src.config import settings
+from src.retrieval import Retrieval, SegmentedRetrieval, build_vector_index, metric_type, search_dimension, storage_dtype
+from src.disk_index import DiskSegmentWriter, DiskRetrieval, ByteLRUCache, write_ivf, has_text_index, is_disk_segment, load_text_index, \
+    read_chunks, DISK_FORMAT
+
+# vector_store 目录下的共享文件
+INDEX_FILE = "index.faiss"
+# 多向量检索的子片段向量、父分块下标和索引
+SPAN_VECTORS_FILE = "spans.npy"
+SPAN_PARENTS_FILE = "span_parents.npy"
+SPAN_INDEX_FILE = "spans.faiss"
+# 段内可检索的文件，旧版本直接写在文档目录下
+SEGMENT_FILES = ["chunks.json", "vectors.npy", INDEX_FILE, SPAN_VECTORS_FILE, SPAN_PARENTS_FILE, SPAN_INDEX_FILE]
+GENERATION_FILE = ".generation"
+MANIFEST_FILE = "manifest.json"
+GLOBAL_DIR = ".global"
+SNAPSHOTS_DIR = ".snapshots"
+# 文档目录下的不可变版本段 segments/<版本号>/，CURRENT 记录当前版本
+SEGMENTS_DIR = "segments"
+CURRENT_FILE = "CURRENT"
+# 文档已删除的标记，段目录保留到不再被任何快照引用时由 collect_garbage 删除
+DELETED_FILE = "DELETED"
+# 写入中的段目录前缀，改名为正式名称前对读者不可见
+TMP_PREFIX = ".tmp-"
+LOCK_FILE = ".lock"
+COMPACT_LOCK_FILE = ".compact.lock"
+STATE_DB = ".state.db"
+
+
+def read_generation(vector_store_dir: Path) -> int:
+    """读取当前索引代数，向量化或删除文件后代数递增"""
+    try:
+        return int((vector_store_dir / GENERATION_FILE).read_text().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _write_generation(vector_store_dir: Path, generation: int):
+    """原子写入索引代数（先写临时文件再替换）"""
+    tmp_file = vector_store_dir / f"{GENERATION_FILE}.tmp"
+    tmp_file.write_text(str(generation))
+    os.replace(tmp_file, vector_store_dir / GENERATION_FILE)
+
+
+def _write_json(path: Path, data: Any):
+    """原子写入JSON文件"""
+    tmp_file = path.with_name(f"{path.name}.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, path)
+
+
+def current_segment(doc_dir: Path) -> Optional[Path]:
+    """文档当前版本的段目录；旧数据没有版本段时为文档目录本身；尚未向量化或已删除时返回None"""
+    if (doc_dir / DELETED_FILE).exists():
+        return None
+    try:
+        version = (doc_dir / CURRENT_FILE).read_text().strip()
+    except FileNotFoundError:
+        return doc_dir if (doc_dir / "chunks.json").exists() else None
+    segment_dir = doc_dir / SEGMENTS_DIR / version
+    return segment_dir if has_text_index(segment_dir) or (segment_dir / "chunks.json").exists() else None
+
+
+def create_segment_dir(doc_dir: Path) -> Path:
+    """创建写入中的临时段目录，写完后由 commit_segment 原子地切换为新版本"""
+    tmp_dir = doc_dir / SEGMENTS_DIR / f"{TMP_PREFIX}{uuid.uuid4().hex}"
+    tmp_dir.mkdir(parents=True)
+    return tmp_dir
+
+
+def commit_segment(doc_dir: Path, tmp_dir: Path) -> Path:
+    """
+    将写完的临时段目录改名为下一个版本号，再原子替换 CURRENT
+    段目录一旦改名即不再修改，读者读到的 CURRENT 总是指向完整的段
+    """
+    segments_dir = doc_dir / SEGMENTS_DIR
+    versions = [int(p.name) for p in segments_dir.iterdir() if p.name.isdigit()]
+    segment_dir = segments_dir / str(max(versions, default=0) + 1)
+    os.rename(tmp_dir, segment_dir)
+    tmp_file = doc_dir / f"{CURRENT_FILE}.tmp"
+    tmp_file.write_text(segment_dir.name)
+    os.replace(tmp_file, doc_dir / CURRENT_FILE)
+    # 删除后重新向量化的文档
+    (doc_dir / DELETED_FILE).unlink(missing_ok=True)
+    return segment_dir
+
+
+def remove_document(doc_dir: Path):
+    """
+    标记文档已删除：写入删除标记后移除 CURRENT 和 metadata.json，随后的发布不再包含该文档
+    段目录不立即删除，仍在读取旧快照的worker可以继续使用，由 collect_garbage 在不再被引用后删除
+    """
+    (doc_dir / DELETED_FILE).touch()
+    (doc_dir / CURRENT_FILE).unlink(missing_ok=True)
+    (doc_dir / "metadata.json").unlink(missing_ok=True)
+
+
+def list_document_dirs(vector_store_dir: Path) -> List[Path]:
+    """列出所有已向量化的文档目录（忽略以.开头的内部目录）"""
+    if not vector_store_dir.exists():
+        return []
+    return sorted(
+        p for p in vector_store_dir.iterdir()
+        if p.is_dir() and not p.name.startswith(".") and current_segment(p) is not None
+    )
+
+
+def _annotate_chunks(doc_dir: Path, chunks: List[Dict[str, Any]]):
+    """为chunks补充文件名和上传时间，供过滤检索使用（兼容旧数据）"""
+    metadata = {}
+    metadata_file = doc_dir / "metadata.json"
+    if metadata_file.exists():
+        with open(metadata_file, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+    filename = metadata.get("filename", f"{doc_dir.name}.pdf")
+    uploaded_at = metadata.get("uploaded_at")
+    for chunk in chunks:
+        chunk.setdefault("filename", filename)
+        if uploaded_at is not None:
+            chunk.setdefault("uploaded_at", uploaded_at)
+
+
+def write_document_index(file_vector_dir: Path, vectors: np.ndarray, index_file: str = INDEX_FILE):
+    """将文档的FAISS索引（按VECTOR_STORAGE格式）写入磁盘，供各worker以mmap方式只读共享"""
+    if vectors.ndim != 2 or len(vectors) == 0:
+        return
+    index = build_vector_index(vectors)
+    tmp_file = file_vector_dir / f"{index_file}.tmp"
+    faiss.write_index(index, str(tmp_file))
+    os.replace(tmp_file, file_vector_dir / index_file)
+
+
+def write_document_spans(file_vector_dir: Path, span_vectors: np.ndarray, span_parents: np.ndarray):
+    """写入子片段向量、父分块下标和子片段索引；没有子片段时删除旧文件"""
+    if len(span_vectors) == 0:
+        for name in (SPAN_VECTORS_FILE, SPAN_PARENTS_FILE, SPAN_INDEX_FILE):
+            (file_vector_dir / name).unlink(missing_ok=True)
+        return
+    for name, array in ((SPAN_VECTORS_FILE, span_vectors.astype(storage_dtype())),
+                        (SPAN_PARENTS_FILE, np.asarray(span_parents, dtype="int32"))):
+        tmp_file = file_vector_dir / f"{name}.tmp.npy"
+        np.save(tmp_file, array)
+        os.replace(tmp_file, file_vector_dir / name)
+    write_document_index(file_vector_dir, span_vectors, SPAN_INDEX_FILE)
+
+
+def _load_spans(segment_dir: Path, chunk_count: int) -> Optional[tuple]:
+    """以mmap方式加载子片段向量与父分块下标，父下标越界时视为无效"""
+    vectors_file = segment_dir / SPAN_VECTORS_FILE
+    parents_file = segment_dir / SPAN_PARENTS_FILE
+    if not (vectors_file.exists() and parents_file.exists()):
+        return None
+    mmap_mode = "r" if settings.INDEX_MMAP else None
+    span_vectors = np.load(vectors_file, mmap_mode=mmap_mode)
+    span_parents = np.load(parents_file, mmap_mode=mmap_mode)
+    if len(span_vectors) != len(span_parents) or (len(span_parents) and span_parents.max() >= chunk_count):
+        print(f"[IndexStore] 子片段与Chunks不一致，忽略多向量索引: {segment_dir}")
+        return None
+    return span_vectors, span_parents
+
+
+def _read_manifest(segment_dir: Path) -> Optional[Dict[str, Any]]:
+    manifest_file = segment_dir / MANIFEST_FILE
+    if not manifest_file.exists():
+        return None
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_snapshot(vector_store_dir: Path, generation: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    读取某一代数（默认当前代数）的快照，不存在时返回None
+    快照格式: {"generation", "created_at",
+              "documents": {文档名: 当前版本段的相对路径},
+              "segments": [{"path": 段的相对路径, "documents": [段内仍然有效的文档名]}]}
+    """
+    if generation is None:
+        generation = read_generation(vector_store_dir)
+    snapshot_file = vector_store_dir / SNAPSHOTS_DIR / f"{generation}.json"
+    if not snapshot_file.exists():
+        return None
+    with open(snapshot_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _searchable(vector_store_dir: Path, name: str, segment: str) -> bool:
+    """段能否参与全局检索：只读取vectors.npy的文件头，维度与配置不一致的文档需要重新向量化"""
+    vectors_file = vector_store_dir / segment / "vectors.npy"
+    if not vectors_file.exists():
+        print(f"[IndexStore] 跳过缺少向量的文档: {name}")
+        return False
+    vectors = np.load(vectors_file, mmap_mode="r")
+    if vectors.ndim != 2 or vectors.shape[1] != settings.EMBEDDING_DIMENSION:
+        print(f"[IndexStore] 跳过向量维度({vectors.shape[-1]})与配置({settings.EMBEDDING_DIMENSION})不一致的文档: {name}")
+        return False
+    return True
+
+
+def publish(vector_store_dir: Path, merged: Optional[Tuple[str, List[str]]] = None) -> int:
+    """
+    发布新的快照并递增代数，通知所有worker热加载
+    快照记录每个文档当前的版本段，以及参与全局检索的段：全局合并段中已被新版本替换或已删除的文档
+    在快照中标记为失效，其余文档直接使用各自的版本段，发布本身通常不重建任何索引；
+    GLOBAL_INDEX_MODE为ondisk时，不是磁盘格式的段（旧数据、内存模式下写出的段）先同步合并为一个磁盘段，
+    全局检索不会把任何文档整体载入内存
+    :param merged: 合并器产生的 (新全局段, 被它取代的段列表)
+    """
+    with open(vector_store_dir / LOCK_FILE, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        generation = read_generation(vector_store_dir) + 1
+        previous = read_snapshot(vector_store_dir)
+        documents = {
+            doc_dir.name: current_segment(doc_dir).relative_to(vector_store_dir).as_posix()
+            for doc_dir in list_document_dirs(vector_store_dir)
+        }
+
+        global_segments = [segment["path"] for segment in (previous or {}).get("segments", [])
+                           if segment["path"].startswith(GLOBAL_DIR)]
+        if merged is not None:
+            global_segments = [merged[0]] + [path for path in global_segments if path not in merged[1]]
+        segments = []
+        covered = set()
+        for path in global_segments:
+            manifest = _read_manifest(vector_store_dir / path)
+            if manifest is None:
+                continue
+            live = [entry["name"] for entry in manifest["documents"]
+                    if documents.get(entry["name"]) == entry["segment"] and entry["name"] not in covered]
+            if live:
+                segments.append({"path": path, "documents": live})
+                covered.update(live)
+        for name, segment in documents.items():
+            if name not in covered and _searchable(vector_store_dir, name, segment):
+                segments.append({"path": segment, "documents": [name]})
+
+        if settings.GLOBAL_INDEX_MODE == "ondisk":
+            pending = [entry for entry in segments if not _disk_segment(vector_store_dir, entry["path"])]
+            if pending:
+                t0 = time.time()
+                sources = [(name, documents[name]) for entry in pending for name in entry["documents"]]
+                path = _write_global_segment(vector_store_dir, sources, generation)
+                segments = [entry for entry in segments if entry not in pending]
+                built = [entry["name"] for entry in _read_manifest(vector_store_dir / path)["documents"]]
+                if built:
+                    segments.append({"path": path, "documents": built})
+                print(f"[IndexStore] 发布前将 {len(pending)} 个非磁盘格式的段合并为磁盘段，耗时 {time.time() - t0:.2f}秒")
+
+        (vector_store_dir / SNAPSHOTS_DIR).mkdir(exist_ok=True)
+        _write_json(vector_store_dir / SNAPSHOTS_DIR / f"{generation}.json", {
+            "generation": generation,
+            "created_at": time.time(),
+            "documents": documents,
+            "segments": segments
+        })
+        _write_generation(vector_store_dir, generation)
+        print(f"[IndexStore] 已发布索引代数 {generation} ({len(segments)} 个段)")
+        return generation
+
+
+def compact(vector_store_dir: Path, force: bool = False) -> Optional[int]:
+    """
+    将当前快照中的小段合并为一个更大的全局段并发布
+    待合并的段：各文档的版本段、存活chunk数低于 COMPACT_SEGMENT_CHUNKS 的全局段、
+    失效chunk比例超过 COMPACT_DEAD_RATIO、存储模式与 GLOBAL_INDEX_MODE 不一致或段格式过旧的全局段；
+    小段达到 COMPACT_MIN_SEGMENTS 个或存在需要重写的全局段时执行，force时合并全部段
+    合并按快照中固定的版本在临时目录中进行，期间发布的新版本在合并完成后的发布中自动覆盖合并结果
+    多个worker同一时刻只有一个在合并，返回新代数，未执行合并时返回None
+    """
+    with open(vector_store_dir / COMPACT_LOCK_FILE, "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        snapshot = read_snapshot(vector_store_dir)
+        if snapshot is None or not snapshot["segments"]:
+            return None
+
+        candidates = []
+        rewrite = False
+        for segment in snapshot["segments"]:
+            manifest = _read_manifest(vector_store_dir / segment["path"]) if segment["path"].startswith(GLOBAL_DIR) else None
+            if manifest is None:
+                candidates.append(segment)
+                continue
+            live_count = sum(entry["count"] for entry in manifest["documents"] if entry["name"] in segment["documents"])
+            dead_ratio = 1 - live_count / max(manifest["chunk_count"], 1)
+            if dead_ratio > settings.COMPACT_DEAD_RATIO or manifest.get("mode", "memory") != settings.GLOBAL_INDEX_MODE \
+                    or manifest.get("format") != DISK_FORMAT:
+                rewrite = True
+                candidates.append(segment)
+            elif force or live_count < settings.COMPACT_SEGMENT_CHUNKS:
+                candidates.append(segment)
+        if not (force and len(candidates) > 0 or rewrite or len(candidates) >= max(settings.COMPACT_MIN_SEGMENTS, 2)):
+            return None
+
+        t0 = time.time()
+        documents = [(name, snapshot["documents"][name]) for segment in candidates for name in segment["documents"]]
+        path = _write_global_segment(vector_store_dir, documents, snapshot["generation"])
+        print(f"[IndexStore] 合并 {len(candidates)} 个段 ({len(documents)} 个文档) 耗时 {time.time() - t0:.2f}秒")
+        return publish(vector_store_dir, (path, [segment["path"] for segment in candidates]))
+
+
+def collect_garbage(vector_store_dir: Path) -> int:
+    """
+    删除不再被任何保留快照引用的段目录、已删除文档的目录和过期快照，返回删除的目录数
+    当前快照和 SNAPSHOT_RETENTION 秒内的快照都会保留，仍在读取旧快照的worker不受影响；
+    已mmap的文件在Linux下删除后映射仍然有效
+    """
+    with open(vector_store_dir / COMPACT_LOCK_FILE, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        generation = read_generation(vector_store_dir)
+        expire_before = time.time() - settings.SNAPSHOT_RETENTION
+        referenced = set()
+        snapshots_dir = vector_store_dir / SNAPSHOTS_DIR
+        if snapshots_dir.exists():
+            for snapshot_file in snapshots_dir.glob("*.json"):
+                if snapshot_file.stem != str(generation) and snapshot_file.stat().st_mtime < expire_before:
+                    snapshot_file.unlink(missing_ok=True)
+                    continue
+                with open(snapshot_file, "r", encoding="utf-8") as f:
+                    snapshot = json.load(f)
+                referenced.update(segment["path"] for segment in snapshot["segments"])
+                referenced.update(snapshot["documents"].values())
+
+        removed = 0
+        candidates = []
+        if (vector_store_dir / GLOBAL_DIR).exists():
+            candidates.extend((vector_store_dir / GLOBAL_DIR).iterdir())
+        for doc_dir in list(vector_store_dir.iterdir()):
+            if doc_dir.is_dir() and not doc_dir.name.startswith(".") and (doc_dir / DELETED_FILE).exists():
+                name = doc_dir.name
+                # 已删除的文档不再被任何保留快照引用、且没有正在进行的重新入库（近期写入的以.开头的暂存目录）时整体删除
+                if any(path == name or path.startswith(f"{name}/") for path in referenced) or \
+                        any(p.name.startswith(".") and p.stat().st_mtime >= expire_before - 3600 for p in doc_dir.iterdir()):
+                    continue
+                tmp_dir = vector_store_dir / f"{TMP_PREFIX}{uuid.uuid4().hex}"
+                os.rename(doc_dir, tmp_dir)
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                removed += 1
+            elif doc_dir.is_dir() and not doc_dir.name.startswith(".") and (doc_dir / SEGMENTS_DIR).exists():
+                current = current_segment(doc_dir)
+                current_version = int(current.name) if current is not None and current != doc_dir else 0
+                # 只清理早于当前版本的段，避免误删清理期间刚提交的新版本
+                candidates.extend(p for p in (doc_dir / SEGMENTS_DIR).iterdir()
+                                  if p.name.startswith(TMP_PREFIX) or (p.name.isdigit() and int(p.name) < current_version))
+                if current_version and doc_dir.name not in referenced:
+                    # 已有版本段的文档，删除旧格式直接写在文档目录下的文件
+                    for name in SEGMENT_FILES:
+                        (doc_dir / name).unlink(missing_ok=True)
+        for path in candidates:
+            if path.name.startswith(TMP_PREFIX):
+                # 写入中断残留的临时目录
+                if path.stat().st_mtime < expire_before - 3600:
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+            elif path.parent.name == GLOBAL_DIR and int(path.name.split("-")[0]) > generation:
+                # 发布过程中刚写出、尚未写入快照的全局段
+                continue
+            elif path.relative_to(vector_store_dir).as_posix() not in referenced:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        if removed:
+            print(f"[IndexStore] 已清理 {removed} 个不再引用的段")
+        return removed
+
+
+def _disk_segment(vector_store_dir: Path, path: str) -> bool:
+    """段是否为当前格式的磁盘段（ondisk全局段或带IVF倒排表的文档版本段）"""
+    if path.startswith(GLOBAL_DIR):
+        manifest = _read_manifest(vector_store_dir / path)
+        return manifest is not None and manifest.get("mode") == "ondisk" and manifest.get("format") == DISK_FORMAT
+    return is_disk_segment(vector_store_dir / path)
+
+
+def _write_global_segment(vector_store_dir: Path, sources: List[Tuple[str, str]], generation: int) -> str:
+    """在临时目录中构建全局段，完成后改名为 <代数>-<随机后缀>，返回相对路径"""
+    global_root = vector_store_dir / GLOBAL_DIR
+    tmp_dir = global_root / f"{TMP_PREFIX}{uuid.uuid4().hex}"
+    tmp_dir.mkdir(parents=True)
+    try:
+        _build_global_segment(vector_store_dir, tmp_dir, sources)
+        target_dir = global_root / f"{generation}-{uuid.uuid4().hex[:8]}"
+        os.rename(tmp_dir, target_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return target_dir.relative_to(vector_store_dir).as_posix()
+
+
+def _build_global_segment(vector_store_dir: Path, target_dir: Path, sources: List[Tuple[str, str]]):
+    """
+    逐个文档拼接chunks与向量，chunks流式写入文本索引（chunks.jsonl、列式元数据、BM25倒排），不在内存中保留全部chunks
+    向量写出 vectors.npy / index.faiss，GLOBAL_INDEX_MODE为ondisk时写为IVF倒排表
+    :param sources: (文档名, 版本段的相对路径) 列表
+    """
+    ondisk = settings.GLOBAL_INDEX_MODE == "ondisk"
+    writer = DiskSegmentWriter(target_dir)
+    chunk_count = 0
+    vector_parts = []
+    span_parts = []
+    documents = []
+    for name, segment in sources:
+        segment_dir = vector_store_dir / segment
+        chunks = read_chunks(segment_dir)
+        _annotate_chunks(vector_store_dir / name, chunks)
+        vectors_file = segment_dir / "vectors.npy"
+        if not vectors_file.exists():
+            print(f"[IndexStore] 跳过缺少向量的文档: {name}")
+            continue
+        vectors = np.load(vectors_file, mmap_mode="r")
+        if len(vectors) != len(chunks) or vectors.ndim != 2:
+            print(f"[IndexStore] 跳过向量与Chunks数量不一致的文档: {name}")
+            continue
+        if vectors.shape[1] != settings.EMBEDDING_DIMENSION:
+            # 以不同EMBEDDING_DIMENSION向量化的文档无法与当前查询向量比较，需要重新向量化
+            print(f"[IndexStore] 跳过向量维度({vectors.shape[1]})与配置({settings.EMBEDDING_DIMENSION})不一致的文档: {name}")
+            continue
+        # 磁盘模式暂不支持多向量检索
+        spans = _load_spans(segment_dir, len(chunks)) if settings.MULTI_VECTOR and not ondisk else None
+        if spans is not None:
+            # 父分块下标加上文档在全局中的偏移
+            span_parts.append((spans[0], spans[1] + chunk_count))
+        documents.append({"name": name, "segment": segment, "offset": chunk_count, "count": len(chunks)})
+        writer.add(chunks)
+        chunk_count += len(chunks)
+        vector_parts.append(vectors)
+
+    writer.close()
+    with open(target_dir / MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump({"documents": documents, "chunk_count": chunk_count, "mode": settings.GLOBAL_INDEX_MODE,
+                   "format": DISK_FORMAT}, f, ensure_ascii=False, indent=2)
+
+    if not vector_parts:
+        return
+    # 按文档写入memmap，避免一次性在内存中拼接全部向量
+    dimension = vector_parts[0].shape[1]
+    merged = np.lib.format.open_memmap(
+        target_dir / "vectors.npy", mode="w+", dtype=storage_dtype(), shape=(chunk_count, dimension)
+    )
+    offset = 0
+    for vectors in vector_parts:
+        merged[offset:offset + len(vectors)] = vectors
+        offset += len(vectors)
+    merged.flush()
+    if ondisk:
+        write_ivf(target_dir, merged)
+    else:
+        write_document_index(target_dir, merged)
+    del merged
+
+    if span_parts:
+        write_document_spans(
+            target_dir,
+            np.concatenate([vectors for vectors, _ in span_parts]),
+            np.concatenate([parents for _, parents in span_parts])
+        )
+
+
+class Snapshot:
+    """
+    读者固定的一致快照：一次查询使用的检索器与答案缓存版本都来自同一代数
+    段不可变，快照被替换后已加载的检索器仍可继续使用
+    """
+    def __init__(self, store: "IndexStore", manifest: Dict[str, Any]):
+        self.store = store
+        self.manifest = manifest
+        self.generation = manifest["generation"]
+
+    def retrieval(self, doc_name: Optional[str] = None) -> Optional[Retrieval]:
+        """获取单文档（doc_name）或全局（None）的检索器，不存在时返回None"""
+        if doc_name:
+            segment = self.manifest["documents"].get(doc_name)
+            return self.store._segment(segment, doc_name) if segment else None
+        return self.store._global(self)
+
+    def version(self, doc_name: Optional[str] = None, filenames: Optional[List[str]] = None) -> str:
+        """
+        检索范围的文档版本，用于答案缓存失效：单文档为其版本段路径；全局或按文件过滤时为范围内
+        各文档版本段的摘要。版本段只在重新向量化时变化，合并与范围外文档的增删都不改变版本
+        """
+        documents = self.manifest["documents"]
+        if doc_name:
+            return documents.get(doc_name, "")
+        if filenames:
+            names = {os.path.splitext(filename)[0] for filename in filenames}
+            documents = {name: segment for name, segment in documents.items() if name in names}
+        return hashlib.sha1(json.dumps(sorted(documents.items())).encode("utf-8")).hexdigest()
+
+
+class IndexStore:
+    """
+    进程内的只读索引缓存
+    向量、FAISS索引以及chunks偏移、列式元数据和BM25倒排均以mmap方式只读加载，多个worker共享同一份页缓存，内存不随worker数增长
+    每次访问时检查代数文件，向量化/删除完成后自动热加载；段不可变，按段路径缓存，新代数只加载新增的段
+    """
+    def __init__(self, vector_store_dir: Path):
+        self.vector_store_dir = vector_store_dir
+        # 段路径 -> 检索器
+        self._segments: Dict[str, Retrieval] = {}
+        # (代数, 全局检索器)
+        self._global_cache: Optional[Tuple[int, Optional[Retrieval]]] = None
+        self._snapshot: Optional[Snapshot] = None
+        # 磁盘模式下所有段共用的倒排表缓存，常驻内存不随段数增长
+        self._cache = ByteLRUCache(settings.ONDISK_CACHE_MB * 1024 * 1024)
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def snapshot(self) -> Optional[Snapshot]:
+        """固定当前代数的快照，尚无快照（旧数据）时由当前worker补发布"""
+        generation = read_generation(self.vector_store_dir)
+        with self._lock:
+            if self._snapshot is not None and self._snapshot.generation == generation:
+                return self._snapshot
+            manifest = read_snapshot(self.vector_store_dir, generation)
+            if manifest is None:
+                if not list_document_dirs(self.vector_store_dir):
+                    return None
+                publish(self.vector_store_dir)
+                manifest = read_snapshot(self.vector_store_dir)
+            self._snapshot = Snapshot(self, manifest)
+            return self._snapshot
+
+    def get_retrieval(self, doc_name: Optional[str] = None) -> Optional[Retrieval]:
+        """获取当前快照中单文档（doc_name）或全局（None）的检索器，不存在时返回None"""
+        snapshot = self.snapshot()
+        return snapshot.retrieval(doc_name) if snapshot is not None else None
+
+    def preload(self):
+        """启动时预加载全局和所有文档的索引，避免首个请求承担加载开销"""
+        t0 = time.time()
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return
+        snapshot.retrieval()
+        for doc_name in snapshot.manifest["documents"]:
+            snapshot.retrieval(doc_name)
+        print(f"[IndexStore] 预加载 {len(snapshot.manifest['documents'])} 个文档索引耗时 {time.time() - t0:.4f}秒")
+
+    def _segment(self, segment: str, doc_name: Optional[str] = None) -> Optional[Retrieval]:
+        """按相对路径加载段（已加载的段直接复用）"""
+        with self._lock:
+            if segment in self._segments:
+                return self._segments[segment]
+            segment_dir = self.vector_store_dir / segment
+            manifest = _read_manifest(segment_dir) if segment.startswith(GLOBAL_DIR) else None
+            if manifest is not None and manifest.get("mode") == "ondisk" or \
+                    manifest is None and settings.GLOBAL_INDEX_MODE == "ondisk" and is_disk_segment(segment_dir):
+                t0 = time.time()
+                retrieval = DiskRetrieval(segment_dir, self._cache) if manifest is None or manifest["chunk_count"] else None
+                print(f"[IndexStore] 加载磁盘索引 {segment_dir} 耗时 {time.time() - t0:.4f}秒")
+            else:
+                retrieval = self._load(segment_dir, self.vector_store_dir / doc_name if doc_name else None)
+            if retrieval is not None:
+                self._segments[segment] = retrieval
+            return retrieval
+
+    def _global(self, snapshot: Snapshot) -> Optional[Retrieval]:
+        """由快照中的段组合全局检索器，合并段中失效的文档通过存活掩码排除"""
+        with self._lock:
+            if self._global_cache is not None and self._global_cache[0] == snapshot.generation:
+                return self._global_cache[1]
+            parts = []
+            for entry in snapshot.manifest["segments"]:
+                doc_name = None if entry["path"].startswith(GLOBAL_DIR) else entry["documents"][0]
+                try:
+                    retrieval = self._segment(entry["path"], doc_name)
+                except (OSError, ValueError) as e:
+                    print(f"[IndexStore] 跳过无法加载的段 {entry['path']}: {e}")
+                    continue
+                if retrieval is not None:
+                    parts.append((retrieval, self._live_mask(entry)))
+
+            retrieval = None
+            if len(parts) == 1 and parts[0][1] is None:
+                retrieval = parts[0][0]
+            elif parts:
+                retrieval = SegmentedRetrieval(parts)
+            # 丢弃当前快照不再引用的段
+            referenced = {entry["path"] for entry in snapshot.manifest["segments"]} | set(snapshot.manifest["documents"].values())
+            for segment in [segment for segment in self._segments if segment not in referenced]:
+                del self._segments[segment]
+            self._global_cache = (snapshot.generation, retrieval)
+            return retrieval
+
+    def _live_mask(self, entry: Dict[str, Any]) -> Optional[np.ndarray]:
+        """合并段的存活掩码，段内文档全部有效时返回None"""
+        manifest = _read_manifest(self.vector_store_dir / entry["path"]) if entry["path"].startswith(GLOBAL_DIR) else None
+        if manifest is None:
+            return None
+        live = set(entry["documents"])
+        if all(document["name"] in live for document in manifest["documents"]):
+            return None
+        mask = np.zeros(manifest["chunk_count"], dtype=bool)
+        for document in manifest["documents"]:
+            if document["name"] in live:
+                mask[document["offset"]:document["offset"] + document["count"]] = True
+        return mask
+
+    def _load(self, segment_dir: Path, doc_dir: Optional[Path] = None) -> Optional[Retrieval]:
+        """
+        加载段：文本索引（chunks偏移、列式元数据、BM25倒排）与向量、FAISS索引一样只读mmap，
+        多个worker共享页缓存；只有旧数据的chunks.json需要在各自的堆上解析并构建BM25
+        """
+        text_index = has_text_index(segment_dir)
+        chunks_file = segment_dir / "chunks.json"
+        if not text_index and not chunks_file.exists():
+            return None
+        t0 = time.time()
+        retrieval = Retrieval()
+        if text_index:
+            load_text_index(retrieval, segment_dir)
+            chunks = retrieval.chunks
+        else:
+            with open(chunks_file, "r", encoding="utf-8") as f:
+                chunks = json.load(f)
+            if doc_dir is not None:
+                _annotate_chunks(doc_dir, chunks)
+        if len(chunks) == 0:
+            return None
+
+        vectors = None
+        vectors_file = segment_dir / "vectors.npy"
+        if vectors_file.exists():
+            try:
+                vectors = np.load(vectors_file, mmap_mode="r" if settings.INDEX_MMAP else None)
+            except Exception as e:
+                print(f"加载向量文件失败 {vectors_file}: {e}")
+
+        if vectors is not None and vectors.ndim == 2 and vectors.shape[1] != settings.EMBEDDING_DIMENSION:
+            raise ValueError(
+                f"{(doc_dir or segment_dir).name} 的向量维度({vectors.shape[1]})与当前配置EMBEDDING_DIMENSION({settings.EMBEDDING_DIMENSION})不一致，请重新向量化"
+            )
+
+        if vectors is None or len(vectors) != len(chunks):
+            if segment_dir != doc_dir:
+                # 版本段与全局段整体原子写入，不应出现不一致；不再退回到重新计算整个段的向量
+                print(f"[IndexStore] 段 {segment_dir} 的向量数量与 Chunks 数量 ({len(chunks)}) 不一致，跳过")
+                return None
+            # 旧数据的向量缺失或不一致时退回到重新计算向量
+            print(f"警告: {segment_dir.name} 向量数量与 Chunks 数量 ({len(chunks)}) 不一致，将重新计算向量")
+            retrieval.build_index(chunks)
+            return retrieval
+
+        index = self._read_index(segment_dir / INDEX_FILE, len(chunks), vectors.shape[1])
+        if text_index:
+            retrieval.load_vectors(vectors, index)
+        else:
+            retrieval.load_index(chunks, vectors, index)
+        if settings.MULTI_VECTOR:
+            self._load_span_index(segment_dir, retrieval)
+        print(f"[IndexStore] 加载 {segment_dir} 耗时 {time.time() - t0:.4f}秒 (Chunks数量: {len(chunks)})")
+        return retrieval
+
+    @staticmethod
+    def _read_index(index_file: Path, count: int, dimension: int) -> Optional[faiss.Index]:
+        """读取磁盘上的FAISS索引，数量、维度或度量与当前配置不一致时返回None"""
+        if not index_file.exists():
+            return None
+        flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if settings.INDEX_MMAP else 0
+        try:
+            index = faiss.read_index(str(index_file), flags)
+        except Exception as e:
+            print(f"加载索引文件失败 {index_file}: {e}")
+            return None
+        # SEARCH_DIMENSION或VECTOR_METRIC调整后磁盘上的索引不再匹配，在内存中重建
+        if index.ntotal != count or index.d != search_dimension(dimension) or index.metric_type != metric_type():
+            return None
+        return index
+
+    def _load_span_index(self, segment_dir: Path, retrieval: Retrieval):
+        spans = _load_spans(segment_dir, len(retrieval.chunks))
+        if spans is None:
+            return
+        span_vectors, span_parents = spans
+        span_index = self._read_index(segment_dir / SPAN_INDEX_FILE, len(span_vectors), span_vectors.shape[1])
+        retrieval.load_spans(span_vectors, span_parents, span_index)
+
+    def start_compactor(self, interval: float = None):
+        """启动后台合并线程（轮询）：合并小段并清理不再被快照引用的旧版本"""
+        interval = interval or settings.COMPACT_INTERVAL
+        if self._thread is not None or interval <= 0:
+            return
+
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    compact(self.vector_store_dir)
+                    collect_garbage(self.vector_store_dir)
+                except Exception as e:
+                    print(f"[IndexStore] 合并失败: {e}")
+
+        self._thread = threading.Thread(target=loop, name="index-compactor", daemon=True)
+        self._thread.start()
+
+    def stop_compactor(self):
+        self._stop.set()
+
+
+class ProgressStore:
+    """
+    基于SQLite的向量化进度存储，替代进程内字典，供多个worker共享
+    接口与dict保持一致：progress[filename] = 40 / progress.get(filename, 0)
+    """
+    def __init__(self, db_path: Path):
+        self.db_path = str(db_path)
+        self._execute("CREATE TABLE IF NOT EXISTS progress (filename TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def __setitem__(self, filename: str, value: int):
+        self._execute(
+            "INSERT INTO progress (filename, value) VALUES (?, ?) "
+            "ON CONFLICT(filename) DO UPDATE SET value = excluded.value",
+            (filename, value)
+        )
+
+    def __getitem__(self, filename: str) -> int:
+        value = self.get(filename)
+        if value is None:
+            raise KeyError(filename)
+        return value
+
+    def get(self, filename: str, default: Optional[int] = None) -> Optional[int]:
+        rows = self._execute("SELECT value FROM progress WHERE filename = ?", (filename,))
+        return rows[0][0] if rows else default
+
+    def __contains__(self, filename: str) -> bool:
+        return self.get(filename) is not None
+
+    def __delitem__(self, filename: str):
+        self._execute("DELETE FROM progress WHERE filename = ?", (filename,))
@@ -0,0 +1,401 @@
+import os
+import json
+import time
+import queue
+import shutil
+import threading
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Any
+from src.config import settings
+from src.pdf_parsing import PDFParser
+from src.text_splitter import TextSplitter, StructureChunker, chunk_subspans
+from src.retrieval import Retrieval, prepare_vectors, storage_dtype
+from src.index_store import write_document_index, write_document_spans, create_segment_dir, commit_segment
+from src.disk_index import DiskSegmentWriter, write_ivf
+from src.outbound import PRIORITY_BULK
+
+# 入库过程中的暂存目录，完成后删除；存在时表示上次入库未完成，可断点续跑
+STAGING_DIR = ".ingest"
+CHECKPOINT_FILE = "checkpoint.json"
+
+# 队列结束标记
+_DONE = None
+
+
+class IngestionPipeline:
+    """
+    流水线入库：按页批次 解析 -> 分块 -> 批量Embedding -> 增量写入
+    前三个阶段各在独立线程中运行，阶段之间用有界队列衔接（队列满时上游阻塞，内存占用有上限），
+    CPU密集的解析与网络密集的Embedding得以重叠
+    写入阶段每完成一个页批次就追加到暂存文件并记录检查点，进程崩溃后重新向量化会从下一个批次继续；
+    每处理 INGEST_FLUSH_PAGES 页写出一次可检索的版本段（chunks.json / vectors.npy / index.faiss）
+    """
+    def __init__(self, file_path: Path, filename: str, file_vector_dir: Path,
+                 progress_callback: Optional[Callable[[int], None]] = None,
+                 flush_callback: Optional[Callable[[], None]] = None):
+        self.file_path = file_path
+        self.filename = filename
+        self.file_vector_dir = file_vector_dir
+        self.staging_dir = file_vector_dir / STAGING_DIR
+        self.progress_callback = progress_callback or (lambda progress: None)
+        self.flush_callback = flush_callback or (lambda: None)
+        self._stop = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    # --------------------------
+    # 检查点与暂存文件
+    # --------------------------
+    def _source_signature(self) -> Dict[str, Any]:
+        stat = self.file_path.stat()
+        return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+    def _load_checkpoint(self) -> Dict[str, Any]:
+        """读取检查点；源文件变化或没有检查点时从头开始"""
+        checkpoint_file = self.staging_dir / CHECKPOINT_FILE
+        if checkpoint_file.exists():
+            with open(checkpoint_file, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("source") == self._source_signature():
+                print(f"[Ingestion] 从第 {checkpoint['next_page']} 页继续入库 (已完成 {checkpoint['chunk_count']} 个分块)")
+                self._truncate_staging(checkpoint)
+                return checkpoint
+            print("[Ingestion] 源文件已变化，丢弃未完成的入库进度")
+        if self.staging_dir.exists():
+            shutil.rmtree(self.staging_dir)
+        self.staging_dir.mkdir(parents=True)
+        return {
+            "source": self._source_signature(),
+            "page_count": None,
+            "next_page": 1,
+            "chunk_count": 0,
+            "span_count": 0,
+            "dimension": None,
+            "element_count": 0,
+            "markdown_bytes": 0,
+            "page_sizes": {},
+            "chunker_state": None,
+            "flushed_page": 0
+        }
+
+    def _save_checkpoint(self, checkpoint: Dict[str, Any]):
+        tmp_file = self.staging_dir / f"{CHECKPOINT_FILE}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+        os.replace(tmp_file, self.staging_dir / CHECKPOINT_FILE)
+
+    def _truncate_staging(self, checkpoint: Dict[str, Any]):
+        """丢弃崩溃时写了一半、未进入检查点的数据"""
+        for name, count in [("chunks.jsonl", checkpoint["chunk_count"]), ("elements.jsonl", checkpoint["element_count"])]:
+            path = self.staging_dir / name
+            if path.exists():
+                with open(path, "r", encoding="utf-8") as f:
+                    lines = f.readlines()[:count]
+                with open(path, "w", encoding="utf-8") as f:
+                    f.writelines(lines)
+        vectors_file = self.staging_dir / "vectors.bin"
+        if vectors_file.exists() and checkpoint["dimension"]:
+            os.truncate(vectors_file, checkpoint["chunk_count"] * checkpoint["dimension"] * 4)
+        span_count = checkpoint.get("span_count", 0)
+        if (self.staging_dir / "spans.bin").exists() and checkpoint["dimension"]:
+            os.truncate(self.staging_dir / "spans.bin", span_count * checkpoint["dimension"] * 4)
+        if (self.staging_dir / "span_parents.bin").exists():
+            os.truncate(self.staging_dir / "span_parents.bin", span_count * 4)
+        markdown_file = self.staging_dir / "document.md.part"
+        if markdown_file.exists():
+            os.truncate(markdown_file, checkpoint["markdown_bytes"])
+
+    # --------------------------
+    # 阶段间通信
+    # --------------------------
+    def _put(self, q: queue.Queue, item: Any) -> bool:
+        """放入队列，队列满时阻塞（背压）；流水线已停止时返回False"""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _iter_queue(self, q: queue.Queue) -> Iterator[Any]:
+        while not self._stop.is_set():
+            try:
+                item = q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                return
+            yield item
+
+    def _run_stage(self, stage: Callable[..., None], *args):
+        """在线程中运行阶段，异常时记录并停止整个流水线"""
+        try:
+            stage(*args)
+        except BaseException as e:
+            self._error = e
+            self._stop.set()
+
+    # --------------------------
+    # 各阶段
+    # --------------------------
+    def _load_parsed(self) -> Optional[Dict[str, Any]]:
+        """读取上次解析得到的elements.json；源文件已被替换（签名不一致）时忽略"""
+        elements_file = self.file_vector_dir / "elements.json"
+        if not elements_file.exists():
+            return None
+        with open(elements_file, "r", encoding="utf-8") as f:
+            parsed = json.load(f)
+        if parsed.get("source") != self._source_signature():
+            print("[Ingestion] elements.json 与当前源文件不一致，重新解析")
+            return None
+        return parsed
+
+    def _legacy_markdown(self) -> Optional[Path]:
+        """旧数据只有document.md（没有来源签名），源文件比它新时视为已被替换"""
+        markdown_file = self.file_vector_dir / "document.md"
+        if (self.file_vector_dir / "elements.json").exists() or not markdown_file.exists():
+            return None
+        if markdown_file.stat().st_size == 0 or markdown_file.stat().st_mtime < self.file_path.stat().st_mtime:
+            return None
+        return markdown_file
+
+    def _count_pages(self) -> int:
+        parsed = self._load_parsed()
+        if parsed is not None:
+            pages = [int(page) for page in parsed.get("page_sizes", {})] + [e["page_num"] for e in parsed["elements"]]
+            return max(pages, default=1)
+        if self._legacy_markdown() is not None:
+            return 1
+        return PDFParser.get_page_count(str(self.file_path))
+
+    def _iter_batches(self, page_count: int, start_page: int) -> Iterator[Dict[str, Any]]:
+        """按页批次产出待分块的内容；已解析过的同一源文件直接复用elements.json"""
+        batch_pages = settings.INGEST_PAGE_BATCH
+        parsed = self._load_parsed()
+        markdown_file = self._legacy_markdown() if parsed is None else None
+
+        if parsed is not None:
+            print(f"[Ingestion] 复用已解析的elements.json")
+            # JSON的键为字符串，转换回页码
+            page_sizes = {int(page_no): size for page_no, size in parsed.get("page_sizes", {}).items()}
+            by_page = {}
+            for element in parsed["elements"]:
+                by_page.setdefault(element["page_num"], []).append(element)
+            for start in range(start_page, page_count + 1, batch_pages):
+                end = min(start + batch_pages - 1, page_count)
+                pages = range(start, end + 1)
+                yield {
+                    "start": start,
+                    "end": end,
+                    "elements": [element for page in pages for element in by_page.get(page, [])],
+                    "page_sizes": {page: page_sizes[page] for page in pages if page in page_sizes},
+                    "parsed": False
+                }
+        elif markdown_file is not None:
+            # 旧数据只有document.md，整体作为一个页面按token分块
+            print(f"[Ingestion] 旧数据没有elements.json，从document.md分块")
+            with open(markdown_file, "r", encoding="utf-8") as f:
+                markdown_content = f.read()
+            yield {
+                "start": 1,
+                "end": 1,
+                "pages": [{"page_num": 1, "content": markdown_content, "page_width": 0, "page_height": 0}],
+                "parsed": False
+            }
+        else:
+            for start in range(start_page, page_count + 1, batch_pages):
+                end = min(start + batch_pages - 1, page_count)
+                t0 = time.time()
+                elements, markdown, page_sizes = PDFParser.parse_pages(str(self.file_path), start, end)
+                print(f"[Ingestion] 解析第 {start}-{end} 页耗时 {time.time() - t0:.2f}秒")
+                yield {
+                    "start": start,
+                    "end": end,
+                    "elements": elements,
+                    "page_sizes": page_sizes,
+                    "markdown": markdown,
+                    "parsed": True
+                }
+
+    def _parse_stage(self, out_q: queue.Queue, page_count: int, start_page: int):
+        for batch in self._iter_batches(page_count, start_page):
+            if not self._put(out_q, batch):
+                return
+        self._put(out_q, _DONE)
+
+    def _split_stage(self, in_q: queue.Queue, out_q: queue.Queue, page_count: int, chunker_state: Optional[Dict[str, Any]]):
+        splitter = TextSplitter()
+        chunker = StructureChunker(splitter, state=chunker_state)
+        for batch in self._iter_queue(in_q):
+            if "pages" in batch:
+                chunks = splitter.split_document(batch["pages"])
+            elif settings.CHUNKING_STRATEGY == "structure":
+                chunks = chunker.feed(batch["elements"], batch["page_sizes"])
+                if batch["end"] >= page_count:
+                    chunks += chunker.finish()
+            else:
+                chunks = splitter.split_document(PDFParser.group_pages(batch["elements"], batch["page_sizes"]))
+            batch["chunks"] = chunks
+            batch["chunker_state"] = chunker.get_state()
+            if not self._put(out_q, batch):
+                return
+        self._put(out_q, _DONE)
+
+    def _embed_stage(self, in_q: queue.Queue, out_q: queue.Queue):
+        retrieval = Retrieval(priority=PRIORITY_BULK)
+        batch_size = settings.EMBEDDING_BATCH_SIZE
+        with ThreadPoolExecutor(max_workers=settings.INGEST_EMBED_CONCURRENCY) as executor:
+            for batch in self._iter_queue(in_q):
+                texts = [chunk["content"] for chunk in batch["chunks"]]
+                # 多向量模式下子片段与分块一起发送Embedding请求
+                span_texts, span_parents = chunk_subspans(batch["chunks"]) if settings.MULTI_VECTOR else ([], [])
+                all_texts = texts + span_texts
+                groups = [all_texts[i:i + batch_size] for i in range(0, len(all_texts), batch_size)]
+                # 多个Embedding请求并发发送，限流由调度器统一控制
+                results = executor.map(lambda group: retrieval.get_embeddings(group, PRIORITY_BULK), groups)
+                vectors = [vector for group in results for vector in group]
+                embedded = prepare_vectors(np.array(vectors, dtype="float32").reshape(len(all_texts), -1)) if vectors else None
+                batch["vectors"] = embedded[:len(texts)] if embedded is not None else None
+                batch["span_vectors"] = embedded[len(texts):] if span_texts else None
+                batch["span_parents"] = span_parents
+                if not self._put(out_q, batch):
+                    return
+        self._put(out_q, _DONE)
+
+    def _write_batch(self, batch: Dict[str, Any], checkpoint: Dict[str, Any], uploaded_at: float):
+        """把一个页批次追加到暂存文件，最后更新检查点"""
+        chunks = batch["chunks"]
+        vectors = batch["vectors"]
+        if vectors is not None:
+            if checkpoint["dimension"] is None:
+                checkpoint["dimension"] = int(vectors.shape[1])
+            elif vectors.shape[1] != checkpoint["dimension"]:
+                raise ValueError(f"向量维度不一致: {vectors.shape[1]} != {checkpoint['dimension']}")
+
+        # 记录来源文件和上传时间，供过滤检索使用
+        with open(self.staging_dir / "chunks.jsonl", "a", encoding="utf-8") as f:
+            for chunk in chunks:
+                chunk["filename"] = self.filename
+                chunk["uploaded_at"] = uploaded_at
+                f.write(json.dumps(chunk, ensure_ascii=False) + "\n")
+        if vectors is not None:
+            with open(self.staging_dir / "vectors.bin", "ab") as f:
+                f.write(vectors.tobytes())
+        if batch.get("span_vectors") is not None:
+            with open(self.staging_dir / "spans.bin", "ab") as f:
+                f.write(batch["span_vectors"].tobytes())
+            # 批次内的父分块下标转换为文档内下标
+            parents = np.array(batch["span_parents"], dtype="int32") + checkpoint["chunk_count"]
+            with open(self.staging_dir / "span_parents.bin", "ab") as f:
+                f.write(parents.tobytes())
+            checkpoint["span_count"] = checkpoint.get("span_count", 0) + len(parents)
+        if batch["parsed"]:
+            with open(self.staging_dir / "elements.jsonl", "a", encoding="utf-8") as f:
+                for element in batch["elements"]:
+                    f.write(json.dumps(element, ensure_ascii=False) + "\n")
+            with open(self.staging_dir / "document.md.part", "ab") as f:
+                f.write((batch["markdown"] + "\n\n").encode("utf-8"))
+            checkpoint["element_count"] += len(batch["elements"])
+            checkpoint["markdown_bytes"] = (self.staging_dir / "document.md.part").stat().st_size
+            checkpoint["page_sizes"].update({str(page): size for page, size in batch["page_sizes"].items()})
+
+        checkpoint["chunk_count"] += len(chunks)
+        checkpoint["next_page"] = batch["end"] + 1
+        checkpoint["chunker_state"] = batch.get("chunker_state")
+        self._save_checkpoint(checkpoint)
+
+    def _write_outputs(self, checkpoint: Dict[str, Any], final: bool):
+        """由暂存文件写出新版本段的文本索引 / vectors.npy / index.faiss，final时同时写出解析结果并清理暂存"""
+        with open(self.staging_dir / "chunks.jsonl", "r", encoding="utf-8") as f:
+            chunks = [json.loads(line) for line in f]
+        vectors = np.fromfile(self.staging_dir / "vectors.bin", dtype="float32").reshape(len(chunks), checkpoint["dimension"])
+
+        # 在临时段目录中写完全部文件后整体切换为新版本，读者不会读到半成品或新旧混合的文件
+        segment_dir = create_segment_dir(self.file_vector_dir)
+        np.save(segment_dir / "vectors.npy", vectors.astype(storage_dtype()))
+        if settings.GLOBAL_INDEX_MODE == "ondisk":
+            # 磁盘模式下文档段同样写为IVF倒排表，全局检索不把任何文档整体载入内存
+            if len(vectors):
+                write_ivf(segment_dir, vectors)
+        else:
+            write_document_index(segment_dir, vectors)
+        span_count = checkpoint.get("span_count", 0)
+        if span_count:
+            span_vectors = np.fromfile(self.staging_dir / "spans.bin", dtype="float32").reshape(span_count, checkpoint["dimension"])
+            span_parents = np.fromfile(self.staging_dir / "span_parents.bin", dtype="int32")
+            write_document_spans(segment_dir, span_vectors, span_parents)
+        writer = DiskSegmentWriter(segment_dir)
+        writer.add(chunks)
+        writer.close()
+        commit_segment(self.file_vector_dir, segment_dir)
+
+        if final:
+            elements_file = self.staging_dir / "elements.jsonl"
+            if elements_file.exists():
+                with open(elements_file, "r", encoding="utf-8") as f:
+                    elements = [json.loads(line) for line in f]
+                with open(self.file_vector_dir / "elements.json", "w", encoding="utf-8") as f:
+                    json.dump({"source": checkpoint["source"], "elements": elements, "page_sizes": checkpoint["page_sizes"]}, f, ensure_ascii=False)
+                shutil.copyfile(self.staging_dir / "document.md.part", self.file_vector_dir / "document.md")
+            shutil.rmtree(self.staging_dir)
+        return chunks
+
+    def run(self) -> Dict[str, Any]:
+        """执行入库，返回页数、分块数和耗时统计"""
+        t_start = time.time()
+        self.file_vector_dir.mkdir(parents=True, exist_ok=True)
+        checkpoint = self._load_checkpoint()
+        if checkpoint["page_count"] is None:
+            checkpoint["page_count"] = self._count_pages()
+            self._save_checkpoint(checkpoint)
+        page_count = checkpoint["page_count"]
+        uploaded_at = checkpoint["source"]["mtime"]
+
+        parsed_q = queue.Queue(maxsize=settings.INGEST_QUEUE_SIZE)
+        split_q = queue.Queue(maxsize=settings.INGEST_QUEUE_SIZE)
+        embedded_q = queue.Queue(maxsize=settings.INGEST_QUEUE_SIZE)
+        threads = [
+            threading.Thread(target=self._run_stage, args=(self._parse_stage, parsed_q, page_count, checkpoint["next_page"]), daemon=True),
+            threading.Thread(target=self._run_stage, args=(self._split_stage, parsed_q, split_q, page_count, checkpoint["chunker_state"]), daemon=True),
+            threading.Thread(target=self._run_stage, args=(self._embed_stage, split_q, embedded_q), daemon=True),
+        ]
+        for thread in threads:
+            thread.start()
+
+        time_to_first_searchable = None
+        try:
+            for batch in self._iter_queue(embedded_q):
+                self._write_batch(batch, checkpoint, uploaded_at)
+                self.progress_callback(5 + int(90 * min(batch["end"], page_count) / page_count))
+
+                # 周期性写出可检索的索引，大文档无需等到全部完成即可检索
+                if batch["end"] < page_count and checkpoint["chunk_count"] > 0 \
+                        and batch["end"] - checkpoint["flushed_page"] >= settings.INGEST_FLUSH_PAGES:
+                    self._write_outputs(checkpoint, final=False)
+                    checkpoint["flushed_page"] = batch["end"]
+                    self._save_checkpoint(checkpoint)
+                    self.flush_callback()
+                    if time_to_first_searchable is None:
+                        time_to_first_searchable = time.time() - t_start
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._error is not None:
+            raise self._error
+        if checkpoint["chunk_count"] == 0:
+            raise ValueError("PDF解析失败，未生成文档内容")
+
+        self._write_outputs(checkpoint, final=True)
+        total_time = time.time() - t_start
+        print(f"[Ingestion] 入库完成: {page_count} 页, {checkpoint['chunk_count']} 个分块, 总耗时 {total_time:.2f}秒")
+        return {
+            "page_count": page_count,
+            "chunk_count": checkpoint["chunk_count"],
+            "dimension": checkpoint["dimension"],
+            "time_to_first_searchable": time_to_first_searchable if time_to_first_searchable is not None else total_time,
+            "total_time": total_time
+        }
@@ -1,18 +1,19 @@
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, APIRouter, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from typing import List, Dict, Any
 import os
 import tempfile
 import json
-import shutil
 import hashlib
-import numpy as np
 from pathlib import Path
-from src.pdf_parsing import PDFParser
-from src.text_splitter import TextSplitter
 from src.questions_processing import QuestionProcessor
-from src.retrieval import Retrieval
+from src.retrieval import SearchFilter
+from src.ingestion import IngestionPipeline
+from src.catalog import DocumentCatalog, file_sha256, STATUS_VECTORIZING, STATUS_VECTORIZED, STATUS_FAILED
+from src.index_store import IndexStore, ProgressStore, publish, current_segment, remove_document, STATE_DB
+from src.answer_cache import answer_cache
+from src.outbound import scheduler
 from src.config import settings, pipeline_config
 
 app = FastAPI(title="RAG问答系统 API", version="1.0.0")
@@ -26,18 +27,56 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 问答接口与入库接口分别注册，可通过APP_ROLE拆分为独立部署的查询服务和入库服务
+# 查询服务不会加载Docling等PDF解析依赖
+query_router = APIRouter()
+ingest_router = APIRouter()
+
 # 挂载静态文件服务，用于提供上传的PDF文件访问
 app.mount("/uploads", StaticFiles(directory=str(pipeline_config.uploads_dir)), name="uploads")
 
 # 全局变量
-# 向量解析进度跟踪
-task_progress = {}
+# 向量解析进度跟踪，存放在SQLite中供多个worker共享
+task_progress = ProgressStore(pipeline_config.vector_store_dir / STATE_DB)
+# 只读索引缓存，按代数文件热加载
+index_store = IndexStore(pipeline_config.vector_store_dir)
+# 文档目录，文件列表与状态从SQLite读取，不再每次扫描文件系统
+catalog = DocumentCatalog(pipeline_config.vector_store_dir / STATE_DB, pipeline_config.uploads_dir, pipeline_config.vector_store_dir)
 
 # 从配置中获取路径
 vector_store_dir = str(pipeline_config.vector_store_dir)
 uploads_dir = str(pipeline_config.uploads_dir)
 
 
+@app.on_event("startup")
+def preload_indexes():
+    """启动时预加载索引，完成后才开始接收请求"""
+    if settings.PRELOAD_INDEXES and settings.APP_ROLE != "ingest":
+        index_store.preload()
+
+
+@app.on_event("startup")
+def start_catalog_reconciler():
+    """后台定期对账，发现绕过接口直接放入或删除的文件"""
+    catalog.start_reconciler()
+
+
+@app.on_event("shutdown")
+def stop_catalog_reconciler():
+    catalog.stop_reconciler()
+
+
+@app.on_event("startup")
+def start_index_compactor():
+    """后台合并小段并清理旧版本，由负责写入的服务执行"""
+    if settings.APP_ROLE != "query":
+        index_store.start_compactor()
+
+
+@app.on_event("shutdown")
+def stop_index_compactor():
+    index_store.stop_compactor()
+
 
 def get_file_vector_status(filename: str) -> Dict[str, Any]:
     """获取文件的向量状态"""
@@ -48,7 +87,7 @@ def get_file_vector_status(filename: str) -> Dict[str, Any]:
     # 使用文件名（不带扩展名）作为向量存储目录名
     file_name_without_ext = os.path.splitext(filename)[0]
     file_vector_dir = os.path.join(vector_store_dir, file_name_without_ext)
-    vectorized = os.path.exists(os.path.join(file_vector_dir, "chunks.json"))
+    vectorized = current_segment(Path(file_vector_dir)) is not None
     
     return {
         "status": "success",
@@ -58,9 +97,9 @@ def get_file_vector_status(filename: str) -> Dict[str, Any]:
     }
 
 
-@app.post("/api/upload-pdf")
-async def upload_pdf(file: UploadFile = File(...)):
-    """上传PDF文档"""
+@ingest_router.post("/api/upload-pdf")
+def upload_pdf(file: UploadFile = File(...)):
+    """上传PDF文档（同步接口，在线程池中执行，写文件、计算哈希和写SQLite不阻塞事件循环）"""
     try:
         # 确保上传目录存在
         pipeline_config.uploads_dir.mkdir(parents=True, exist_ok=True)
@@ -68,10 +107,17 @@ async def upload_pdf(file: UploadFile = File(...)):
         # 构建文件路径
         file_path = pipeline_config.uploads_dir / file.filename
         
-        # 保存上传的文件
+        # 保存上传的文件，分块写入的同时计算哈希
+        digest = hashlib.sha256()
+        size = 0
         with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+            for block in iter(lambda: file.file.read(1 << 20), b""):
+                digest.update(block)
+                f.write(block)
+                size += len(block)
+        
+        # 登记到文档目录
+        catalog.record_upload(file.filename, size, file_path.stat().st_mtime, digest.hexdigest())
         
         return {
             "status": "success",
@@ -85,36 +131,40 @@ async def upload_pdf(file: UploadFile = File(...)):
             "message": f"PDF上传失败: {str(e)}"
         }
 
-@app.get("/api/get-pdf-files")
-async def get_pdf_files():
-    """获取uploads文件夹中的PDF文件列表，包含向量状态"""
+@query_router.get("/api/get-pdf-files")
+def get_pdf_files(page: int = 1, page_size: int = 0):
+    """
+    获取PDF文件列表及向量状态，从文档目录读取，按修改时间倒序
+    :param page: 页码，从1开始
+    :param page_size: 每页数量，0表示返回全部
+    """
     try:
-        # 获取文件夹中的所有PDF文件
-        pdf_files = []
-        for filename in os.listdir(pipeline_config.uploads_dir):
-            if filename.lower().endswith(".pdf"):
-                file_path = pipeline_config.uploads_dir / filename
-                file_stats = file_path.stat()
-                
-                # 获取向量状态，使用文件名（不带扩展名）作为向量存储目录名
-                file_name_without_ext = os.path.splitext(filename)[0]
-                file_vector_dir = pipeline_config.vector_store_dir / file_name_without_ext
-                vectorized = (file_vector_dir / "chunks.json").exists()
-                
-                pdf_files.append({
-                    "filename": filename,
-                    "file_path": str(file_path),
-                    "size": file_stats.st_size,
-                    "mtime": file_stats.st_mtime,
-                    "vectorized": vectorized
-                })
-        
-        # 按修改时间排序，最新的在前
-        pdf_files.sort(key=lambda x: x["mtime"], reverse=True)
+        documents, total = catalog.list(page, page_size)
+        pdf_files = [
+            {
+                "filename": document["filename"],
+                "file_path": str(pipeline_config.uploads_dir / document["filename"]),
+                "size": document["size"],
+                "mtime": document["mtime"],
+                "sha256": document["sha256"],
+                "status": document["status"],
+                "vectorized": document["status"] == STATUS_VECTORIZED,
+                "page_count": document["page_count"],
+                "chunk_count": document["chunk_count"],
+                "version": document["version"],
+                # 向量维度与当前配置不一致的文档需要重新向量化
+                "dimension_mismatch": document["embedding_dimension"] is not None
+                    and document["embedding_dimension"] != settings.EMBEDDING_DIMENSION
+            }
+            for document in documents
+        ]
         
         return {
             "status": "success",
-            "files": pdf_files
+            "files": pdf_files,
+            "total": total,
+            "page": page,
+            "page_size": page_size
         }
     except Exception as e:
         return {
@@ -122,7 +172,7 @@ async def get_pdf_files():
             "message": f"获取文件列表失败: {str(e)}"
         }
 
-@app.post("/api/vectorize-pdf")
+@ingest_router.post("/api/vectorize-pdf")
 def vectorize_pdf(file_info: Dict[str, str]):
     """将PDF文件向量化并存储"""
     try:
@@ -161,112 +211,60 @@ def vectorize_pdf(file_info: Dict[str, str]):
         file_vector_dir.mkdir(parents=True, exist_ok=True)
         task_progress[filename] = 5
         
-        # --------------------------
-        # 1. 调用Docling API解析PDF生成document.md
-        # --------------------------
-        markdown_file = file_vector_dir / "document.md"
-        # 检查是否已存在document.md且不为空
-        if markdown_file.exists() and markdown_file.stat().st_size > 0:
-            print(f"步骤1: PDF {filename} 已存在document.md，跳过Docling解析...")
-            task_progress[filename] = 30
-        else:
-            print(f"步骤1: 调用Docling API解析PDF {filename} 生成document.md...")
-            parser = PDFParser()
-            task_progress[filename] = 10
-            
-            # 使用Docling解析PDF
-            # parse_pdf_by_docling方法内部已经处理了document.md的生成
-            pages = parser.parse_pdf_by_docling(str(file_path), output_dir=str(file_vector_dir))
-            
-            # 检查是否生成了document.md
-            if not markdown_file.exists() or markdown_file.stat().st_size == 0:
-                print(f"步骤1: Docling未生成document.md，解析失败")
-                task_progress[filename] = 0
-                return {
-                    "status": "error",
-                    "message": "PDF解析失败，未生成文档内容"
-                }
-            
-            task_progress[filename] = 40
+        # 未经上传接口放入（或在上传目录中被替换）的文件先登记到文档目录
+        row = catalog.get(filename)
+        file_stats = file_path.stat()
+        if row is None or row["size"] != file_stats.st_size or row["mtime"] != file_stats.st_mtime:
+            catalog.record_upload(filename, file_stats.st_size, file_stats.st_mtime, file_sha256(file_path))
+            row = catalog.get(filename)
+        catalog.set_status(filename, STATUS_VECTORIZING)
         
         # --------------------------
-        # 2. 从document.md解析并分块
+        # 解析、分块、向量化按页批次流水线执行
+        # 每累计一定页数就发布一次索引，大文档的前几页无需等待全部完成即可检索；
+        # 中途失败后重新向量化会从上次完成的页批次继续
         # --------------------------
-        print(f"步骤2: 从document.md解析并分块...")
-        task_progress[filename] = 45
-        
-        # 从document.md读取内容
-        with open(markdown_file, "r", encoding="utf-8") as f:
-            markdown_content = f.read()
-        
-        # 将markdown转换为pages格式，用于分块
-        # 检查是否包含"# Page "标记
-        pages = []
-        if "# Page " in markdown_content:
-            # 按"# Page "分割markdown内容
-            page_sections = markdown_content.split("# Page ")
-            for i, section in enumerate(page_sections[1:], 1):
-                # 提取页面内容
-                content = section.split("\n\n", 1)[1].strip() if "\n\n" in section else section.strip()
-                pages.append({
-                    "page_num": i,
-                    "content": content,
-                    "page_width": 0,
-                    "page_height": 0
-                })
-        else:
-            # 如果没有"# Page "标记，将整个文档作为一个页面
-            pages.append({
-                "page_num": 1,
-                "content": markdown_content,
-                "page_width": 0,
-                "page_height": 0
-            })
+        print(f"流水线入库: {filename}")
         
-        # 文本分块
-        splitter = TextSplitter()
-        chunks = splitter.split_document(pages)
-        
-        # 获取分块统计信息
-        stats = splitter.get_chunk_statistics(chunks)
-        print(f"分块统计: {stats}")
-        
-        # 保存切块数据到向量存储目录
-        chunks_file = file_vector_dir / "chunks.json"
-        with open(chunks_file, "w", encoding="utf-8") as f:
-            json.dump(chunks, f, ensure_ascii=False, indent=2)
-        
-        task_progress[filename] = 60
-        
-        # --------------------------
-        # 3. 从分块报告创建向量数据库
-        # --------------------------
-        print(f"步骤3: 为PDF {filename} 创建向量数据库...")
-        task_progress[filename] = 70
+        def on_progress(progress: int):
+            task_progress[filename] = progress
         
-        # 构建向量索引
-        retrieval = Retrieval()
-        retrieval.build_index(chunks)
-        task_progress[filename] = 90
+        def on_flush():
+            publish(pipeline_config.vector_store_dir)
         
-        # 保存向量和索引信息
-        vectors_file = file_vector_dir / "vectors.npy"
-        np.save(vectors_file, retrieval.vectors)
+        pipeline = IngestionPipeline(file_path, filename, file_vector_dir,
+                                     progress_callback=on_progress, flush_callback=on_flush)
+        result = pipeline.run()
+        print(f"入库统计: 首次可检索 {result['time_to_first_searchable']:.2f}秒, 总耗时 {result['total_time']:.2f}秒")
+        uploaded_at = file_path.stat().st_mtime
         
         # 保存文件元信息
         metadata = {
             "filename": filename,
             "file_path": str(file_path),
-            "page_count": len(pages),
-            "chunk_count": len(chunks),
+            "uploaded_at": uploaded_at,
+            # 记录源文件哈希，对账时据此判断向量是否对应当前上传的文件
+            "sha256": row["sha256"],
+            "page_count": result["page_count"],
+            "chunk_count": result["chunk_count"],
+            "vector_storage": settings.VECTOR_STORAGE,
+            # 记录向量维度，配置变化后可识别需要重新向量化的文档
+            "embedding_dimension": result["dimension"],
+            "search_dimension": settings.SEARCH_DIMENSION,
             "vectorized_at": json.dumps({"$date": "2024-01-13T00:00:00.000Z"}),
             "has_markdown": True,
             "has_chunks": True,
             "has_vectors": True
         }
         metadata_file = file_vector_dir / "metadata.json"
-        with open(metadata_file, "w", encoding="utf-8") as f:
+        tmp_metadata_file = file_vector_dir / "metadata.json.tmp"
+        with open(tmp_metadata_file, "w", encoding="utf-8") as f:
             json.dump(metadata, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_metadata_file, metadata_file)
+        
+        # 发布新的索引代数，通知所有worker热加载（各worker中涉及该文档的检索范围的答案缓存随版本变化失效）
+        publish(pipeline_config.vector_store_dir)
+        catalog.record_vectorized(filename, result["page_count"], result["chunk_count"], result["dimension"])
         
         # 完成进度
         task_progress[filename] = 100
@@ -274,8 +272,10 @@ def vectorize_pdf(file_info: Dict[str, str]):
         return {
             "status": "success",
             "message": "PDF向量化成功",
-            "page_count": len(pages),
-            "chunk_count": len(chunks),
+            "page_count": result["page_count"],
+            "chunk_count": result["chunk_count"],
+            "time_to_first_searchable": round(result["time_to_first_searchable"], 2),
+            "total_time": round(result["total_time"], 2),
             "steps": [
                 "PDF转markdown完成",
                 "报告分块完成",
@@ -288,13 +288,15 @@ def vectorize_pdf(file_info: Dict[str, str]):
         # 出错时清除进度
         if filename in task_progress:
             del task_progress[filename]
+        if filename:
+            catalog.set_status(filename, STATUS_FAILED)
         return {
             "status": "error",
             "message": f"PDF向量化失败: {str(e)}"
         }
 
-@app.get("/api/vectorize-progress/{filename}")
-async def get_vectorize_progress(filename: str):
+@ingest_router.get("/api/vectorize-progress/{filename}")
+def get_vectorize_progress(filename: str):
     """获取PDF向量化进度"""
     return {
         "status": "success",
@@ -302,12 +304,18 @@ async def get_vectorize_progress(filename: str):
         "progress": task_progress.get(filename, 0)
     }
 
-@app.post("/api/ask-question")
-async def ask_question(question: Dict[str, str]):
-    """处理用户问题，生成答案"""
+@query_router.post("/api/ask-question")
+def ask_question(question: Dict[str, Any]):
+    """
+    处理用户问题，生成答案
+    同步接口，在线程池中执行：模型调用在调度器中排队、限流重试时只阻塞当前线程，不阻塞事件循环
+    可选过滤参数：filenames（文档列表）、page_range（[起始页, 结束页]）、
+    uploaded_after / uploaded_before（时间戳或ISO日期）
+    """
     try:
         query = question.get("question", "")
         filename = question.get("filename", "")
+        search_filter = SearchFilter.from_request(question)
         
         if not query:
             return {
@@ -315,75 +323,50 @@ async def ask_question(question: Dict[str, str]):
                 "message": "问题不能为空"
             }
         
-        # 加载向量和切块数据
-        all_chunks = []
-        all_vectors = []
-        
-        if filename:
+        # 从共享索引缓存获取检索器（向量、FAISS索引与文本索引以mmap方式加载）
+        # 本次查询固定在同一个快照上，期间发布的新版本不影响本次检索
+        snapshot = index_store.snapshot()
+        if filename and search_filter is None:
             # 单文件检索，使用文件名（不带扩展名）作为向量存储目录名
             file_name_without_ext = os.path.splitext(filename)[0]
-            file_vector_dir = os.path.join(vector_store_dir, file_name_without_ext)
-            chunks_file = os.path.join(file_vector_dir, "chunks.json")
-            vectors_file = os.path.join(file_vector_dir, "vectors.npy")
+            retrieval = snapshot.retrieval(file_name_without_ext) if snapshot else None
             
-            if not os.path.exists(chunks_file):
+            if retrieval is None:
                 return {
                     "status": "error",
                     "message": "该文件尚未向量化，请先进行向量解析"
                 }
-            
-            # 加载单个文件的切块数据
-            with open(chunks_file, "r", encoding="utf-8") as f:
-                all_chunks = json.load(f)
-            
-            # 加载向量数据
-            if os.path.exists(vectors_file):
-                try:
-                    vectors = np.load(vectors_file)
-                    all_vectors.extend(vectors.tolist())
-                except Exception as e:
-                    print(f"加载向量文件失败 {vectors_file}: {e}")
         else:
-            # 全局检索，加载所有向量化文件的切块数据
-            vectorized_files = []
-            for dir_name in os.listdir(vector_store_dir):
-                file_vector_dir = os.path.join(vector_store_dir, dir_name)
-                chunks_file = os.path.join(file_vector_dir, "chunks.json")
-                if os.path.exists(chunks_file):
-                    vectorized_files.append(file_vector_dir)
+            # 全局检索，在快照中的全局合并段与各文档版本段上检索后合并，过滤条件在索引层面预过滤
+            if filename:
+                # 同时指定单个文件与文件列表时取交集：单文件只会缩小检索范围
+                if search_filter.filenames is not None and filename not in search_filter.filenames:
+                    return {
+                        "status": "error",
+                        "message": f"文件 {filename} 不在过滤的文件列表中"
+                    }
+                search_filter.filenames = [filename]
+            retrieval = snapshot.retrieval() if snapshot else None
             
-            if not vectorized_files:
+            if retrieval is None:
                 return {
                     "status": "error",
                     "message": "没有已向量化的文件，请先对文件进行向量解析"
                 }
-            
-            # 加载所有文件的切块数据
-            for file_vector_dir in vectorized_files:
-                chunks_file = os.path.join(file_vector_dir, "chunks.json")
-                vectors_file = os.path.join(file_vector_dir, "vectors.npy")
-                
-                with open(chunks_file, "r", encoding="utf-8") as f:
-                    chunks = json.load(f)
-                    all_chunks.extend(chunks)
-                
-                # 加载向量数据
-                if os.path.exists(vectors_file):
-                    try:
-                        vectors = np.load(vectors_file)
-                        all_vectors.extend(vectors.tolist())
-                    except Exception as e:
-                        print(f"加载向量文件失败 {vectors_file}: {e}")
         
-        # 确保向量数量与chunks数量一致，否则不使用预计算向量
-        if len(all_vectors) != len(all_chunks):
-            print(f"警告: 向量数量 ({len(all_vectors)}) 与 Chunks 数量 ({len(all_chunks)}) 不一致，将重新计算向量")
-            all_vectors = None
+        # 答案缓存按检索范围隔离，版本为该范围覆盖的文档段，其他文档的变化不影响本范围的缓存
+        cache_scope = f"{filename if search_filter is None else ''}|{search_filter.cache_key() if search_filter else ''}"
+        if search_filter is None:
+            cache_version = snapshot.version(os.path.splitext(filename)[0])
+        else:
+            cache_version = snapshot.version(filenames=search_filter.filenames)
         
         # 处理问题
         processor = QuestionProcessor()
-        # 传入预计算的向量
-        answer = processor.process_question(query, all_chunks, all_vectors)
+        answer = processor.process_question(
+            query, retrieval.chunks, retrieval=retrieval, search_filter=search_filter,
+            cache_scope=cache_scope, cache_version=cache_version
+        )
         
         return {
             "status": "success",
@@ -398,8 +381,8 @@ async def ask_question(question: Dict[str, str]):
             "message": f"处理问题失败: {str(e)}"
         }
 
-@app.delete("/api/delete-file/{filename}")
-async def delete_file(filename: str):
+@ingest_router.delete("/api/delete-file/{filename}")
+def delete_file(filename: str):
     """删除文件及其相关数据"""
     try:
         # 1. 删除上传的文件
@@ -407,15 +390,17 @@ async def delete_file(filename: str):
         if file_path.exists():
             os.remove(file_path)
             
-        # 2. 删除向量存储目录
+        # 2. 标记向量存储目录已删除，段目录在不再被快照引用后由后台清理
         file_name_without_ext = os.path.splitext(filename)[0]
         file_vector_dir = pipeline_config.vector_store_dir / file_name_without_ext
         if file_vector_dir.exists():
-            shutil.rmtree(file_vector_dir)
+            remove_document(file_vector_dir)
+            publish(pipeline_config.vector_store_dir)
             
-        # 3. 清除进度信息
+        # 3. 清除进度信息和目录记录
         if filename in task_progress:
             del task_progress[filename]
+        catalog.remove(filename)
             
         return {
             "status": "success",
@@ -432,9 +417,17 @@ async def get_status():
     """获取系统状态"""
     # 简单的状态检查，不再依赖processed_chunks全局变量
     return {
-        "status": "running"
+        "status": "running",
+        "outbound": scheduler.get_metrics(),
+        "answer_cache": answer_cache.get_stats()
     }
 
+if settings.APP_ROLE in ("all", "query"):
+    app.include_router(query_router)
+if settings.APP_ROLE in ("all", "ingest"):
+    app.include_router(ingest_router)
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # 多worker模式需要以导入字符串的方式传入应用
+    uvicorn.run("src.main:app", host="0.0.0.0", port=8000, workers=settings.WORKERS)
@@ -0,0 +1,252 @@
+import time
+import heapq
+import random
+import threading
+from collections import deque
+from typing import Any, Callable, Dict
+from src.config import settings
+
+# 优先级：数值越小越优先，交互式问答优先于批量向量化
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk"}
+
+# 可重试的HTTP状态码（限流与服务端错误）
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class OutboundError(Exception):
+    """模型调用失败（重试耗尽或不可重试的错误）"""
+
+
+class OutboundQueueFull(OutboundError):
+    """等待队列已满，调用方需要稍后重试"""
+
+
+_dashscope = None
+
+
+def get_dashscope():
+    """延迟导入dashscope SDK（导入耗时数百毫秒），首次使用时设置API Key"""
+    global _dashscope
+    if _dashscope is None:
+        import dashscope
+        dashscope.api_key = settings.DASHSCOPE_API_KEY
+        _dashscope = dashscope
+    return _dashscope
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估计token数（中文约每字一个token），实际用量在响应返回后校正"""
+    return max(len(text), 1)
+
+
+class TokenBucket:
+    """
+    令牌桶，按每分钟限额匀速补充
+    容量只允许 OUTBOUND_BURST_SECONDS 秒的突发量：若容量为整分钟限额，
+    任意60秒滑动窗口内最多可能发出两倍限额的请求，会触发服务端限流
+    """
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate * settings.OUTBOUND_BURST_SECONDS, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """距离可以取出amount个令牌还需等待的秒数，超过容量的请求按容量计算"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, amount: float):
+        """按实际用量校正（正数补扣，负数返还）"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class ModelLimiter:
+    """
+    单个模型的限流状态：请求数令牌桶、token令牌桶、并发数和按优先级排序的等待队列
+    配额是账号级别的，多worker部署时按worker数平分
+    任一限额不大于0时视为该模型已停用，调用直接被拒绝
+    """
+    def __init__(self, model: str, limits: Dict[str, int]):
+        self.model = model
+        workers = max(settings.WORKERS, 1)
+        rpm = limits.get("rpm", settings.OUTBOUND_DEFAULT_RPM)
+        tpm = limits.get("tpm", settings.OUTBOUND_DEFAULT_TPM)
+        self.max_concurrency = limits.get("concurrency", settings.OUTBOUND_MAX_CONCURRENCY)
+        self.disabled = min(rpm, tpm, self.max_concurrency) <= 0
+        if self.disabled:
+            print(f"[Outbound] 模型 {model} 的限额 rpm={rpm} tpm={tpm} concurrency={self.max_concurrency} 不大于0，调用将被拒绝")
+        self.requests = TokenBucket(max(rpm, 0) / workers)
+        self.tokens = TokenBucket(max(tpm, 0) / workers)
+        self.in_flight = 0
+        self.waiting = []  # 堆: (priority, seq)
+        # 指标
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "rejected": 0, "tokens": 0}
+        self.queue_waits = {name: deque(maxlen=1000) for name in PRIORITY_NAMES.values()}
+
+
+class OutboundScheduler:
+    """
+    统一的模型调用调度器
+    所有对DashScope的调用都经过这里：按模型限制RPM/TPM与并发，交互式请求优先出队，
+    等待队列有上限（满时阻塞调用方形成背压，超时则拒绝），失败时指数退避加抖动重试
+    限流只按模型划分：服务只使用一个DashScope账号，配额按账号和模型计算，请求中也没有租户标识
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._limiters: Dict[str, ModelLimiter] = {}
+        self._seq = 0
+
+    def _limiter(self, model: str) -> ModelLimiter:
+        if model not in self._limiters:
+            self._limiters[model] = ModelLimiter(model, settings.MODEL_RATE_LIMITS.get(model, {}))
+        return self._limiters[model]
+
+    def _acquire(self, limiter: ModelLimiter, tokens: int, priority: int, seq: int) -> float:
+        """
+        进入等待队列，在队首且配额充足时出队，返回排队耗时（需持有 self._cond）
+        队列已满时阻塞等待（背压），超时后拒绝；检查容量与入队在同一临界区内完成，并发调用和重试都不会超过上限
+        """
+        t0 = time.monotonic()
+        deadline = t0 + settings.OUTBOUND_QUEUE_TIMEOUT
+        while len(limiter.waiting) >= settings.OUTBOUND_QUEUE_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                limiter.stats["rejected"] += 1
+                raise OutboundQueueFull(f"{limiter.model} 等待队列已满")
+            self._cond.wait(timeout=remaining)
+        heapq.heappush(limiter.waiting, (priority, seq))
+        self._cond.notify_all()
+        try:
+            while True:
+                if limiter.waiting[0] == (priority, seq) and limiter.in_flight < limiter.max_concurrency:
+                    wait = max(limiter.requests.wait_time(1), limiter.tokens.wait_time(tokens))
+                    if wait == 0:
+                        break
+                    self._cond.wait(timeout=wait)
+                else:
+                    self._cond.wait(timeout=1.0)
+        except BaseException:
+            limiter.waiting.remove((priority, seq))
+            heapq.heapify(limiter.waiting)
+            self._cond.notify_all()
+            raise
+        heapq.heappop(limiter.waiting)
+        limiter.requests.consume(1)
+        limiter.tokens.consume(tokens)
+        limiter.in_flight += 1
+        self._cond.notify_all()
+        return time.monotonic() - t0
+
+    def _release(self, limiter: ModelLimiter):
+        with self._cond:
+            limiter.in_flight -= 1
+            self._cond.notify_all()
+
+    def submit(self, model: str, fn: Callable[[], Any], tokens: int = 1, priority: int = PRIORITY_INTERACTIVE) -> Any:
+        """
+        经调度器调用模型
+        :param model: 模型名称，用于选择限流配置
+        :param fn: 实际发起调用的函数，返回DashScope响应
+        :param tokens: 预估token用量，响应返回后按usage校正
+        :param priority: PRIORITY_INTERACTIVE 或 PRIORITY_BULK
+        """
+        with self._cond:
+            limiter = self._limiter(model)
+            if limiter.disabled:
+                limiter.stats["rejected"] += 1
+                raise OutboundError(f"{model} 已停用（限额不大于0）")
+            self._seq += 1
+            seq = self._seq
+
+        last_error = None
+        for attempt in range(settings.OUTBOUND_MAX_RETRIES + 1):
+            with self._cond:
+                queue_wait = self._acquire(limiter, tokens, priority, seq)
+                limiter.queue_waits[PRIORITY_NAMES[priority]].append(queue_wait)
+                limiter.stats["requests"] += 1
+            try:
+                response = fn()
+            except Exception as e:
+                # 网络异常视为可重试
+                response, last_error = None, e
+            finally:
+                self._release(limiter)
+
+            if response is not None:
+                status_code = getattr(response, "status_code", 200)
+                if status_code == 200:
+                    self._record_usage(limiter, response, tokens)
+                    return response
+                code = getattr(response, "code", "")
+                last_error = OutboundError(f"{model} 调用失败 [{status_code}] {code}: {getattr(response, 'message', '')}")
+                if status_code not in RETRYABLE_STATUS and not str(code).startswith("Throttling"):
+                    break
+
+            if attempt < settings.OUTBOUND_MAX_RETRIES:
+                with self._cond:
+                    limiter.stats["retries"] += 1
+                # 指数退避 + 完全抖动，避免多个调用方同时重试
+                backoff = min(settings.OUTBOUND_BACKOFF_MAX, settings.OUTBOUND_BACKOFF_BASE * 2 ** attempt)
+                time.sleep(random.uniform(0, backoff))
+
+        with self._cond:
+            limiter.stats["failures"] += 1
+        if isinstance(last_error, OutboundError):
+            raise last_error
+        raise OutboundError(f"{model} 调用失败: {last_error}") from last_error
+
+    def _record_usage(self, limiter: ModelLimiter, response: Any, estimated: int):
+        """按响应中的实际token用量校正令牌桶"""
+        usage = getattr(response, "usage", None) or {}
+        try:
+            actual = usage.get("total_tokens") or (usage.get("input_tokens", 0) + usage.get("output_tokens", 0))
+        except AttributeError:
+            actual = 0
+        with self._cond:
+            if actual:
+                limiter.tokens.adjust(actual - estimated)
+            limiter.stats["tokens"] += actual or estimated
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """各模型的调用统计与排队耗时（毫秒）"""
+        metrics = {}
+        with self._cond:
+            for model, limiter in self._limiters.items():
+                queue_wait = {}
+                for name, waits in limiter.queue_waits.items():
+                    if not waits:
+                        continue
+                    ordered = sorted(waits)
+                    queue_wait[name] = {
+                        "count": len(ordered),
+                        "avg_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+                        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2),
+                        "max_ms": round(ordered[-1] * 1000, 2)
+                    }
+                metrics[model] = {
+                    **limiter.stats,
+                    "in_flight": limiter.in_flight,
+                    "queued": len(limiter.waiting),
+                    "queue_wait": queue_wait
+                }
+        return metrics
+
+
+# 进程内单例，所有模块共享
+scheduler = OutboundScheduler()
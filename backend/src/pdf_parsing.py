@@ -1,58 +1,108 @@
-import os
-from typing import List, Dict, Optional
-from docling.document_converter import DocumentConverter, PdfFormatOption
-from docling.datamodel.pipeline_options import PdfPipelineOptions
-from docling.datamodel.base_models import InputFormat
+import threading
+from typing import List, Dict, Optional, Tuple
+
+# Docling及其模型栈导入和初始化都很慢，只在首次解析PDF时加载，并在进程内复用同一个转换器
+_converter = None
+_converter_lock = threading.Lock()
+
+def get_converter():
+    """获取进程内共享的Docling转换器（延迟创建）"""
+    global _converter
+    if _converter is None:
+        with _converter_lock:
+            if _converter is None:
+                from docling.document_converter import DocumentConverter, PdfFormatOption
+                from docling.datamodel.pipeline_options import PdfPipelineOptions
+                from docling.datamodel.base_models import InputFormat
+                
+                # 配置 Docling 禁用 OCR，避免下载模型失败
+                pipeline_options = PdfPipelineOptions()
+                pipeline_options.do_ocr = False
+                pipeline_options.do_table_structure = True
+                
+                _converter = DocumentConverter(
+                    format_options={
+                        InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
+                    }
+                )
+    return _converter
 
 class PDFParser:
 
     @staticmethod
-    def parse_pdf_by_docling(file_path: str, output_dir: Optional[str] = None) -> List[Dict[str, any]]:
-        """使用Docling解析PDF文档"""
-        try:
-            print(f"正在使用Docling解析PDF: {file_path}")
-            
-            # 配置 Docling 禁用 OCR，避免下载模型失败
-            pipeline_options = PdfPipelineOptions()
-            pipeline_options.do_ocr = False
-            pipeline_options.do_table_structure = True
-            
-            converter = DocumentConverter(
-                format_options={
-                    InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
-                }
-            )
-            
-            result = converter.convert(file_path)
-            
-            # 输出为 Markdown
-            markdown_content = result.document.export_to_markdown()
+    def extract_elements(document) -> List[Dict[str, any]]:
+        """
+        遍历Docling文档树，提取按阅读顺序排列的结构化元素
+        每个元素包含类型(heading/text/list/table)、文本、标题层级和真实页码
+        """
+        from docling_core.types.doc import SectionHeaderItem, TitleItem, TableItem, ListItem, TextItem
+        
+        elements = []
+        for item, _ in document.iterate_items():
+            page_num = item.prov[0].page_no if getattr(item, "prov", None) else None
             
-            # 如果指定了输出目录，保存 document.md
-            if output_dir:
-                md_file = os.path.join(output_dir, "document.md")
-                with open(md_file, "w", encoding="utf-8") as f:
-                    f.write(markdown_content)
-                print(f"Docling解析完成，已保存至: {md_file}")
+            if isinstance(item, TableItem):
+                # 表格整体导出为Markdown，保证分块时不被拆开
+                element = {"type": "table", "text": item.export_to_markdown(doc=document), "level": 0}
+            elif isinstance(item, TitleItem):
+                element = {"type": "heading", "text": item.text, "level": 1}
+            elif isinstance(item, SectionHeaderItem):
+                # Docling的章节层级从1开始，标题(Title)占用第1级
+                element = {"type": "heading", "text": item.text, "level": item.level + 1}
+            elif isinstance(item, ListItem):
+                element = {"type": "list", "text": f"- {item.text}", "level": 0}
+            elif isinstance(item, TextItem):
+                element = {"type": "text", "text": item.text, "level": 0}
+            else:
+                # 图片等不含文本的元素跳过
+                continue
             
-            # 将 Markdown 内容简单包装为 page 结构
-            # Docling 的 Markdown 输出是整篇文档，这里暂时作为一个大页面处理
-            # 或者如果有分页符，可以尝试分割
-            pages = []
-            
-            # 简单的分页尝试（Docling markdown 可能不包含明确的分页符）
-            # 这里为了兼容后续流程，先整体作为一个页面
-            pages.append({
-                "page_num": 1,
-                "content": markdown_content,
-                "page_width": 0,
-                "page_height": 0
-            })
-                
-            return pages
+            if not element["text"] or not element["text"].strip():
+                continue
+            element["page_num"] = page_num or (elements[-1]["page_num"] if elements else 1)
+            elements.append(element)
+        
+        return elements
+
+    @staticmethod
+    def group_pages(elements: List[Dict[str, any]], page_sizes: Optional[Dict[int, Dict[str, float]]] = None) -> List[Dict[str, any]]:
+        """将结构化元素按真实页码聚合为page结构"""
+        page_sizes = page_sizes or {}
+        contents = {}
+        for element in elements:
+            contents.setdefault(element["page_num"], []).append(element["text"])
+        
+        return [
+            {
+                "page_num": page_num,
+                "content": "\n\n".join(texts),
+                "page_width": page_sizes.get(page_num, {}).get("width", 0),
+                "page_height": page_sizes.get(page_num, {}).get("height", 0)
+            }
+            for page_num, texts in sorted(contents.items())
+        ]
 
-        except Exception as e:
-            print(f"使用Docling解析PDF失败: {e}")
-            import traceback
-            traceback.print_exc()
-            return []
+    @staticmethod
+    def get_page_count(file_path: str) -> int:
+        """读取PDF页数（pypdfium2为Docling的依赖）"""
+        import pypdfium2
+        pdf = pypdfium2.PdfDocument(file_path)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+    @staticmethod
+    def parse_pages(file_path: str, start_page: int, end_page: int) -> Tuple[List[Dict[str, any]], str, Dict[int, Dict[str, float]]]:
+        """
+        只解析 [start_page, end_page] 页，供流水线按页批次解析
+        :return: (结构化元素, 该批次的Markdown, 页面尺寸)
+        """
+        result = get_converter().convert(file_path, page_range=(start_page, end_page))
+        document = result.document
+        elements = PDFParser.extract_elements(document)
+        page_sizes = {
+            page_no: {"width": page.size.width, "height": page.size.height}
+            for page_no, page in document.pages.items()
+        }
+        return elements, document.export_to_markdown(), page_sizes
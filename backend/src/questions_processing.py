@@ -1,18 +1,29 @@
 from typing import Dict, List, Optional
-import dashscope
 import time
 from src.config import settings
-from src.retrieval import Retrieval
+from src.outbound import scheduler, estimate_tokens, get_dashscope
+from src.retrieval import Retrieval, SearchFilter
 from src.reranking import Reranking
+from src.answer_cache import answer_cache
+
+# 生成失败时返回的提示，此类答案不写入缓存
+ANSWER_ERROR_TEXT = "生成答案时发生错误"
 
 class QuestionProcessor:
     def __init__(self):
-        dashscope.api_key = settings.DASHSCOPE_API_KEY
         self.retrieval = Retrieval()
         self.reranking = Reranking()
     
-    def process_question(self, query: str, chunks: List[Dict[str, any]], vectors: Optional[List[List[float]]] = None) -> Dict[str, any]:
-        """处理用户问题，生成结构化答案"""
+    def process_question(self, query: str, chunks: List[Dict[str, any]], vectors: Optional[List[List[float]]] = None,
+                         retrieval: Optional[Retrieval] = None, search_filter: Optional[SearchFilter] = None,
+                         cache_scope: Optional[str] = None, cache_version: str = "") -> Dict[str, any]:
+        """
+        处理用户问题，生成结构化答案
+        :param retrieval: 已加载索引的检索器（来自IndexStore），提供时跳过索引构建
+        :param search_filter: 检索过滤条件（文档列表、页码范围、上传时间范围）
+        :param cache_scope: 语义答案缓存的检索范围标识，为空时不使用缓存
+        :param cache_version: 检索范围内的文档版本（见 Snapshot.version），变化后该范围的缓存失效
+        """
         start_total = time.time()
         print(f"----- 开始处理问题: {query} -----")
         
@@ -20,19 +31,44 @@ class QuestionProcessor:
 
         # 1. 构建检索索引
         t0 = time.time()
-        self.retrieval.build_index(chunks, vectors)
+        if retrieval is not None:
+            self.retrieval = retrieval
+        else:
+            self.retrieval.build_index(chunks, vectors)
         timing["index_build"] = time.time() - t0
         print(f"[Timing] 步骤1: 构建索引耗时 {timing['index_build']:.4f}秒 (Chunks数量: {len(chunks)})")
         
-        # 2. 混合检索
+        # 2. 查询语义答案缓存，近似问题直接返回已有答案
+        query_embedding = None
+        use_cache = settings.ANSWER_CACHE_ENABLED and cache_scope is not None
+        if use_cache:
+            t_cache = time.time()
+            query_embedding = self.retrieval.get_embedding(query)
+            hit = answer_cache.lookup(cache_scope, cache_version, query_embedding)
+            timing["cache_lookup"] = time.time() - t_cache
+            if hit is not None:
+                answer, similarity = hit
+                timing["total"] = time.time() - start_total
+                print(f"----- 命中答案缓存(相似度 {similarity:.4f})，总耗时: {timing['total']:.4f}秒 -----")
+                answer["cache"] = {"hit": True, "similarity": similarity}
+                answer["timing"] = timing
+                return answer
+        
+        # 混合检索
         t1 = time.time()
-        retrieved_chunks = self.retrieval.hybrid_search(query)
+        retrieved_chunks = self.retrieval.hybrid_search(query, search_filter=search_filter, query_embedding=query_embedding)
         timing["retrieval"] = time.time() - t1
         print(f"[Timing] 步骤2: 混合检索耗时 {timing['retrieval']:.4f}秒")
         
-        # 3. 暂时跳过重排序，直接使用检索结果
-        # reranked_chunks = self.reranking.rerank(query, retrieved_chunks)
-        print(f"[Timing] 步骤3: 重排序已跳过")
+        # 3. 重排序（分窗口并发，超过截止时间时使用已有的最佳排序）
+        rerank_report = None
+        if settings.RERANK_ENABLED:
+            t_rerank = time.time()
+            retrieved_chunks, rerank_report = self.reranking.rerank_with_report(query, retrieved_chunks)
+            timing["rerank"] = time.time() - t_rerank
+            print(f"[Timing] 步骤3: 重排序耗时 {timing['rerank']:.4f}秒 (提前结束: {rerank_report['early_exit']}, 超时: {rerank_report['deadline_exceeded']})")
+        else:
+            print(f"[Timing] 步骤3: 重排序已跳过")
         
         # 4. 生成结构化答案
         t2 = time.time()
@@ -44,15 +80,25 @@ class QuestionProcessor:
         timing["total"] = total_time
         print(f"----- 处理完成，总耗时: {total_time:.4f}秒 -----")
         
+        if use_cache and answer.get("finalAnswer") != ANSWER_ERROR_TEXT:
+            answer_cache.store(cache_scope, cache_version, query_embedding, answer)
+        
         # 将耗时信息添加到答案中
+        if use_cache:
+            answer["cache"] = {"hit": False}
         answer["timing"] = timing
+        if rerank_report is not None:
+            answer["rerank"] = rerank_report
         
         return answer
     
     def generate_structured_answer(self, query: str, chunks: List[Dict[str, any]]) -> Dict[str, any]:
         """生成结构化答案"""
         # 构建上下文
-        context = "\n\n".join([f"相关内容 {i+1} (第{chunk['page_num']}页): {chunk['content']}" for i, chunk in enumerate(chunks)])
+        context = "\n\n".join([
+            f"相关内容 {i+1} (第{chunk['page_num']}页{'，章节: ' + ' > '.join(chunk['section_path']) if chunk.get('section_path') else ''}): {chunk['content']}"
+            for i, chunk in enumerate(chunks)
+        ])
         
         # 构建提示词
         messages = [
@@ -68,11 +114,15 @@ class QuestionProcessor:
         
         try:
             print("[Timing] 开始调用LLM生成答案...")
-            response = dashscope.Generation.call(
-                model=settings.LLM_MODEL,
-                messages=messages,
-                temperature=0.1,
-                top_p=0.8
+            response = scheduler.submit(
+                settings.LLM_MODEL,
+                lambda: get_dashscope().Generation.call(
+                    model=settings.LLM_MODEL,
+                    messages=messages,
+                    temperature=0.1,
+                    top_p=0.8
+                ),
+                tokens=estimate_tokens(messages[0]["content"] + messages[1]["content"])
             )
             
             answer_text = response.output['text'].strip()
@@ -84,10 +134,10 @@ class QuestionProcessor:
         except Exception as e:
             print(f"生成答案失败: {e}")
             return {
-                "stepByStepReasoning": "生成答案时发生错误",
-                "reasoningSummary": "生成答案时发生错误",
+                "stepByStepReasoning": ANSWER_ERROR_TEXT,
+                "reasoningSummary": ANSWER_ERROR_TEXT,
                 "relatedPages": [],
-                "finalAnswer": "生成答案时发生错误"
+                "finalAnswer": ANSWER_ERROR_TEXT
             }
     
     def parse_structured_answer(self, answer_text: str, chunks: List[Dict[str, any]]) -> Dict[str, any]:
@@ -124,7 +174,7 @@ class QuestionProcessor:
             final_answer = answer_text
         
         # 提取相关页面列表
-        page_nums = sorted(list(set([chunk['page_num'] for chunk in chunks])))
+        page_nums = sorted(list(set([page for chunk in chunks for page in chunk.get('pages', [chunk['page_num']])])))
         
         return {
             "stepByStepReasoning": step_reasoning,
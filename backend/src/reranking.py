@@ -1,62 +1,163 @@
-from typing import List, Dict
-import dashscope
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Tuple, Any
 from src.config import settings
+from src.outbound import scheduler, estimate_tokens, get_dashscope
+
+# 解析 "编号: 分数" 形式的打分结果，允许中英文冒号、等号或空白分隔，输出被截断时已完成的行仍然有效
+SCORE_PATTERN = re.compile(r"\[?(\d+)\]?\s*[:：=]\s*(\d+(?:\.\d+)?)")
+MAX_SCORE = 10.0
 
 class Reranking:
-    def __init__(self):
-        dashscope.api_key = settings.DASHSCOPE_API_KEY
-    
-    def rerank(self, query: str, chunks: List[Dict[str, any]], top_k: int = None) -> List[Dict[str, any]]:
-        """使用LLM对检索结果进行重排序"""
-        if not chunks:
-            return []
-        
-        top_k = top_k or settings.RERANK_TOP_K
-        
-        # 构建文本块内容
-        chunks_text = chr(10).join([f"{i}. {chunk['content'][:200]}..." for i, chunk in enumerate(chunks)])
-        
-        # 构建重排序请求
+    """
+    分窗口并发的LLM重排序
+    候选按检索顺序切分为多个窗口，每个窗口单独请求LLM为窗口内的候选打分（0-10），窗口之间并发执行；
+    每完成一个窗口就更新当前排序，top_k全部已打分且之后连续 RERANK_STABLE_WINDOWS 个完成的窗口都没有改变top_k时提前结束，
+    超过截止时间时返回已有的最佳排序；未被打分的候选（窗口未完成或解析失败）排在已打分的候选之后，按检索顺序排列
+    提前结束或超时后，尚未发起LLM请求的窗口不再请求；已发起的请求无法撤回，报告中标记为abandoned，仍会占用调度器配额
+    """
+    def _score_window(self, query: str, window: List[Dict[str, any]]) -> Dict[int, float]:
+        """请求LLM为一个窗口内的候选打分，返回 {窗口内编号: 0-1得分}"""
+        chunks_text = "\n\n".join(
+            f"[{i}] {chunk['content'][:settings.RERANK_SNIPPET_CHARS]}" for i, chunk in enumerate(window)
+        )
         messages = [
             {
                 "role": "system",
-                "content": "你是一个专业的重排序助手，请根据查询与文本块的相关性对文本块进行排序，最相关的排在前面。请返回排序后的文本块索引，用逗号分隔，例如：2,0,1"
+                "content": "你是一个专业的重排序助手，请评估每个文本块与查询的相关性，给出0到10的分数（10表示最相关）。"
+                           "每行输出一个结果，格式为 编号: 分数，例如：\n0: 8\n1: 3\n不要输出其他内容。"
             },
             {
                 "role": "user",
-                "content": f"查询：{query}\n\n文本块：\n{chunks_text}\n\n请返回排序后的索引，用逗号分隔："
+                "content": f"查询：{query}\n\n文本块：\n{chunks_text}\n\n请逐行输出每个文本块的分数："
             }
         ]
-        
-        try:
-            response = dashscope.Generation.call(
+        response = scheduler.submit(
+            settings.LLM_MODEL,
+            lambda: get_dashscope().Generation.call(
                 model=settings.LLM_MODEL,
                 messages=messages,
                 temperature=0.0,
                 top_p=0.0
-            )
-            
-            # 解析重排序结果
-            rerank_result = response.output['text'].strip()
-            # 提取索引
-            indices = [int(idx.strip()) for idx in rerank_result.split(',') if idx.strip().isdigit()]
-            
-            # 确保索引有效
-            valid_indices = [idx for idx in indices if 0 <= idx < len(chunks)]
-            
-            # 构建重排序后的结果
-            reranked_chunks = [chunks[idx] for idx in valid_indices]
-            
-            # 如果重排序结果不足，补充原始结果
-            if len(reranked_chunks) < top_k:
-                original_indices = set(range(len(chunks)))
-                used_indices = set(valid_indices)
-                remaining_indices = list(original_indices - used_indices)
-                for idx in remaining_indices[:top_k - len(reranked_chunks)]:
-                    reranked_chunks.append(chunks[idx])
-            
-            return reranked_chunks[:top_k]
-        except Exception as e:
-            print(f"重排序失败: {e}")
-            # 失败时返回原始结果的前top_k个
-            return chunks[:top_k]
+            ),
+            tokens=estimate_tokens(messages[0]["content"] + messages[1]["content"])
+        )
+
+        scores = {}
+        for idx, score in SCORE_PATTERN.findall(response.output['text']):
+            idx = int(idx)
+            if 0 <= idx < len(window) and idx not in scores:
+                scores[idx] = min(float(score), MAX_SCORE) / MAX_SCORE
+        return scores
+
+    def _run_window(self, query: str, window: List[Dict[str, any]], window_id: int, started: Dict[int, float],
+                    cancelled: threading.Event, lock: threading.Lock) -> Dict[int, float]:
+        """
+        在线程池中执行一个窗口，记录实际开始时间，用于区分排队等待与LLM调用耗时
+        已提前结束或超时的重排序不再发起请求
+        """
+        with lock:
+            if cancelled.is_set():
+                return {}
+            started[window_id] = time.time()
+        return self._score_window(query, window)
+
+    @staticmethod
+    def _ranking(count: int, scores: Dict[int, float]) -> List[int]:
+        """按LLM得分降序排列候选下标，未打分的候选排在最后并保持检索顺序"""
+        return sorted(range(count), key=lambda i: (i not in scores, -scores.get(i, 0.0), i))
+
+    @staticmethod
+    def _window_timing(window_id: int, members: List[int], submitted: float, started: Dict[int, float]) -> Dict[str, Any]:
+        """窗口的排队等待时间与执行时间（尚未开始执行的窗口执行时间为0）"""
+        now = time.time()
+        start = started.get(window_id, now)
+        return {
+            "window": window_id,
+            "size": len(members),
+            "queue_wait": round(start - submitted, 4),
+            "elapsed": round(now - start, 4)
+        }
+
+    def rerank_with_report(self, query: str, chunks: List[Dict[str, any]], top_k: int = None) -> Tuple[List[Dict[str, any]], Dict[str, Any]]:
+        """
+        分窗口并发重排序
+        :return: (重排后的前top_k个chunk, 报告)，报告包含每个窗口的排队时间、执行耗时与状态、是否提前结束或超时
+        """
+        top_k = top_k or settings.RERANK_TOP_K
+        report = {"windows": [], "early_exit": False, "deadline_exceeded": False, "total": 0.0}
+        if not chunks:
+            return [], report
+
+        t_start = time.time()
+        deadline = t_start + settings.RERANK_DEADLINE
+        window_size = max(settings.RERANK_WINDOW_SIZE, 1)
+        scores: Dict[int, float] = {}
+        windows = [list(range(start, min(start + window_size, len(chunks)))) for start in range(0, len(chunks), window_size)]
+
+        executor = ThreadPoolExecutor(max_workers=max(settings.RERANK_CONCURRENCY, 1))
+        futures = {}
+        # 窗口开始执行（发起LLM请求）的时间，超过并发数的窗口在线程池中排队
+        started: Dict[int, float] = {}
+        cancelled, lock = threading.Event(), threading.Lock()
+        for window_id, members in enumerate(windows):
+            submitted = time.time()
+            future = executor.submit(self._run_window, query, [chunks[i] for i in members], window_id, started, cancelled, lock)
+            futures[future] = (window_id, members, submitted)
+
+        pending = set(futures)
+        ranking = self._ranking(len(chunks), scores)
+        stable = 0
+        try:
+            while pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    report["deadline_exceeded"] = True
+                    break
+                done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window_id, members, submitted = futures[future]
+                    entry = self._window_timing(window_id, members, submitted, started)
+                    try:
+                        window_scores = future.result()
+                        scores.update({members[i]: score for i, score in window_scores.items()})
+                        entry.update(status="ok", scored=len(window_scores))
+                    except Exception as e:
+                        print(f"重排序窗口 {window_id} 失败: {e}")
+                        entry.update(status="failed", scored=0)
+                    report["windows"].append(entry)
+                    print(f"[Timing] 重排序窗口 {window_id}: 排队 {entry['queue_wait']:.4f}秒, 执行 {entry['elapsed']:.4f}秒, 打分 {entry['scored']}/{len(members)}")
+
+                    # 按完成的窗口计数：top_k全部已打分且连续多个窗口没有改变top_k时，剩余窗口不再等待
+                    new_ranking = self._ranking(len(chunks), scores)
+                    confirmed = all(i in scores for i in new_ranking[:top_k])
+                    stable = stable + 1 if confirmed and new_ranking[:top_k] == ranking[:top_k] else 0
+                    ranking = new_ranking
+                if pending and stable >= settings.RERANK_STABLE_WINDOWS:
+                    report["early_exit"] = True
+                    break
+        finally:
+            # 尚未发起请求的窗口不再请求，已在执行的窗口不再等待
+            with lock:
+                cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        for future in pending:
+            window_id, members, submitted = futures[future]
+            entry = self._window_timing(window_id, members, submitted, started)
+            if window_id in started:
+                # LLM请求已发出，结果被丢弃，但仍在后台执行并占用调度器配额
+                status = "abandoned"
+            else:
+                status = "timeout" if report["deadline_exceeded"] else "skipped"
+            entry.update(status=status, scored=0)
+            report["windows"].append(entry)
+        report["total"] = round(time.time() - t_start, 4)
+        return [chunks[i] for i in ranking[:top_k]], report
+
+    def rerank(self, query: str, chunks: List[Dict[str, any]], top_k: int = None) -> List[Dict[str, any]]:
+        """使用LLM对检索结果进行重排序"""
+        reranked_chunks, _ = self.rerank_with_report(query, chunks, top_k)
+        return reranked_chunks
@@ -1,32 +1,309 @@
+import json
 import faiss
 import numpy as np
-from rank_bm25 import BM25Okapi
-from typing import List, Dict, Tuple, Optional
-import dashscope
+from typing import List, Dict, Tuple, Optional, Any
+from datetime import datetime
 import time
 from src.config import settings
+from src.outbound import scheduler, estimate_tokens, get_dashscope, PRIORITY_INTERACTIVE
+from src.text_splitter import chunk_subspans
+from src.bm25_index import PostingsBM25, bm25_idf
+
+# 各向量存储格式在 vectors.npy 中使用的数据类型
+# sq8/pq 的索引直接基于量化编码构建，vectors.npy 以float16保存，仅用于精确重排
+VECTOR_STORAGE_DTYPES = {
+    "float32": "float32",
+    "float16": "float16",
+    "sq8": "float16",
+    "pq": "float16",
+}
+
+def storage_dtype(storage: Optional[str] = None) -> str:
+    """获取向量存储格式对应的磁盘数据类型"""
+    storage = storage or settings.VECTOR_STORAGE
+    if storage not in VECTOR_STORAGE_DTYPES:
+        raise ValueError(f"不支持的向量存储格式: {storage}")
+    return VECTOR_STORAGE_DTYPES[storage]
+
+# 两阶段检索未配置RESCORE_FACTOR时，召回 top_k*该倍数 个候选再用完整向量重排
+TWO_STAGE_FACTOR = 4
+# numpy精确检索每次参与矩阵乘法的向量行数，限制float16转换产生的临时内存
+EXACT_SEARCH_BLOCK = 8192
+VECTOR_METRICS = {
+    "cosine": faiss.METRIC_INNER_PRODUCT,
+    "l2": faiss.METRIC_L2,
+}
+
+def metric_type(metric: Optional[str] = None) -> int:
+    """获取检索度量对应的FAISS度量类型"""
+    metric = metric or settings.VECTOR_METRIC
+    if metric not in VECTOR_METRICS:
+        raise ValueError(f"不支持的检索度量: {metric}")
+    return VECTOR_METRICS[metric]
+
+def normalize_vectors(vectors: np.ndarray) -> np.ndarray:
+    """L2归一化，返回float32副本"""
+    vectors = np.array(vectors, dtype='float32')
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def prepare_vectors(vectors: np.ndarray) -> np.ndarray:
+    """写入vectors.npy前的处理：cosine度量下归一化，检索时内积即余弦相似度"""
+    if settings.VECTOR_METRIC == "cosine":
+        return normalize_vectors(vectors)
+    return np.asarray(vectors, dtype='float32')
+
+def truncate_vectors(vectors: np.ndarray, dimension: int) -> np.ndarray:
+    """截取前dimension维并重新L2归一化（Matryoshka式表示的前缀本身即是有效的低维向量）"""
+    return normalize_vectors(vectors[:, :dimension])
+
+def calibrate_scores(raw: np.ndarray, metric: int) -> np.ndarray:
+    """
+    将原始检索得分映射到[0,1]，越大越相似，便于融合与设置阈值
+    内积（归一化向量即余弦）: (1 + cos) / 2；
+    L2平方距离: 1 / (1 + d²)，l2度量下向量不做归一化，映射不能假设向量为单位长度
+    """
+    raw = np.asarray(raw, dtype='float32')
+    if metric == faiss.METRIC_INNER_PRODUCT:
+        scores = (1.0 + raw) / 2.0
+    else:
+        # 浮点误差可能产生极小的负距离
+        scores = 1.0 / (1.0 + np.maximum(raw, 0.0))
+    return np.clip(scores, 0.0, 1.0)
+
+def exact_search(vectors: np.ndarray, queries: np.ndarray, top_k: int, metric: Optional[str] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    基于numpy矩阵乘法的精确检索，小规模语料下比FAISS索引开销更低
+    分块计算 queries @ vectors.T，每块用argpartition保留top_k候选，最后排序
+    :return: (校准到[0,1]的得分, 向量下标)，形状均为 (查询数, min(top_k, 向量数))，按得分降序
+    """
+    l2 = metric_type(metric) == faiss.METRIC_L2
+    queries = np.ascontiguousarray(queries, dtype='float32')
+    top_k = min(top_k, len(vectors))
+    if top_k == 0:
+        return np.empty((len(queries), 0), dtype='float32'), np.empty((len(queries), 0), dtype='int64')
+    best_scores = np.empty((len(queries), 0), dtype='float32')
+    best_ids = np.empty((len(queries), 0), dtype='int64')
+    for start in range(0, len(vectors), EXACT_SEARCH_BLOCK):
+        block = np.asarray(vectors[start:start + EXACT_SEARCH_BLOCK], dtype='float32')
+        scores = queries @ block.T
+        if l2:
+            # -d² = 2q·v - |v|² - |q|²，|q|²对排序无影响，最后再补上
+            scores = 2 * scores - np.einsum('ij,ij->i', block, block)[None, :]
+        if start == 0:
+            candidate_scores, candidate_ids = scores, np.broadcast_to(np.arange(len(block)), scores.shape)
+        else:
+            candidate_scores = np.concatenate([best_scores, scores], axis=1)
+            candidate_ids = np.concatenate([best_ids, np.broadcast_to(np.arange(start, start + len(block)), scores.shape)], axis=1)
+        if candidate_scores.shape[1] > top_k:
+            part = np.argpartition(-candidate_scores, top_k - 1, axis=1)[:, :top_k]
+            candidate_scores = np.take_along_axis(candidate_scores, part, axis=1)
+            candidate_ids = np.take_along_axis(candidate_ids, part, axis=1)
+        best_scores, best_ids = candidate_scores, candidate_ids
+
+    order = np.argsort(-best_scores, axis=1)
+    best_scores = np.take_along_axis(best_scores, order, axis=1)
+    best_ids = np.take_along_axis(best_ids, order, axis=1)
+    if l2:
+        distances = np.einsum('ij,ij->i', queries, queries)[:, None] - best_scores
+        return calibrate_scores(distances, faiss.METRIC_L2), best_ids
+    return calibrate_scores(best_scores, faiss.METRIC_INNER_PRODUCT), best_ids
+
+def search_dimension(dimension: int) -> int:
+    """索引实际使用的维度：开启两阶段检索时为SEARCH_DIMENSION，否则为完整维度"""
+    if 0 < settings.SEARCH_DIMENSION < dimension:
+        return settings.SEARCH_DIMENSION
+    return dimension
+
+def search_vectors(vectors: np.ndarray) -> np.ndarray:
+    """构建索引和查询索引所用的向量，开启两阶段检索时为截断后的低维向量"""
+    dimension = search_dimension(vectors.shape[1])
+    if dimension < vectors.shape[1]:
+        return truncate_vectors(vectors, dimension)
+    if settings.VECTOR_METRIC == "cosine":
+        return normalize_vectors(vectors)
+    return np.ascontiguousarray(vectors, dtype='float32')
+
+def max_sim(scores: np.ndarray, parents: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    将子片段得分按父分块聚合（取最大值），返回得分最高的top_k个父分块
+    全部为向量化运算：按得分降序排序后，每个父分块第一次出现的位置即其最大得分
+    """
+    order = np.argsort(-scores, kind='stable')
+    unique_parents, first = np.unique(parents[order], return_index=True)
+    best = order[first]
+    ranked = np.argsort(-scores[best], kind='stable')[:top_k]
+    return scores[best][ranked], unique_parents[ranked]
+
+def build_vector_index(vectors: np.ndarray, storage: Optional[str] = None) -> faiss.Index:
+    """
+    按存储格式构建FAISS索引，度量由VECTOR_METRIC决定（cosine为归一化向量上的内积）
+    float32: IndexFlatIP/IndexFlatL2；float16/sq8: IndexScalarQuantizer；pq: IndexPQ
+    训练样本不足或维度不能被PQ_M整除时，pq退化为sq8
+    开启两阶段检索时索引只包含向量的前SEARCH_DIMENSION维
+    """
+    storage = storage or settings.VECTOR_STORAGE
+    storage_dtype(storage)
+    metric = metric_type()
+    vectors = search_vectors(vectors)
+    dimension = vectors.shape[1]
+    
+    if storage == "pq" and (len(vectors) < 2 ** settings.PQ_NBITS or dimension % settings.PQ_M != 0):
+        print(f"[Retrieval] 向量数量({len(vectors)})不足以训练PQ或维度不匹配，改用sq8")
+        storage = "sq8"
+    
+    if storage == "float32":
+        index = faiss.IndexFlat(dimension, metric)
+    elif storage == "float16":
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, metric)
+    elif storage == "sq8":
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, metric)
+    else:
+        index = faiss.IndexPQ(dimension, settings.PQ_M, settings.PQ_NBITS, metric)
+    
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+class SearchFilter:
+    """检索过滤条件：文档列表、页码范围、上传时间范围，均为可选"""
+    def __init__(self, filenames: Optional[List[str]] = None, page_range: Optional[Tuple[int, int]] = None,
+                 uploaded_range: Optional[Tuple[Optional[float], Optional[float]]] = None):
+        self.filenames = filenames
+        self.page_range = page_range
+        self.uploaded_range = uploaded_range
+    
+    @staticmethod
+    def _parse_time(value: Any) -> Optional[float]:
+        """支持时间戳或ISO格式日期字符串"""
+        if value in (None, ""):
+            return None
+        if isinstance(value, (int, float)):
+            return float(value)
+        return datetime.fromisoformat(str(value)).timestamp()
+    
+    @classmethod
+    def from_request(cls, data: Dict[str, Any]) -> Optional["SearchFilter"]:
+        """从请求参数构建过滤条件，没有任何过滤条件时返回None"""
+        filenames = data.get("filenames") or None
+        page_range = data.get("page_range") or None
+        uploaded_after = cls._parse_time(data.get("uploaded_after"))
+        uploaded_before = cls._parse_time(data.get("uploaded_before"))
+        uploaded_range = None
+        if uploaded_after is not None or uploaded_before is not None:
+            uploaded_range = (uploaded_after, uploaded_before)
+        if not (filenames or page_range or uploaded_range):
+            return None
+        return cls(
+            filenames=list(filenames) if filenames else None,
+            page_range=(int(page_range[0]), int(page_range[1])) if page_range else None,
+            uploaded_range=uploaded_range
+        )
+    
+    def cache_key(self) -> str:
+        """过滤条件的规范化表示，用于区分答案缓存的检索范围"""
+        return json.dumps({
+            "filenames": sorted(self.filenames) if self.filenames else None,
+            "page_range": self.page_range,
+            "uploaded_range": self.uploaded_range
+        }, sort_keys=True)
+    
+    def may_match(self, retrieval: "Retrieval") -> bool:
+        """检索器中是否可能有命中的chunk：按文件名过滤时，不包含任何指定文件的段无需计算掩码"""
+        return self.filenames is None or any(name in retrieval.filename_codes for name in self.filenames)
+    
+    def mask(self, retrieval: "Retrieval") -> np.ndarray:
+        """基于检索器的列式元数据计算命中掩码，全部为向量化运算"""
+        mask = np.ones(len(retrieval.chunks), dtype=bool)
+        if self.filenames is not None:
+            codes = [retrieval.filename_codes[name] for name in self.filenames if name in retrieval.filename_codes]
+            mask &= np.isin(retrieval.chunk_files, codes)
+        if self.page_range is not None:
+            start, end = self.page_range
+            mask &= (retrieval.chunk_pages >= start) & (retrieval.chunk_pages <= end)
+        if self.uploaded_range is not None:
+            after, before = self.uploaded_range
+            if after is not None:
+                mask &= retrieval.chunk_uploaded_at >= after
+            if before is not None:
+                mask &= retrieval.chunk_uploaded_at <= before
+        return mask
 
 class Retrieval:
-    def __init__(self):
+    def __init__(self, priority: int = PRIORITY_INTERACTIVE):
+        """
+        :param priority: 构建索引时批量生成向量所用的调用优先级，向量化任务应使用 PRIORITY_BULK
+        """
+        self.priority = priority
         self.vector_index = None
         self.bm25_index = None
         self.chunks = []
         self.vectors = None
-        dashscope.api_key = settings.DASHSCOPE_API_KEY
-    
-    def get_embedding(self, text: str) -> List[float]:
-        """获取文本的向量表示"""
-        try:
-            # t0 = time.time()
-            response = dashscope.TextEmbedding.call(
-                model="text-embedding-v4",
-                input=text
+        # 多向量检索：句子级子片段的向量、对应的父分块下标（int32数组）和索引
+        self.span_vectors = None
+        self.span_parents = np.array([], dtype='int32')
+        self.span_index = None
+        # 列式元数据，用于过滤检索
+        self.filename_codes = {}
+        self.chunk_files = np.array([], dtype='int32')
+        self.chunk_pages = np.array([], dtype='int32')
+        self.chunk_uploaded_at = np.array([], dtype='float64')
+    
+    @staticmethod
+    def _call_embedding(texts: Any):
+        """调用Embedding接口，按配置请求服务端输出EMBEDDING_DIMENSION维向量"""
+        kwargs = {"dimension": settings.EMBEDDING_DIMENSION} if settings.EMBEDDING_REQUEST_DIMENSION else {}
+        return get_dashscope().TextEmbedding.call(model=settings.EMBEDDING_MODEL, input=texts, **kwargs)
+    
+    @staticmethod
+    def _fit_dimension(embeddings: List[List[float]]) -> List[List[float]]:
+        """服务端返回的向量长于EMBEDDING_DIMENSION时在本地截断并重新归一化"""
+        if not embeddings or len(embeddings[0]) <= settings.EMBEDDING_DIMENSION:
+            return embeddings
+        return truncate_vectors(np.array(embeddings, dtype='float32'), settings.EMBEDDING_DIMENSION).tolist()
+    
+    def get_embedding(self, text: str, priority: int = PRIORITY_INTERACTIVE) -> List[float]:
+        """
+        获取文本的向量表示
+        调用经过统一调度器限流与重试，重试耗尽时抛出异常，避免写入全零向量
+        """
+        response = scheduler.submit(
+            settings.EMBEDDING_MODEL,
+            lambda: self._call_embedding(text),
+            tokens=estimate_tokens(text),
+            priority=priority
+        )
+        return self._fit_dimension([response.output['embeddings'][0]['embedding']])[0]
+    
+    def _build_columns(self):
+        """从chunks提取文件名、页码、上传时间为numpy数组，过滤时无需遍历chunks"""
+        self.filename_codes = {}
+        files = []
+        for chunk in self.chunks:
+            name = chunk.get('filename', '')
+            files.append(self.filename_codes.setdefault(name, len(self.filename_codes)))
+        self.chunk_files = np.array(files, dtype='int32')
+        self.chunk_pages = np.array([chunk.get('page_num', 0) for chunk in self.chunks], dtype='int32')
+        self.chunk_uploaded_at = np.array([chunk.get('uploaded_at', np.nan) for chunk in self.chunks], dtype='float64')
+    
+    def get_embeddings(self, texts: List[str], priority: int = PRIORITY_INTERACTIVE) -> List[List[float]]:
+        """批量获取向量，每次请求最多 EMBEDDING_BATCH_SIZE 条文本，减少请求数"""
+        embeddings = []
+        batch_size = settings.EMBEDDING_BATCH_SIZE
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            response = scheduler.submit(
+                settings.EMBEDDING_MODEL,
+                lambda batch=batch: self._call_embedding(batch),
+                tokens=sum(estimate_tokens(text) for text in batch),
+                priority=priority
             )
-            # print(f"单次Embedding耗时: {time.time() - t0:.4f}s")
-            return response.output['embeddings'][0]['embedding']
-        except Exception as e:
-            print(f"获取向量失败: {e}")
-            return [0.0] * 1536
+            # 按text_index还原顺序
+            items = sorted(response.output['embeddings'], key=lambda item: item['text_index'])
+            embeddings.extend(self._fit_dimension([item['embedding'] for item in items]))
+        return embeddings
     
     def build_index(self, chunks: List[Dict[str, any]], vectors: Optional[List[List[float]]] = None):
         """
@@ -35,6 +312,7 @@ class Retrieval:
         :param vectors: 预计算的向量列表 (Optional)
         """
         self.chunks = chunks
+        self._build_columns()
         
         if not chunks:
             print("警告：chunks为空，无法构建索引")
@@ -46,84 +324,332 @@ class Retrieval:
         # 1. 处理向量
         if vectors is not None and len(vectors) == len(chunks):
             print(f"[Retrieval] 使用预计算的向量 (数量: {len(vectors)})")
-            self.vectors = np.array(vectors, dtype='float32')
+            self.vectors = prepare_vectors(vectors)
         else:
             # 如果没有提供向量或数量不匹配，重新计算
             print(f"[Retrieval] 正在为 {len(chunks)} 个分块生成向量(Embedding)...")
             t_embed_start = time.time()
-            self.vectors = np.array([self.get_embedding(chunk['content']) for chunk in chunks])
+            self.vectors = prepare_vectors(self.get_embeddings([chunk['content'] for chunk in chunks], self.priority))
             print(f"[Retrieval] 生成向量总耗时: {time.time() - t_embed_start:.4f}秒")
         
         # 2. 构建FAISS索引
         if len(self.vectors) > 0:
-            dimension = self.vectors.shape[1]
-            self.vector_index = faiss.IndexFlatL2(dimension)
-            self.vector_index.add(self.vectors)
+            self.vector_index = build_vector_index(self.vectors)
         else:
             self.vector_index = None
         
-        # 3. 构建BM25索引
-        if chunks:
-            # BM25构建速度通常很快，可以实时构建
-            tokenized_chunks = [chunk['content'].split() for chunk in chunks]
-            self.bm25_index = BM25Okapi(tokenized_chunks)
-        else:
-            self.bm25_index = None
+        # 2.1 多向量模式下为子片段生成向量
+        if settings.MULTI_VECTOR:
+            self._build_spans()
+        
+        # 3. 构建BM25倒排索引
+        # BM25构建速度通常很快，可以实时构建
+        self.bm25_index = PostingsBM25.build([chunk['content'] for chunk in chunks])
     
-    def vector_search(self, query: str, top_k: int = None) -> List[Tuple[float, Dict[str, any]]]:
-        """向量检索"""
+    def _build_spans(self):
+        """为当前chunks的句子级子片段生成向量并建索引"""
+        texts, parents = chunk_subspans(self.chunks)
+        if not texts:
+            return
+        print(f"[Retrieval] 正在为 {len(texts)} 个子片段生成向量(Embedding)...")
+        self.load_spans(prepare_vectors(self.get_embeddings(texts, self.priority)), np.array(parents, dtype='int32'))
+    
+    def load_spans(self, span_vectors: np.ndarray, span_parents: np.ndarray, span_index: Optional[faiss.Index] = None):
+        """
+        加载子片段向量（可为mmap数组）
+        :param span_parents: 每个子片段所属分块的下标
+        :param span_index: 磁盘上的子片段FAISS索引，为空时基于span_vectors在内存中构建
+        """
+        if len(span_vectors) == 0:
+            return
+        if span_index is None:
+            span_index = build_vector_index(span_vectors)
+        self.span_vectors = span_vectors
+        self.span_parents = np.asarray(span_parents, dtype='int32')
+        self.span_index = span_index
+    
+    def load_index(self, chunks: List[Dict[str, any]], vectors: np.ndarray, vector_index: Optional[faiss.Index] = None):
+        """
+        加载预先构建的索引（向量可为mmap数组，索引可为mmap只读FAISS索引）
+        :param chunks: 文本块列表
+        :param vectors: 与chunks一一对应的向量
+        :param vector_index: 磁盘上的FAISS索引，为空时基于vectors在内存中构建
+        """
+        self.chunks = chunks
+        self._build_columns()
+        self.bm25_index = PostingsBM25.build([chunk['content'] for chunk in chunks]) if chunks else None
+        self.load_vectors(vectors, vector_index)
+    
+    def load_vectors(self, vectors: np.ndarray, vector_index: Optional[faiss.Index] = None):
+        """
+        只加载向量与FAISS索引，chunks与BM25倒排已由磁盘文本索引加载（见 disk_index.load_text_index）
+        :param vector_index: 磁盘上的FAISS索引，为空时基于vectors在内存中构建
+        """
+        self.vectors = vectors
+        if vector_index is None and len(vectors) > 0:
+            vector_index = build_vector_index(vectors)
+        self.vector_index = vector_index
+    
+    def vector_search(self, query: str, top_k: int = None, search_filter: Optional[SearchFilter] = None,
+                      query_embedding: Optional[List[float]] = None) -> List[Tuple[float, Dict[str, any]]]:
+        """
+        向量检索，可选过滤条件在索引层面预过滤
+        :param query_embedding: 已计算好的查询向量，提供时不再调用Embedding接口
+        :return: [(校准到[0,1]的相似度得分, chunk)]，按得分降序
+        """
         if not self.vector_index:
             return []
         
         top_k = top_k or settings.TOP_K
-        query_vector = np.array([self.get_embedding(query)])
-        distances, indices = self.vector_index.search(query_vector, top_k)
+        if query_embedding is None:
+            query_embedding = self.get_embedding(query)
+        query_vector = np.array([query_embedding], dtype='float32')
+        if self.vectors is not None and query_vector.shape[1] != self.vectors.shape[1]:
+            raise ValueError(f"查询向量维度({query_vector.shape[1]})与索引向量维度({self.vectors.shape[1]})不一致，请重新向量化文档")
+        if settings.VECTOR_METRIC == "cosine":
+            query_vector = normalize_vectors(query_vector)
         
-        results = []
-        for i in range(len(indices[0])):
-            idx = indices[0][i]
-            if idx < len(self.chunks):
-                results.append((distances[0][i], self.chunks[idx]))
+        mask = None
+        if search_filter is not None:
+            mask = search_filter.mask(self)
+            if not mask.any():
+                return []
+        
+        scores, indices = self._search(self.vectors, self.vector_index, query_vector, top_k, mask)
+        if self.span_index is not None:
+            # 多向量检索：子片段命中按父分块聚合，分块得分取分块向量与其子片段的最大相似度
+            span_mask = mask[self.span_parents] if mask is not None else None
+            span_scores, span_ids = self._search(self.span_vectors, self.span_index, query_vector,
+                                                 top_k * settings.SUBSPAN_CANDIDATE_FACTOR, span_mask)
+            scores, indices = max_sim(
+                np.concatenate([scores, span_scores]),
+                np.concatenate([indices, self.span_parents[span_ids]]),
+                top_k
+            )
+        
+        return [(float(score), self.chunks[idx]) for score, idx in zip(scores, indices)]
+    
+    def _search(self, vectors: Optional[np.ndarray], index: faiss.Index, query_vector: np.ndarray, top_k: int,
+                mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        在一组向量上检索，返回 (校准到[0,1]的得分, 向量下标)，按得分降序
+        :param mask: 过滤掩码，为空时不过滤
+        """
+        ids = np.flatnonzero(mask) if mask is not None else None
+        if ids is not None and len(ids) == 0:
+            return np.array([], dtype='float32'), np.array([], dtype='int64')
+        
+        # 小规模float32语料或过滤后子集较小：直接用numpy矩阵乘法精确计算，没有索引调用开销，量化存储下也无需重排
+        # （numpy转换float16很慢，float16整库检索仍交给FAISS）
+        # IndexPQ不支持IDSelector，过滤时只能在子集上计算
+        total = index.ntotal
+        candidates = total if ids is None else len(ids)
+        use_exact = vectors is not None and (
+            (vectors.dtype == np.float32 and candidates <= settings.EXACT_SEARCH_MAX_VECTORS)
+            or (ids is not None and (len(ids) <= total * settings.FILTER_BRUTE_FORCE_RATIO
+                                     or isinstance(index, faiss.IndexPQ)))
+        )
+        if use_exact:
+            subset = vectors if ids is None else vectors[ids]
+            scores, indices = exact_search(subset, query_vector, top_k)
+            scores, indices = scores[0], indices[0]
+            if ids is not None:
+                indices = ids[indices]
+            return scores, indices
         
-        return results
+        # 两阶段检索时索引只包含低维前缀，查询向量同样截断
+        two_stage = index.d < query_vector.shape[1]
+        index_query = truncate_vectors(query_vector, index.d) if two_stage else query_vector
+        
+        # 量化索引或低维索引先召回更多候选，再用原始向量精确重排
+        rescore = (settings.RESCORE_FACTOR > 1 or two_stage) and vectors is not None
+        search_k = top_k * max(settings.RESCORE_FACTOR, TWO_STAGE_FACTOR if two_stage else 1) if rescore else top_k
+        
+        if ids is None:
+            distances, indices = index.search(index_query, search_k)
+        else:
+            # 过滤后集合较大：用位图IDSelector让FAISS在扫描时跳过未命中的向量
+            selector = faiss.IDSelectorBitmap(np.packbits(mask, bitorder='little'))
+            params = faiss.SearchParameters(sel=selector)
+            distances, indices = index.search(index_query, search_k, params=params)
+        distances, indices = distances[0], indices[0]
+        # FAISS在结果不足top_k时返回-1
+        valid = indices >= 0
+        distances, indices = distances[valid], indices[valid]
+        if rescore:
+            return self._rescore(vectors, query_vector, indices, top_k)
+        return calibrate_scores(distances, index.metric_type), indices
     
-    def bm25_search(self, query: str, top_k: int = None) -> List[Tuple[float, Dict[str, any]]]:
-        """BM25关键词检索"""
-        if not self.bm25_index:
+    @staticmethod
+    def _rescore(vectors: np.ndarray, query_vector: np.ndarray, indices: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """使用原始向量对候选结果精确计算相似度并重新排序"""
+        if len(indices) == 0:
+            return np.array([], dtype='float32'), indices
+        scores, order = exact_search(vectors[indices], query_vector, top_k)
+        return scores[0], indices[order[0]]
+    
+    def bm25_search(self, query: str, top_k: int = None, search_filter: Optional[SearchFilter] = None) -> List[Tuple[float, Dict[str, any]]]:
+        """
+        BM25关键词检索，只读取查询词的倒排表，返回包含查询词的chunk
+        有过滤条件时倒排表先按过滤掩码裁剪，只为命中的chunk计算得分
+        """
+        if self.bm25_index is None:
             return []
         
-        top_k = top_k or settings.TOP_K
-        tokenized_query = query.split()
-        scores = self.bm25_index.get_scores(tokenized_query)
+        mask = None
+        if search_filter is not None:
+            mask = search_filter.mask(self)
+            if not mask.any():
+                return []
+        doc_ids, scores = self.bm25_index.score(query.split(), mask=mask)
+        return self._bm25_top(doc_ids, scores, top_k or settings.TOP_K)
+    
+    def _bm25_top(self, doc_ids: np.ndarray, scores: np.ndarray, top_k: int) -> List[Tuple[float, Dict[str, any]]]:
+        """取BM25得分最高的top_k个chunk"""
+        if len(doc_ids) == 0:
+            return []
         
         # 获取top_k结果
-        indices = np.argsort(scores)[::-1][:top_k]
-        results = [(scores[idx], self.chunks[idx]) for idx in indices]
-        
-        return results
+        k = min(top_k, len(doc_ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(float(scores[i]), self.chunks[doc_ids[i]]) for i in top]
     
-    def hybrid_search(self, query: str, top_k: int = None) -> List[Dict[str, any]]:
-        """混合检索，结合向量检索和BM25检索"""
+    def hybrid_search(self, query: str, top_k: int = None, search_filter: Optional[SearchFilter] = None,
+                      query_embedding: Optional[List[float]] = None) -> List[Dict[str, any]]:
+        """
+        混合检索，结合向量检索和BM25检索
+        向量得分已校准到[0,1]，BM25得分按本次结果的最大值归一化，按 HYBRID_VECTOR_WEIGHT 加权融合后排序
+        返回的chunk副本中附带融合得分 score
+        """
         top_k = top_k or settings.TOP_K
+        weight = settings.HYBRID_VECTOR_WEIGHT
         
         # 获取两种检索结果
-        vector_results = self.vector_search(query, top_k)
-        bm25_results = self.bm25_search(query, top_k)
-        
-        # 合并结果，去重
-        chunk_ids = set()
-        hybrid_results = []
-        
-        # 先添加向量检索结果
-        for _, chunk in vector_results:
-            if chunk['chunk_id'] not in chunk_ids:
-                chunk_ids.add(chunk['chunk_id'])
-                hybrid_results.append(chunk)
-        
-        # 再添加BM25检索结果
-        for _, chunk in bm25_results:
-            if chunk['chunk_id'] not in chunk_ids:
-                chunk_ids.add(chunk['chunk_id'])
-                hybrid_results.append(chunk)
-        
-        return hybrid_results[:top_k]
+        vector_results = self.vector_search(query, top_k, search_filter, query_embedding)
+        bm25_results = self.bm25_search(query, top_k, search_filter)
+        
+        # 合并结果，按 (文件名, chunk_id) 去重
+        fused = {}
+        for score, chunk in vector_results:
+            key = (chunk.get('filename'), chunk['chunk_id'])
+            fused.setdefault(key, [chunk, 0.0, 0.0])[1] = score
+        
+        max_bm25 = max((float(score) for score, _ in bm25_results), default=0.0)
+        for score, chunk in bm25_results:
+            key = (chunk.get('filename'), chunk['chunk_id'])
+            fused.setdefault(key, [chunk, 0.0, 0.0])[2] = float(score) / max_bm25 if max_bm25 > 0 else 0.0
+        
+        ranked = sorted(
+            fused.values(),
+            key=lambda item: weight * item[1] + (1 - weight) * item[2],
+            reverse=True
+        )
+        return [
+            dict(chunk, score=round(weight * vector_score + (1 - weight) * bm25_score, 4))
+            for chunk, vector_score, bm25_score in ranked[:top_k]
+        ]
+
+
+class SegmentFilter:
+    """在检索过滤条件上叠加段内的存活掩码，排除合并段中已被新版本替换或已删除的文档"""
+    def __init__(self, live: np.ndarray, search_filter: Optional[SearchFilter] = None):
+        self.live = live
+        self.search_filter = search_filter
+    
+    def mask(self, retrieval: "Retrieval") -> np.ndarray:
+        if self.search_filter is None:
+            return self.live.copy()
+        return self.search_filter.mask(retrieval) & self.live
+
+
+class SegmentChunks:
+    """多个段的chunks按顺序拼接成的只读序列，不复制各段的chunks"""
+    def __init__(self, parts: List[Any]):
+        self.parts = parts
+        self.offsets = np.cumsum([0] + [len(part) for part in parts])
+    
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+    
+    def __getitem__(self, idx: int) -> Dict[str, any]:
+        part = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        return self.parts[part][idx - int(self.offsets[part])]
+    
+    def __iter__(self):
+        for part in self.parts:
+            yield from part
+
+
+class SegmentedRetrieval(Retrieval):
+    """
+    由多个不可变段组成的全局检索器，查询在各段上分别执行后按得分合并
+    向量得分已校准到[0,1]，可直接跨段比较；BM25的idf与平均文档长度按全部段的存活chunk统计，
+    各段用同一组统计量打分，得分与把所有存活chunk放在一个语料中计算一致
+    （负idf的下限 epsilon * 平均idf 中的平均idf取各段按chunk数加权的均值，是近似值）
+    """
+    def __init__(self, segments: List[Tuple[Retrieval, Optional[np.ndarray]]]):
+        """
+        :param segments: (段检索器, 存活掩码) 列表，掩码为None表示段内全部chunk有效
+        """
+        super().__init__()
+        self.segments = segments
+        self.chunks = SegmentChunks([retrieval.chunks for retrieval, _ in segments])
+        # 全局BM25统计：存活chunk数、总词数、加权平均idf（段不可变，快照内只算一次）
+        corpus_size, total_length, idf_sum = 0, 0.0, 0.0
+        for retrieval, live in segments:
+            bm25 = retrieval.bm25_index
+            if bm25 is None:
+                continue
+            if live is None:
+                size, length = bm25.corpus_size, bm25.avgdl * bm25.corpus_size
+            else:
+                size, length = int(np.count_nonzero(live)), float(np.sum(bm25.doc_lengths[live]))
+            corpus_size += size
+            total_length += length
+            idf_sum += bm25.average_idf * size
+        self.corpus_size = corpus_size
+        self.avgdl = total_length / corpus_size if corpus_size else 0.0
+        self.average_idf = idf_sum / corpus_size if corpus_size else 0.0
+    
+    @staticmethod
+    def _segment_filter(live: Optional[np.ndarray], search_filter: Optional[SearchFilter]):
+        return search_filter if live is None else SegmentFilter(live, search_filter)
+    
+    def vector_search(self, query: str, top_k: int = None, search_filter: Optional[SearchFilter] = None,
+                      query_embedding: Optional[List[float]] = None) -> List[Tuple[float, Dict[str, any]]]:
+        top_k = top_k or settings.TOP_K
+        # 查询向量只生成一次，各段共用
+        if query_embedding is None:
+            query_embedding = self.get_embedding(query)
+        results = []
+        for retrieval, live in self.segments:
+            if search_filter is not None and not search_filter.may_match(retrieval):
+                continue
+            results.extend(retrieval.vector_search(query, top_k, self._segment_filter(live, search_filter), query_embedding))
+        results.sort(key=lambda item: item[0], reverse=True)
+        return results[:top_k]
+    
+    def bm25_search(self, query: str, top_k: int = None, search_filter: Optional[SearchFilter] = None) -> List[Tuple[float, Dict[str, any]]]:
+        top_k = top_k or settings.TOP_K
+        tokens = query.split()
+        if not self.corpus_size:
+            return []
+        # 查询词的文档频率在全部段上累加，得到全局idf
+        idf = {}
+        for term in set(tokens):
+            df = sum(retrieval.bm25_index.document_frequency(term, live)
+                     for retrieval, live in self.segments if retrieval.bm25_index is not None)
+            idf[term] = bm25_idf(self.corpus_size, df, self.average_idf)
+        results = []
+        for retrieval, live in self.segments:
+            if retrieval.bm25_index is None or search_filter is not None and not search_filter.may_match(retrieval):
+                continue
+            segment_filter = self._segment_filter(live, search_filter)
+            mask = segment_filter.mask(retrieval) if segment_filter is not None else None
+            if mask is not None and not mask.any():
+                continue
+            doc_ids, scores = retrieval.bm25_index.score(tokens, idf, self.avgdl, mask)
+            results.extend(retrieval._bm25_top(doc_ids, scores, top_k))
+        results.sort(key=lambda item: float(item[0]), reverse=True)
+        return results[:top_k]
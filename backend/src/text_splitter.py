@@ -1,20 +1,70 @@
-import tiktoken
-from typing import List, Dict, Optional
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import re
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
 from src.config import settings
 
+@lru_cache(maxsize=None)
+def get_encoding():
+    """进程内共享的tiktoken编码（gpt-4 对应 cl100k_base），首次使用时加载"""
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base")
+
+@lru_cache(maxsize=None)
+def get_text_splitter(chunk_size: int, chunk_overlap: int):
+    """按块大小缓存的递归分割器，与 from_tiktoken_encoder 等价但复用同一个编码"""
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    encoding = get_encoding()
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=lambda text: len(encoding.encode(text, allowed_special=set(), disallowed_special="all")),
+        separators=["\n\n", "\n", "。", "！", "？", ".", "!", "?", " ", ""]
+    )
+
+# 句子边界：中英文句末标点或换行
+SENTENCE_BOUNDARY = re.compile(r"(?<=[。！？；!?;\n])|(?<=\.)(?=\s)")
+
+def split_subspans(text: str, min_chars: int = None) -> List[str]:
+    """将分块文本切分为句子级子片段，过短的句子与后续句子合并，供多向量检索使用"""
+    min_chars = min_chars or settings.SUBSPAN_MIN_CHARS
+    spans = []
+    current = ""
+    for sentence in SENTENCE_BOUNDARY.split(text):
+        if not sentence or not sentence.strip():
+            continue
+        current += sentence
+        if len(current.strip()) >= min_chars:
+            spans.append(current.strip())
+            current = ""
+    if current.strip():
+        # 末尾剩余的短句并入上一个子片段
+        if spans:
+            spans[-1] = f"{spans[-1]}{current}".strip()
+        else:
+            spans.append(current.strip())
+    return spans
+
+def chunk_subspans(chunks: List[Dict[str, any]], offset: int = 0) -> Tuple[List[str], List[int]]:
+    """
+    为一批分块生成子片段
+    只有一个子片段的分块与分块向量重复，直接跳过
+    :param offset: 第一个分块在文档中的下标
+    :return: (子片段文本, 对应的父分块下标)
+    """
+    texts, parents = [], []
+    for i, chunk in enumerate(chunks):
+        spans = split_subspans(chunk["content"])
+        if len(spans) > 1:
+            texts.extend(spans)
+            parents.extend([offset + i] * len(spans))
+    return texts, parents
+
 class TextSplitter:
     def __init__(self, chunk_size: int = None, chunk_overlap: int = None):
         self.chunk_size = chunk_size or settings.CHUNK_SIZE
         self.chunk_overlap = chunk_overlap or settings.CHUNK_OVERLAP
-        self.encoding = tiktoken.get_encoding("cl100k_base")
-        
-        self.text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            model_name="gpt-4",
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap,
-            separators=["\n\n", "\n", "。", "！", "？", ".", "!", "?", " ", ""]
-        )
+        self.encoding = get_encoding()
+        self.text_splitter = get_text_splitter(self.chunk_size, self.chunk_overlap)
     
     def count_tokens(self, text: str) -> int:
         """统计文本的 token 数量"""
@@ -69,6 +119,15 @@ class TextSplitter:
         
         return chunks
     
+    def split_elements(self, elements: List[Dict[str, any]], page_sizes: Optional[Dict[int, Dict[str, float]]] = None,
+                       min_tokens: int = None) -> List[Dict[str, any]]:
+        """
+        基于Docling文档结构分块：按章节聚合段落，表格整体成块，记录章节路径和真实页码
+        章节累积不足 min_tokens 时与下一章节合并，以减少过碎的小块
+        """
+        chunker = StructureChunker(self, page_sizes, min_tokens)
+        return chunker.feed(elements) + chunker.finish()
+    
     def split_markdown_by_lines(self, markdown_text: str, chunk_size: int = 30, chunk_overlap: int = 5) -> List[Dict[str, any]]:
         """按行分割 markdown 文本，每个分块记录起止行号和内容"""
         lines = markdown_text.split('\n')
@@ -137,3 +196,109 @@ class TextSplitter:
             "min_tokens": min_tokens,
             "max_tokens": max_tokens
         }
+
+class StructureChunker:
+    """
+    可增量喂入元素的结构化分块器，供流水线按页批次分块
+    跨批次的章节路径、未输出的段落缓冲和页内分块序号都保存在状态中，可序列化后断点续跑
+    """
+    def __init__(self, splitter: TextSplitter, page_sizes: Optional[Dict[int, Dict[str, float]]] = None,
+                 min_tokens: int = None, state: Optional[Dict[str, any]] = None):
+        self.splitter = splitter
+        self.page_sizes = page_sizes or {}
+        self.min_tokens = min_tokens if min_tokens is not None else settings.CHUNK_MIN_TOKENS
+        state = state or {}
+        self.section_path = state.get("section_path", [])
+        # JSON序列化后页码键会变为字符串
+        self.chunk_counts = {int(page): count for page, count in state.get("chunk_counts", {}).items()}
+        # 当前正在累积的分块
+        self.buffer = state.get("buffer", [])
+        self.buffer_pages = state.get("buffer_pages", [])
+        self.buffer_path = state.get("buffer_path", [])
+        self.buffer_tokens = state.get("buffer_tokens", 0)
+    
+    def get_state(self) -> Dict[str, any]:
+        return {
+            "section_path": list(self.section_path),
+            "chunk_counts": dict(self.chunk_counts),
+            "buffer": list(self.buffer),
+            "buffer_pages": list(self.buffer_pages),
+            "buffer_path": list(self.buffer_path),
+            "buffer_tokens": self.buffer_tokens
+        }
+    
+    def _make_chunk(self, content: str, pages: List[int], section_path: List[str], chunk_type: str) -> Dict[str, any]:
+        """构建结构化分块，chunk_id 按起始页内序号编号"""
+        page_num = pages[0]
+        self.chunk_counts[page_num] = self.chunk_counts.get(page_num, 0) + 1
+        page_size = self.page_sizes.get(page_num, {})
+        return {
+            "content": content,
+            "page_num": page_num,
+            "pages": sorted(set(pages)),
+            "section_path": list(section_path),
+            "chunk_type": chunk_type,
+            "chunk_id": f"{page_num}-{self.chunk_counts[page_num]}",
+            "length_tokens": self.splitter.count_tokens(content),
+            "original_page": {
+                "page_num": page_num,
+                "page_width": page_size.get("width", 0),
+                "page_height": page_size.get("height", 0)
+            }
+        }
+    
+    def _flush_buffer(self) -> List[Dict[str, any]]:
+        if not self.buffer:
+            return []
+        chunk = self._make_chunk("\n\n".join(self.buffer), self.buffer_pages, self.buffer_path, "text")
+        self.buffer, self.buffer_pages, self.buffer_tokens = [], [], 0
+        return [chunk]
+    
+    def feed(self, elements: List[Dict[str, any]], page_sizes: Optional[Dict[int, Dict[str, float]]] = None) -> List[Dict[str, any]]:
+        """喂入一批元素，返回已完整的分块；末尾未满的段落保留在缓冲中"""
+        if page_sizes:
+            self.page_sizes.update(page_sizes)
+        chunk_size = self.splitter.chunk_size
+        chunks = []
+        
+        for element in elements:
+            text = element.get("text", "").strip()
+            if not text:
+                continue
+            element_type = element.get("type", "text")
+            page_num = element.get("page_num", 1)
+            tokens = self.splitter.count_tokens(text)
+            
+            # 以下情况先输出已累积的内容：遇到表格、超长段落、达到块大小、或遇到新章节且已有足够内容
+            if (
+                element_type == "table"
+                or tokens > chunk_size
+                or self.buffer_tokens + tokens > chunk_size
+                or (element_type == "heading" and self.buffer_tokens >= self.min_tokens)
+            ):
+                chunks.extend(self._flush_buffer())
+            
+            if element_type == "heading":
+                level = max(element.get("level", 1), 1)
+                self.section_path = self.section_path[:level - 1] + [text]
+                text = f"{'#' * min(level, 6)} {text}"
+            
+            if element_type == "table":
+                # 表格保持完整，不与正文合并也不切分
+                chunks.append(self._make_chunk(text, [page_num], self.section_path, "table"))
+            elif tokens > chunk_size:
+                # 超长段落退回到按token切分
+                for piece in self.splitter.split_text(text):
+                    chunks.append(self._make_chunk(piece, [page_num], self.section_path, "text"))
+            else:
+                if not self.buffer:
+                    self.buffer_path = list(self.section_path)
+                self.buffer.append(text)
+                self.buffer_pages.append(page_num)
+                self.buffer_tokens += tokens
+        
+        return chunks
+    
+    def finish(self) -> List[Dict[str, any]]:
+        """文档结束，输出缓冲中剩余的内容"""
+        return self._flush_buffer()
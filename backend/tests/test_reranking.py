@@ -0,0 +1,77 @@
+import re
+import time
+import types
+import threading
+import pytest
+from src.config import settings
+from src import reranking
+
+
+class FakeResponse:
+    status_code = 200
+    usage = {}
+
+    def __init__(self, text: str):
+        self.output = {"text": text}
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    """
+    模拟LLM打分：内容含gold的候选得9分，其余2分；内容中的 delay=秒数 控制该窗口的响应延迟
+    返回实际发出的请求中包含的候选内容列表
+    """
+    calls = []
+    lock = threading.Lock()
+
+    def call(model, messages, **kwargs):
+        items = re.findall(r"\[(\d+)\] (\S+)", messages[1]["content"])
+        with lock:
+            calls.append([content for _, content in items])
+        delays = [float(m) for _, content in items for m in re.findall(r"delay=([\d.]+)", content)]
+        time.sleep(max(delays, default=0.0))
+        return FakeResponse("\n".join(f"{i}: {9 if 'gold' in content else 2}" for i, content in items))
+
+    fake = types.SimpleNamespace(Generation=types.SimpleNamespace(call=call))
+    monkeypatch.setattr(reranking, "get_dashscope", lambda: fake)
+    return calls
+
+
+def make_chunks(contents):
+    return [{"content": content} for content in contents]
+
+
+def test_default_settings_exit_early(fake_llm):
+    """默认配置（10个候选、3个一窗、稳定1个窗口）下，top_k确定且保持不变后不再等待最后一个慢窗口"""
+    contents = [f"c{i}-delay={0.1 * (i // 3 + 1)}" for i in range(10)]
+    contents[1], contents[4] = "gold1-delay=0.1", "gold4-delay=0.2"
+    contents[9] = "c9-delay=3"
+    chunks = make_chunks(contents)
+
+    result, report = reranking.Reranking().rerank_with_report("q", chunks, top_k=5)
+
+    assert report["early_exit"] is True
+    assert report["total"] < 2
+    assert [chunk["content"] for chunk in result[:2]] == ["gold1-delay=0.1", "gold4-delay=0.2"]
+    statuses = {entry["window"]: entry["status"] for entry in report["windows"]}
+    assert statuses[3] == "abandoned"
+    assert [statuses[i] for i in range(3)] == ["ok", "ok", "ok"]
+
+
+def test_deadline_skips_unstarted_windows_and_ranks_unscored_last(fake_llm, monkeypatch):
+    """超时后未开始的窗口不再请求LLM；未打分的候选排在已打分的候选之后"""
+    monkeypatch.setattr(settings, "RERANK_CONCURRENCY", 1)
+    monkeypatch.setattr(settings, "RERANK_DEADLINE", 0.3)
+    contents = ["c0", "c1", "c2", "c3-delay=1", "c4", "c5", "gold6", "c7", "c8", "c9"]
+    chunks = make_chunks(contents)
+
+    result, report = reranking.Reranking().rerank_with_report("q", chunks, top_k=5)
+    time.sleep(1)
+
+    assert report["deadline_exceeded"] is True
+    statuses = {entry["window"]: entry["status"] for entry in report["windows"]}
+    assert statuses == {0: "ok", 1: "abandoned", 2: "timeout", 3: "timeout"}
+    # 只发出了前两个窗口的请求
+    assert len(fake_llm) == 2
+    # 已打分（2分）的窗口0排在未打分的候选之前，未打分的候选按检索顺序排列
+    assert [chunk["content"] for chunk in result] == ["c0", "c1", "c2", "c3-delay=1", "c4"]
@@ -3,6 +3,11 @@ export interface PDFFile {
   size: number
   mtime: number
   vectorized: boolean
+  status?: 'uploaded' | 'vectorizing' | 'vectorized' | 'failed'
+  page_count?: number | null
+  chunk_count?: number | null
+  version?: number
+  dimension_mismatch?: boolean
 }
 
 export interface Answer {